@@ -15,6 +15,27 @@ from datetime import datetime, timedelta
 import re
 import csv
 import pytsk3
+import tempfile
+import shutil
+import multiprocessing
+import io
+import struct
+import hashlib
+import mmap
+import bisect
+import threading
+import Queue
+from collections import OrderedDict
+
+try:
+    import pyewf
+except ImportError:
+    pyewf = None
+
+try:
+    import pyvshadow
+except ImportError:
+    pyvshadow = None
 
 # Enums #######################################################################
 
@@ -41,6 +62,56 @@ class WindowsVersions(Enum):
 usb_devices = []
 debug_mode = False
 os_version = WindowsVersions.NotDefined
+spill_threshold = 256 * 1024 * 1024
+cache_size = 64 * 1024 * 1024
+read_ahead = 8
+prefetch_mode = False
+image_type = 'auto'
+user_workers = 1
+discover_mode = False
+shadow_mode = False
+carve_mode = False
+carve_workers = 1
+image_handle = None
+manifest_mode = False
+manifest = []
+current_image = ''
+current_offset = 0
+current_snapshot = ''
+artifact_index = None
+
+# The file names that the MFT discovery pass indexes
+ARTIFACT_NAMES = ['system', 'software', 'ntuser.dat', 'usrclass.dat', 'setupapi.log', 'setupapi.dev.log',
+                  'system.log', 'system.log1', 'system.log2', 'software.log', 'software.log1', 'software.log2',
+                  'ntuser.dat.log', 'ntuser.dat.log1', 'ntuser.dat.log2']
+USER_HIVE_BATCH = 16
+
+# The variables set from the command line, passed to the worker processes by the pool
+# initializer as a spawned (Windows) worker does not inherit them
+WORKER_SETTINGS = ['debug_mode', 'spill_threshold', 'cache_size', 'read_ahead', 'prefetch_mode', 'image_type',
+                   'user_workers', 'discover_mode', 'shadow_mode', 'carve_mode', 'carve_workers', 'manifest_mode']
+
+# Data runs closer together than the gap are read in one request, up to the maximum read size
+COALESCE_GAP = 256 * 1024
+COALESCE_MAX = 32 * 1024 * 1024
+
+MFT_ROOT_RECORD = 5
+MFT_RECORD_HEADER_SIZE = 0x30
+MFT_RECORDS_PER_READ = 1024
+NTFS_BITMAP_RECORD = 6
+
+# Unallocated space is carved in blocks of this size, each block is read with an
+# overlap so that setupapi sections that cross the end of a block are complete
+CARVE_BLOCK_SIZE = 32 * 1024 * 1024
+CARVE_SECTION_MAX = 64 * 1024
+CARVE_HBIN_MAX = 16 * 1024 * 1024
+REGF_HEADER_SIZE = 4096
+HBIN_HEADER_SIZE = 32
+temp_directory = None
+
+# Extensions of the first segment of EWF and split raw image sets
+EWF_EXTENSIONS = ['.e01', '.ex01', '.s01', '.l01']
+SPLIT_RAW_EXTENSIONS = ['.001', '.000', '.aa']
 
 # Objects #####################################################################
 
@@ -86,135 +157,1104 @@ class UsbDevice():
         self.usbstor_datetime67 = datetime.min
         self.mountpoint2 = []
         self.emdmgmt = []
+        self.image = ''
+        self.partition_offset = 0
+        self.snapshot = ''
+        self.source = ''
+
+
+class RawImage():
+    """Single raw image file read through the file system"""
+    def __init__(self, path):
+        self.handle = open(path, 'rb')
+        self.handle.seek(0, os.SEEK_END)
+        self.size = self.handle.tell()
+
+    def close(self):
+        self.handle.close()
+
+    def get_size(self):
+        return self.size
+
+    def read(self, offset, size):
+        self.handle.seek(offset)
+        return self.handle.read(size)
+
+
+class MmapRawImage(RawImage):
+    """Raw image mapped into memory. Sparse images only occupy the blocks that
+    have been written, the holes are served as zeros by the OS page cache"""
+    def __init__(self, path):
+        RawImage.__init__(self, path)
+        self.map = None
+        if self.size > 0:
+            self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.handle.close()
+
+    def read(self, offset, size):
+        if self.map is None:
+            return ''
+        return self.map[offset:offset + size]
+
+
+class SplitRawImage():
+    """Split raw image (.001, .002 ...) presented as one image, the segments are
+    located using an index of their starting offsets"""
+    def __init__(self, paths):
+        self.handles = []
+        self.offsets = []
+        self.size = 0
+        for path in paths:
+            handle = open(path, 'rb')
+            handle.seek(0, os.SEEK_END)
+            self.handles.append(handle)
+            self.offsets.append(self.size)
+            self.size += handle.tell()
+
+    def close(self):
+        for handle in self.handles:
+            handle.close()
+
+    def get_size(self):
+        return self.size
+
+    def read(self, offset, size):
+        data = []
+        size = min(size, self.size - offset)
+        segment = bisect.bisect_right(self.offsets, offset) - 1
+        while size > 0 and segment < len(self.handles):
+            handle = self.handles[segment]
+            handle.seek(offset - self.offsets[segment])
+            buffer = handle.read(size)
+            if len(buffer) == 0:
+                break
+
+            data.append(buffer)
+            offset += len(buffer)
+            size -= len(buffer)
+            segment += 1
+
+        return ''.join(data)
+
+
+class EwfImage():
+    """EWF (E01) image set read through libewf"""
+    def __init__(self, path):
+        self.handle = pyewf.handle()
+        self.handle.open(pyewf.glob(path))
+        self.size = self.handle.get_media_size()
+
+    def close(self):
+        self.handle.close()
+
+    def get_size(self):
+        return self.size
+
+    def read(self, offset, size):
+        self.handle.seek(offset)
+        return self.handle.read(size)
+
+
+class CachedImgInfo(pytsk3.Img_Info):
+    """Image that serves reads from an LRU cache of fixed size blocks, reading ahead
+    when the blocks are being read sequentially. Hive parsing produces many small
+    local reads, which are expensive on images stored on network shares. In prefetch
+    mode the read ahead is performed by a background thread so that the parsing
+    continues while the following blocks are being read. Pinned blocks are kept
+    outside of the LRU, so files larger than the cache (the hives) can be shared with
+    the volume shadow copies, which read the same physical blocks"""
+
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, image, cache_size, read_ahead, prefetch=False):
+        self.image = image
+        self.size = image.get_size()
+        self.max_blocks = max(cache_size // self.BLOCK_SIZE, read_ahead + 1, 1)
+        self.read_ahead = read_ahead
+        self.blocks = OrderedDict()
+        self.pinned = {}
+        self.last_block = -1
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0
+
+        # The image lock serialises the reads of the backend, the condition guards the
+        # cache and signals the arrival of blocks that are being prefetched
+        self.image_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.pending = set()
+        self.prefetch_queue = None
+        self.prefetch_thread = None
+        if prefetch is True and read_ahead > 0:
+            self.prefetch_queue = Queue.Queue()
+            self.prefetch_thread = threading.Thread(target=self.prefetch_blocks)
+            self.prefetch_thread.daemon = True
+            self.prefetch_thread.start()
+
+        super(CachedImgInfo, self).__init__(url='', type=pytsk3.TSK_IMG_TYPE_EXTERNAL)
+
+    def close(self):
+        if self.prefetch_thread is not None:
+            self.prefetch_queue.put(None)
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+
+        self.blocks.clear()
+        self.pinned.clear()
+        self.image.close()
+
+    def get_size(self):
+        return self.size
+
+    def read_image(self, offset, size):
+        """Reads from the image backend"""
+        with self.image_lock:
+            self.reads += 1
+            return self.image.read(offset, size)
+
+    def read_direct(self, offset, size):
+        """Reads straight from the image, bypassing the cache, used for large sequential reads"""
+        return self.read_image(offset, min(size, self.size - offset))
+
+    def read(self, offset, size):
+        if offset >= self.size:
+            return ''
+        size = min(size, self.size - offset)
+
+        data = []
+        block = offset // self.BLOCK_SIZE
+        last_block = (offset + size - 1) // self.BLOCK_SIZE
+        while block <= last_block:
+            data.append(self.get_block(block))
+            block += 1
+
+        start = offset % self.BLOCK_SIZE
+        return ''.join(data)[start:start + size]
+
+    def read_pinned(self, offset, size):
+        """Reads through the cache, pinning the blocks read so that they are not evicted until unpinned"""
+        if offset >= self.size:
+            return ''
+        size = min(size, self.size - offset)
+
+        data = []
+        block = offset // self.BLOCK_SIZE
+        last_block = (offset + size - 1) // self.BLOCK_SIZE
+        while block <= last_block:
+            data.append(self.get_block(block, True))
+            block += 1
+
+        start = offset % self.BLOCK_SIZE
+        return ''.join(data)[start:start + size]
+
+    def unpin(self):
+        """Releases the pinned blocks"""
+        with self.condition:
+            self.pinned.clear()
+
+    def get_block(self, block, pin=False):
+        """Returns a single block, from the cache if possible"""
+        sequential = block == self.last_block + 1
+        self.last_block = block
+
+        with self.condition:
+            data = self.pinned.get(block)
+            if data is not None:
+                self.hits += 1
+                return data
+
+            # Wait for the block if the prefetch thread is already reading it
+            while block in self.pending:
+                self.condition.wait()
+
+            data = self.blocks.pop(block, None)
+            if data is not None:
+                self.hits += 1
+                self.blocks[block] = data
+                if pin is True:
+                    self.pinned[block] = data
+                if sequential is True:
+                    self.queue_prefetch(block + 1)
+                return data
+
+            self.misses += 1
+
+        # Sequential access so read the following blocks in the same request,
+        # or hand them to the prefetch thread and only read the requested block
+        count = 1
+        if sequential is True:
+            if self.prefetch_queue is not None:
+                with self.condition:
+                    self.queue_prefetch(block + 1)
+            else:
+                count += self.read_ahead
+
+        offset = block * self.BLOCK_SIZE
+        buffer = self.read_image(offset, min(count * self.BLOCK_SIZE, self.size - offset))
+        with self.condition:
+            for index in range(0, len(buffer), self.BLOCK_SIZE):
+                self.add_block(block + index // self.BLOCK_SIZE, buffer[index:index + self.BLOCK_SIZE])
+            if pin is True:
+                self.pinned[block] = buffer[:self.BLOCK_SIZE]
+
+        return buffer[:self.BLOCK_SIZE]
+
+    def queue_prefetch(self, block):
+        """Queues the read ahead blocks that are not cached or already pending, the condition must be held"""
+        if self.prefetch_queue is None:
+            return
+
+        last_block = min(block + self.read_ahead, (self.size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE)
+        while block < last_block and (block in self.blocks or block in self.pending):
+            block += 1
+
+        if block >= last_block:
+            return
+
+        count = last_block - block
+        for index in range(block, last_block):
+            self.pending.add(index)
+        self.prefetch_queue.put((block, count))
+
+    def prefetch_blocks(self):
+        """Prefetch thread, reads the queued blocks into the cache"""
+        while True:
+            request = self.prefetch_queue.get()
+            if request is None:
+                return
+
+            block, count = request
+            offset = block * self.BLOCK_SIZE
+            try:
+                buffer = self.read_image(offset, min(count * self.BLOCK_SIZE, self.size - offset))
+            except Exception:
+                buffer = ''
+
+            with self.condition:
+                for index in range(0, len(buffer), self.BLOCK_SIZE):
+                    self.add_block(block + index // self.BLOCK_SIZE, buffer[index:index + self.BLOCK_SIZE])
+                for index in range(block, block + count):
+                    self.pending.discard(index)
+                self.condition.notify_all()
+
+    def add_block(self, block, data):
+        """Adds a block to the cache, evicting the least recently used blocks, the condition must be held"""
+        self.blocks.pop(block, None)
+        self.blocks[block] = data
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+
+class VolumeFileObject():
+    """File-like object over a partition of the image, used to open the volume shadow
+    copies. The reads go through the image block cache, so the snapshot blocks that
+    are shared with the live volume are cached by their physical offset"""
+    def __init__(self, image, offset):
+        self.image = image
+        self.offset = offset
+        self.size = image.get_size() - offset
+        self.position = 0
+
+    def get_size(self):
+        return self.size
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.position
+        size = max(min(size, self.size - self.position), 0)
+        if size == 0:
+            return ''
+
+        data = self.image.read(self.offset + self.position, size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class ShadowStoreImgInfo(pytsk3.Img_Info):
+    """Volume shadow copy store presented to pytsk3 as an image of the volume"""
+    def __init__(self, store):
+        self.store = store
+        self.size = store.get_volume_size()
+        super(ShadowStoreImgInfo, self).__init__(url='', type=pytsk3.TSK_IMG_TYPE_EXTERNAL)
+
+    def close(self):
+        pass
+
+    def get_size(self):
+        return self.size
+
+    def read(self, offset, size):
+        if offset >= self.size:
+            return ''
+        self.store.seek_offset(offset)
+        return self.store.read_buffer(min(size, self.size - offset))
+
+    def read_direct(self, offset, size):
+        """Reads straight from the store, the store reads go through the image block cache"""
+        return self.read(offset, size)
+
+
+class MftEntry():
+    """Encapsulates the details of an MFT record needed to locate an artifact"""
+    def __init__(self):
+        self.record = 0
+        self.parent = 0
+        self.name = ''
+        self.path = ''
+        self.in_use = False
+        self.is_directory = False
+        self.resident = False
+        self.size = 0
+
+
+class ArtifactHasher():
+    """Computes the MD5 and SHA-256 of a file from chunks that may arrive out of
+    logical order (coalesced data runs), buffering chunks until they can be hashed
+    in order. Gaps left by sparse runs are hashed as zeros"""
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.position = 0
+        self.pending = {}
+
+    def update(self, offset, data):
+        if offset != self.position:
+            self.pending[offset] = data
+            return
+
+        self.hash(data)
+        while self.position in self.pending:
+            self.hash(self.pending.pop(self.position))
+
+    def finish(self, size):
+        """Hashes the remaining chunks, zero filling any gaps, and returns (md5, sha256)"""
+        for offset in sorted(self.pending.keys()):
+            self.hash_zeros(offset - self.position)
+            self.hash(self.pending.pop(offset))
+        self.hash_zeros(size - self.position)
+
+        return self.md5.hexdigest(), self.sha256.hexdigest()
+
+    def hash(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.position += len(data)
+
+    def hash_zeros(self, length):
+        while length > 0:
+            chunk = min(length, 1024 * 1024)
+            self.hash('\x00' * chunk)
+            length -= chunk
+
+
+class ImageFile():
+    """Seekable read only file-like object over a file within an image, using pytsk3 read_random"""
+    def __init__(self, fileobject):
+        self.fileobject = fileobject
+        self.size = fileobject.info.meta.size
+        self.offset = 0
+
+    def read(self, size=-1):
+        if size < 0 or self.offset + size > self.size:
+            size = self.size - self.offset
+        if size <= 0:
+            return ''
+
+        data = self.fileobject.read_random(self.offset, size)
+        self.offset += len(data)
+        return data
+
+    def readlines(self):
+        return self.read().splitlines(True)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += self.size
+        self.offset = max(offset, 0)
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        pass
+
+
+class MappedFile():
+    """Read only file-like object over a memory mapped file extracted from the image.
+    A full read returns the map itself, so python-registry parses a spilled hive in
+    place and its pages can be dropped by the OS, rather than reading a copy into
+    memory. Pickles as the file name so that a worker process maps the file itself"""
+    def __init__(self, file_name):
+        self.name = file_name
+        with open(file_name, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getstate__(self):
+        return self.name
+
+    def __setstate__(self, file_name):
+        self.__init__(file_name)
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.data
+        return self.data.read(size)
+
+    def readlines(self):
+        return list(iter(self.data.readline, ''))
+
+    def close(self):
+        self.data.close()
 
 
 # System Hive Methods #########################################################
 
-def process(image_path, output, format):
-    """Processing entry point"""
-    """Added code to open image and provide object into filesystem where Windows is found"""
-    imagehandle = pytsk3.Img_Info(url=image_path)
-    partitionTable = pytsk3.Volume_Info(imagehandle)
-    for partition in partitionTable:
-      print partition.addr, partition.desc, "%ss(%s)" % (partition.start, partition.start * 512), partition.len
-      try:
-            filesystemObject = pytsk3.FS_Info(imagehandle, offset=(partition.start*512))
-      except:
-              print "Partition has no supported file system"
-              continue
-      print "File System Type Detected .",filesystemObject.info.ftype,"."
-      if (str(filesystemObject.info.ftype) == "TSK_FS_TYPE_NTFS_DETECT"):
-        print "NTFS DETECTED"
-        # Process the hives in a specific order so that the
-        # data can be correctly matched between the hives
+def process(image_paths, output, format, workers=1):
+    """Processing entry point, every Windows partition of every image is processed
+    on its own and the results merged, tagged with the image and partition offset"""
+    global usb_devices, manifest
+
+    tasks = []
+    for image_path in image_paths:
+        for offset in get_windows_partitions(image_path):
+            tasks.append((image_path, offset))
+
+    if workers > 1 and len(tasks) > 1:
+        pool = get_worker_pool(min(workers, len(tasks)))
+        try:
+            results = pool.map(process_partition_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [process_partition_task(task) for task in tasks]
+
+    usb_devices = []
+    manifest = []
+    for devices, manifest_entries in results:
+        usb_devices.extend(devices)
+        manifest.extend(manifest_entries)
+
+    output_data_to_console()
+
+    if output is None:
+        return
+
+    if format == "csv":
+        output_data_to_file_csv(output)
+    else:
+        output_data_to_file_text(output)
+
+
+def open_image(image_path):
+    """Opens an image through the block cache"""
+    return CachedImgInfo(open_image_backend(image_path), cache_size, read_ahead, prefetch_mode)
+
+
+def open_image_backend(image_path):
+    """Opens the image using the backend for its type, detected from the extension unless set"""
+    type = image_type
+    if type == 'auto':
+        type = get_image_type(image_path)
+
+    write_debug(data='Image: ' + image_path + ' Type: ' + type)
+
+    if type == 'ewf':
+        if pyewf is None:
+            raise Exception('pyewf is required to read EWF images: ' + image_path)
+        return EwfImage(image_path)
+    elif type == 'split':
+        return SplitRawImage(get_split_raw_segments(image_path))
+    elif type == 'mmap':
+        return MmapRawImage(image_path)
+    else:
+        return RawImage(image_path)
+
+
+def get_image_type(image_path):
+    """Identifies the image type from the extension of the first segment"""
+    extension = os.path.splitext(image_path)[1].lower()
+    if extension in EWF_EXTENSIONS:
+        return 'ewf'
+
+    if extension in SPLIT_RAW_EXTENSIONS and len(get_split_raw_segments(image_path)) > 1:
+        return 'split'
+
+    return 'raw'
+
+
+def get_split_raw_segments(image_path):
+    """Returns the segments of a split raw image in order, the numbering of the
+    extension (.001, .002 or .aa, .ab) is continued until a segment is missing"""
+    base, extension = os.path.splitext(image_path)
+    extension = extension[1:]
+
+    segments = []
+    directory = os.path.dirname(base) or '.'
+    for file_name in os.listdir(directory):
+        name, suffix = os.path.splitext(file_name)
+        if name != os.path.basename(base):
+            continue
+        candidate = os.path.join(os.path.dirname(base), file_name)
+        suffix = suffix[1:]
+        if len(suffix) != len(extension):
+            continue
+        if extension.isdigit() != suffix.isdigit() or extension.isalpha() != suffix.isalpha():
+            continue
+        segments.append((suffix.lower(), candidate))
+
+    segments.sort()
+
+    # Only keep the consecutive segments starting from the one supplied
+    paths = []
+    expected = extension.lower()
+    for suffix, candidate in segments:
+        if suffix < expected:
+            continue
+        if suffix != expected:
+            break
+        paths.append(candidate)
+        expected = get_next_segment_suffix(expected)
+
+    if len(paths) == 0:
+        paths.append(image_path)
+
+    return paths
+
+
+def get_next_segment_suffix(suffix):
+    """Returns the suffix of the following segment e.g. 001 -> 002, aa -> ab"""
+    if suffix.isdigit():
+        return str(int(suffix) + 1).zfill(len(suffix))
+
+    characters = list(suffix)
+    index = len(characters) - 1
+    while index >= 0:
+        if characters[index] != 'z':
+            characters[index] = chr(ord(characters[index]) + 1)
+            return ''.join(characters)
+        characters[index] = 'a'
+        index -= 1
+
+    return 'a' + ''.join(characters)
+
+
+def get_windows_partitions(image_path):
+    """Returns the byte offsets of the NTFS partitions that contain a Windows directory"""
+    imagehandle = open_image(image_path)
+
+    offsets = []
+    try:
+        partitionTable = pytsk3.Volume_Info(imagehandle)
+        for partition in partitionTable:
+            print('%s %s %ss(%s) %s' % (partition.addr, partition.desc, partition.start, partition.start * 512, partition.len))
+            offsets.append(partition.start * 512)
+    except IOError:
+        # No partition table so the image is a single volume
+        print('No partition table, treating the image as a single volume')
+        offsets.append(0)
+
+    windows_offsets = []
+    for offset in offsets:
+        try:
+            filesystemObject = pytsk3.FS_Info(imagehandle, offset=offset)
+        except IOError:
+            print('Partition has no supported file system')
+            continue
+
+        print('File System Type Detected: ' + str(filesystemObject.info.ftype))
+        if str(filesystemObject.info.ftype) != "TSK_FS_TYPE_NTFS_DETECT":
+            continue
+
         try:
             filesystemObject.open("/Windows")
-        except:
-            print "No Windows directory, skipping"
+        except IOError:
+            print('No Windows directory, skipping')
             continue
+
+        windows_offsets.append(offset)
+
+    imagehandle.close()
+    return windows_offsets
+
+
+def process_partition_task(task):
+    """Worker entry point, takes an (image path, partition offset) tuple"""
+    return process_partition(task[0], task[1])
+
+
+def process_partition(image_path, offset):
+    """Extracts the USB devices from a single Windows partition, returning them
+    tagged with the image and partition offset, along with the manifest entries of
+    the files that were analysed"""
+    global usb_devices, os_version, artifact_index, image_handle, manifest, current_image, current_offset, current_snapshot
+
+    # Each partition has its own device store, as the matching between
+    # the hives must only use the devices from that Windows installation
+    usb_devices = []
+    os_version = WindowsVersions.NotDefined
+    artifact_index = None
+    manifest = []
+    current_image = image_path
+    current_offset = offset
+    current_snapshot = ''
+
+    print('Processing image: ' + image_path + ' partition offset: ' + str(offset))
+
+    snapshot_devices = []
+    imagehandle = open_image(image_path)
+    image_handle = imagehandle
+    try:
+        filesystemObject = pytsk3.FS_Info(imagehandle, offset=offset)
+        process_filesystem(filesystemObject)
+
+        if carve_mode is True:
+            carve_unallocated(filesystemObject, image_path)
+
+        if shadow_mode is True:
+            snapshot_devices = process_shadow_copies(imagehandle, offset)
+
+        print('Image block cache hits: %d misses: %d reads: %d' % (imagehandle.hits, imagehandle.misses, imagehandle.reads))
+    except Exception as err:
+        traceback.print_exc(file=sys.stdout)
+        print(err.args)
+    finally:
+        image_handle = None
+        imagehandle.close()
+        remove_temp_directory()
+
+    devices = usb_devices + snapshot_devices
+    for device in devices:
+        device.image = image_path
+        device.partition_offset = offset
+
+    return (devices, manifest)
+
+
+def process_filesystem(filesystemObject):
+    """Runs the USB extraction against the hives and logs of a file system"""
+    global artifact_index
+
+    if discover_mode is True:
+        artifact_index = build_artifact_index(filesystemObject)
+        if artifact_index is not None:
+            output_artifact_index()
+
     # Process the hives in a specific order so that the
     # data can be correctly matched between the hives
     process_system_registry_hive(filesystemObject, Registry.HiveType.SYSTEM)
     process_system_registry_hive(filesystemObject, Registry.HiveType.SOFTWARE)
     process_user_registry_hive(filesystemObject, Registry.HiveType.NTUSER)
 
-    # Loop through the files looking for the *.log files
     process_log_file(filesystemObject)
 
-    output_data_to_console()
 
-    if output is None:
-        return
+def process_shadow_copies(imagehandle, offset):
+    """Runs the USB extraction against each volume shadow copy of the partition, returning
+    the device state of every snapshot tagged with the snapshot it came from. The snapshots
+    are read through the block cache of the partition's image, so the blocks they share
+    with the live volume are only read from the image once"""
+    global usb_devices, os_version, artifact_index, image_handle, current_snapshot
 
-    if format == "csv":
-        output_data_to_file_csv(output)
-    else:
-        output_data_to_file_text(output)
-        
-def extract_file_from_image(filesystemObject, file_path, file_name):
+    if pyvshadow is None:
+        print('pyvshadow is required to process the volume shadow copies')
+        return []
+
+    volume = pyvshadow.volume()
+    try:
+        volume.open_file_object(VolumeFileObject(imagehandle, offset))
+    except (IOError, OSError):
+        print('No volume shadow copies found')
+        return []
+
+    live_devices = usb_devices
+    live_os_version = os_version
+    devices = []
+    try:
+        for index in range(volume.get_number_of_stores()):
+            store = volume.get_store(index)
+            snapshot = get_snapshot_name(index, store)
+            print('Processing volume shadow copy: ' + snapshot)
+
+            # Each snapshot is a separate device state, so start from an empty device store
+            usb_devices = []
+            os_version = WindowsVersions.NotDefined
+            artifact_index = None
+            current_snapshot = snapshot
+
+            storehandle = ShadowStoreImgInfo(store)
+            image_handle = storehandle
+            try:
+                process_filesystem(pytsk3.FS_Info(storehandle))
+            except Exception as err:
+                traceback.print_exc(file=sys.stdout)
+                print(err.args)
+            finally:
+                storehandle.close()
+                remove_temp_directory()
+
+            for device in usb_devices:
+                device.snapshot = snapshot
+            devices.extend(usb_devices)
+    finally:
+        volume.close()
+        imagehandle.unpin()
+        usb_devices = live_devices
+        os_version = live_os_version
+        image_handle = imagehandle
+        current_snapshot = ''
+
+    return devices
+
+
+def get_snapshot_name(index, store):
+    """Returns the name used to tag the devices from a shadow copy e.g. VSS1 (2015-03-01T10:00:00)"""
+    name = 'VSS' + str(index + 1)
+    try:
+        name += ' (' + store.get_creation_time().strftime('%Y-%m-%dT%H:%M:%S') + ')'
+    except Exception:
+        pass
+
+    return name
+
+
+def extract_file_from_image(filesystemObject, file_path, file_name, inode=None):
     """Method to extract a specific file from an image, takes three parameters.
     pytsk3 The opened filesystem object, the full path to the file and
-    the name you want to give the file when its written out"""
+    the name you want to give the file when its written out. If the inode
+    (MFT record number) is supplied the file is opened by it rather than the path"""
     
-    fileobject = filesystemObject.open(file_path)
+    fileobject = open_fileobject(filesystemObject, file_path, inode)
+    size = fileobject.info.meta.size
+
+    runs = None
+    if image_handle is not None:
+        runs = get_data_runs(filesystemObject, fileobject)
+
+    if runs is not None:
+        # Write each run at its logical offset as it comes off the coalesced reads,
+        # so only one read (COALESCE_MAX) is held in memory at a time
+        hasher = ArtifactHasher()
+        extractFile = open(file_name, 'wb')
+        for index, logical_offset, chunk in read_coalesced_runs(get_file_runs([runs], [size])):
+            extractFile.seek(logical_offset)
+            extractFile.write(chunk)
+            hasher.update(logical_offset, chunk)
+        extractFile.truncate(size)
+        extractFile.close()
+
+        if manifest_mode is True:
+            add_to_manifest(file_path, fileobject, hasher.finish(size))
+        return
+
     BUFF_SIZE = 1024 * 1024
     offset=0
+    hasher = ArtifactHasher()
     extractFile = open(file_name,'wb')
     while offset < fileobject.info.meta.size:
         available_to_read = min(BUFF_SIZE, fileobject.info.meta.size - offset)
         filedata = fileobject.read_random(offset,available_to_read)
+        hasher.update(offset, filedata)
         offset += len(filedata)
         extractFile.write(filedata)
-    extractFile.close
+    extractFile.close()
+
+    if manifest_mode is True:
+        add_to_manifest(file_path, fileobject, hasher.finish(offset))
+
+
+def open_fileobject(filesystemObject, file_path, inode=None):
+    """Opens a pytsk3 file by inode if supplied, otherwise by path"""
+    if inode is not None:
+        return filesystemObject.open_meta(inode=inode)
+
+    return filesystemObject.open(file_path)
+
+
+def open_file_from_image(filesystemObject, file_path, inode=None):
+    """Returns a file-like object for a file within the image. Files up to the spill
+    threshold are read straight from the image, larger files are extracted to a
+    private temporary directory and memory mapped. The caller closes the file"""
+    global temp_directory
+
+    fileobject = open_fileobject(filesystemObject, file_path, inode)
+    if fileobject.info.meta.size <= spill_threshold:
+        data = read_file_from_image(filesystemObject, fileobject)
+        if manifest_mode is True:
+            add_to_manifest(file_path, fileobject, get_hashes(data))
+        return io.BytesIO(data)
+
+    if temp_directory is None:
+        temp_directory = tempfile.mkdtemp(prefix='usbdeviceforensics')
+
+    # The path within the image keeps the names unique e.g. each users NTUSER.DAT
+    file_name = os.path.join(temp_directory, file_path.strip('/').replace('/', '_'))
+    extract_file_from_image(filesystemObject, file_path, file_name, inode)
+    return MappedFile(file_name)
+
+
+def get_data_runs(filesystemObject, fileobject):
+    """Returns the (logical offset, image offset, length) byte runs of the unnamed $DATA
+    attribute, or None when the data cannot be read by run (resident, compressed or
+    encrypted). Sparse runs are omitted as they read as zeros"""
+    block_size = filesystemObject.info.block_size
+    for attribute in fileobject:
+        if attribute.info.type != pytsk3.TSK_FS_ATTR_TYPE_NTFS_DATA or attribute.info.name:
+            continue
+
+        if int(attribute.info.flags) & (int(pytsk3.TSK_FS_ATTR_RES) | int(pytsk3.TSK_FS_ATTR_COMP) | int(pytsk3.TSK_FS_ATTR_ENC)):
+            return None
+
+        runs = []
+        for run in attribute:
+            if int(run.flags) & (int(pytsk3.TSK_FS_ATTR_RUN_FLAG_SPARSE) | int(pytsk3.TSK_FS_ATTR_RUN_FLAG_FILLER)):
+                continue
+            runs.append((run.offset * block_size,
+                         filesystemObject.info.offset + run.addr * block_size,
+                         run.len * block_size))
+        return runs
+
+    return None
+
+
+def read_coalesced_runs(runs):
+    """Takes (image offset, length, file index, logical offset) runs and yields
+    (file index, logical offset, data) for each of them. The runs are sorted by image
+    offset and coalesced, bridging small gaps, into large sequential reads which
+    bypass the block cache. When the shadow copies are to be processed, the live
+    volume reads go through the cache instead and are pinned, so the snapshots
+    read the blocks they share with the live volume from memory"""
+    # Runs longer than the maximum read size are split, so no single read is larger than it
+    pieces = []
+    for image_offset, length, index, logical_offset in runs:
+        for start in range(0, length, COALESCE_MAX):
+            pieces.append((image_offset + start, min(COALESCE_MAX, length - start), index, logical_offset + start))
+    runs = sorted(pieces)
+
+    position = 0
+    while position < len(runs):
+        start = runs[position][0]
+        end = start + runs[position][1]
+        last = position + 1
+        while (last < len(runs) and runs[last][0] - end <= COALESCE_GAP and
+               runs[last][0] + runs[last][1] - start <= COALESCE_MAX):
+            end = max(end, runs[last][0] + runs[last][1])
+            last += 1
+
+        if shadow_mode is True and isinstance(image_handle, CachedImgInfo):
+            data = image_handle.read_pinned(start, end - start)
+        else:
+            data = image_handle.read_direct(start, end - start)
+        for image_offset, length, index, logical_offset in runs[position:last]:
+            yield (index, logical_offset, data[image_offset - start:image_offset - start + length])
+
+        position = last
+
+
+def get_file_runs(runs_per_file, sizes):
+    """Flattens the data runs of a number of files into (image offset, length, file index,
+    logical offset), trimming the last run of each file, which is rounded up to a whole
+    cluster, to the file size"""
+    runs = []
+    for index in range(len(runs_per_file)):
+        for logical_offset, image_offset, length in runs_per_file[index]:
+            length = min(length, sizes[index] - logical_offset)
+            if length > 0:
+                runs.append((image_offset, length, index, logical_offset))
+
+    return runs
+
+
+def read_files_by_runs(runs_per_file, sizes):
+    """Reads a number of files from the image at once in image offset order, returning the data of each file"""
+    buffers = [bytearray(size) for size in sizes]
+    for index, logical_offset, chunk in read_coalesced_runs(get_file_runs(runs_per_file, sizes)):
+        buffers[index][logical_offset:logical_offset + len(chunk)] = chunk
+
+    return [str(buffer) for buffer in buffers]
+
+
+def read_file_from_image(filesystemObject, fileobject):
+    """Returns the data of a file, read by its data runs when possible"""
+    size = fileobject.info.meta.size
+    if image_handle is not None:
+        runs = get_data_runs(filesystemObject, fileobject)
+        if runs is not None:
+            return read_files_by_runs([runs], [size])[0]
+
+    return ImageFile(fileobject).read()
+
+
+def remove_temp_directory():
+    """Deletes the files extracted to the private temporary directory"""
+    global temp_directory
+
+    if temp_directory is not None:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        temp_directory = None
         
 def process_system_registry_hive(filesystemObject, hive_type):
     """Generic method used to process a single registry hive type"""
     
     if hive_type == Registry.HiveType.SYSTEM:
-        extract_file_from_image(filesystemObject, "/Windows/System32/Config/SYSTEM","SYSTEM")
-        registry = Registry.Registry("SYSTEM")
-        process_usb_stor(registry)
-        process_usb_stor_properties(registry)
-        process_usb(registry)
-        process_mounted_devices(registry)
-        process_device_classes(registry)
+        f = open_file_from_image(filesystemObject, "/Windows/System32/Config/SYSTEM")
+        try:
+            registry = Registry.Registry(f)
+            process_usb_stor(registry)
+            process_usb_stor_properties(registry)
+            process_usb(registry)
+            process_mounted_devices(registry)
+            process_device_classes(registry)
+        finally:
+            f.close()
 
     if hive_type == Registry.HiveType.SOFTWARE:
-        extract_file_from_image(filesystemObject, "/Windows/System32/Config/SOFTWARE","SOFTWARE")
-        registry = Registry.Registry("SOFTWARE")
-        get_os_version(registry)
-        process_windows_portable_devices(registry)
-        process_emd_mgmt(registry)
+        f = open_file_from_image(filesystemObject, "/Windows/System32/Config/SOFTWARE")
+        try:
+            registry = Registry.Registry(f)
+            get_os_version(registry)
+            process_windows_portable_devices(registry)
+            process_emd_mgmt(registry)
+        finally:
+            f.close()
 
 def process_user_registry_hive(filesystemObject, hive_type):
-    if hive_type == Registry.HiveType.NTUSER:
-        directoryObject = filesystemObject.open_dir(path="/Users")
-        parentPath="/Users/"
+    """Processes the NTUSER.DAT hive of every user profile. The hives are read from
+    the image by a single thread (pytsk3 objects are not thread safe) and parsed in
+    a pool of worker processes, so the reads overlap with the parsing, and each
+    worker returns compact MountPoints2 tuples"""
+    if hive_type != Registry.HiveType.NTUSER:
+        return
+
+    user_hives = get_user_hives(filesystemObject)
+
+    # Worker processes cannot start their own pool, so parse inline when the
+    # partitions themselves are being processed in parallel
+    if user_workers > 1 and len(user_hives) > 1 and not multiprocessing.current_process().daemon:
+        pool = get_worker_pool(min(user_workers, len(user_hives)))
+        try:
+            results = pool.imap(parse_mountpoints2_task, read_user_hives(filesystemObject, user_hives))
+            merge_mountpoints2(results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        merge_mountpoints2(parse_mountpoints2_task(task) for task in read_user_hives(filesystemObject, user_hives))
+
+
+def get_user_hives(filesystemObject):
+    """Returns (username, path, inode) for the NTUSER.DAT of each profile, Vista+ and XP,
+    using the artifact index when available.
+    UsrClass.dat is not included as it does not hold the MountPoints2 key"""
+    user_hives = []
+    if artifact_index is not None:
+        for entry in get_artifacts(['ntuser.dat']):
+            # The profile name is the parent directory of the hive
+            user_hives.append((entry.path.split('/')[-2], entry.path, entry.record))
+        return user_hives
+
+    for profile_path in ["/Users", "/Documents and Settings"]:
+        try:
+            directoryObject = filesystemObject.open_dir(path=profile_path)
+        except IOError:
+            continue
+
         for entryObject in directoryObject:
-            if entryObject.info.name.name in [".", ".."]:
-              continue
-            #print entryObject.info.name.name
+            name = entryObject.info.name.name
+            if name in [".", ".."]:
+                continue
+            if entryObject.info.name.type != pytsk3.TSK_FS_NAME_TYPE_DIR:
+                continue
+
+            filepath = profile_path + "/" + name + "/NTUSER.DAT"
             try:
-              f_type = entryObject.info.name.type
-              size = entryObject.info.meta.size
-            except Exception as error:
-                print "Cannot retrieve type or size of",entryObject.info.name.name
-                print error.message
+                filesystemObject.open(filepath)
+            except IOError:
+                write_debug(data='No NTUSER.DAT: ' + filepath)
                 continue
-              
+
+            user_hives.append((name, filepath, None))
+
+    return user_hives
+
+
+def read_user_hives(filesystemObject, user_hives):
+    """Yields (username, path, hive data) for each user hive, read from the image. The
+    hives are read in batches so that their data runs can be read in image order.
+    Hives over the spill threshold are yielded as a closed MappedFile, which the
+    parser maps again, rather than being read into memory"""
+    for batch_start in range(0, len(user_hives), USER_HIVE_BATCH):
+        batch = []
+        runs_per_file = []
+        sizes = []
+        for username, filepath, inode in user_hives[batch_start:batch_start + USER_HIVE_BATCH]:
+            print('Reading user hive: ' + filepath)
             try:
-      
-              filepath = parentPath + entryObject.info.name.name
-              outputPath = parentPath
-      
-              if f_type == pytsk3.TSK_FS_NAME_TYPE_DIR:
-                  sub_directory = entryObject.as_directory()
-                  print "Entering Directory: %s" % filepath
-                  #parentPath.append(entryObject.info.name.name)
-                  #directoryRecurse(sub_directory,parentPath)
-                  #parentPath.pop(-1)
-                  print "Leaving Directory: %s" % filepath
-                  extract_file_from_image(filesystemObject, filepath+"/NTUSER.DAT" ,entryObject.info.name.name+"NTUSER")                   
-                  registry = Registry.Registry(entryObject.info.name.name+"NTUSER")
-                  process_mountpoints2(registry, entryObject.info.name.name+"NTUSER", entryObject.info.name.name)              
-      
-              elif f_type == pytsk3.TSK_FS_NAME_TYPE_REG and entryObject.info.meta.size == 0:
-      
-                  continue
-      
-              else:
-                print "This went wrong",entryObject.info.name.name,f_type
-                
-            except IOError as e:
-              print e
-              continue
-            
-            
+                fileobject = open_fileobject(filesystemObject, filepath, inode)
+            except IOError as err:
+                print(err)
+                continue
+
+            runs = None
+            if image_handle is not None and fileobject.info.meta.size <= spill_threshold:
+                runs = get_data_runs(filesystemObject, fileobject)
+
+            if runs is None:
+                batch.append((username, filepath, inode, fileobject, None))
+            else:
+                batch.append((username, filepath, inode, fileobject, len(runs_per_file)))
+                runs_per_file.append(runs)
+                sizes.append(fileobject.info.meta.size)
+
+        batch_data = read_files_by_runs(runs_per_file, sizes)
+
+        for username, filepath, inode, fileobject, index in batch:
+            if index is not None:
+                if manifest_mode is True:
+                    add_to_manifest(filepath, fileobject, get_hashes(batch_data[index]))
+                yield (username, filepath, batch_data[index])
+                continue
+
+            try:
+                f = open_file_from_image(filesystemObject, filepath, inode)
+                if isinstance(f, MappedFile):
+                    data = f
+                else:
+                    data = f.read()
+                f.close()
+            except IOError as err:
+                print(err)
+                continue
+
+            yield (username, filepath, data)
 
 
 def output_data_to_console():
     """Outputs the data to StdOut and an output file if required"""
     for device in usb_devices:
+        print("Image: " + device.image)
+        print("Partition Offset: " + str(device.partition_offset))
+        print("Snapshot: " + device.snapshot)
+        print("Source: " + device.source)
         print("Vendor: " + device.vendor)
         print("Product: " + device.product)
         print("Version: " + device.version)
@@ -281,7 +1321,7 @@ def output_data_to_file_csv(output):
 
     with open(output, "wb") as f:
         # Write the CSV headers
-        f.write("Vendor\tProduct\tVersion\tSerialNumber\tVID\tPID\tParentIDPrefix\tVolumeName\tGUID\tMountPoint\tInstall\tUSBSTOR\tUSBSTOR Properties (Install Date)\tUSBSTOR Properties (First Install Date)\tUSBSTOR Properties (Last Arrival Date)\tUSBSTOR Properties (Last Removal Date)\tDeviceClasses (53f56307-b6bf-11d0-94f2-00a0c91efb8b)\tDeviceClasses (10497b1b-ba51-44e5-8318-a65c837b6661)\tEnum\\USB VIDPID\t")
+        f.write("Image\tPartitionOffset\tSnapshot\tSource\tVendor\tProduct\tVersion\tSerialNumber\tVID\tPID\tParentIDPrefix\tVolumeName\tGUID\tMountPoint\tInstall\tUSBSTOR\tUSBSTOR Properties (Install Date)\tUSBSTOR Properties (First Install Date)\tUSBSTOR Properties (Last Arrival Date)\tUSBSTOR Properties (Last Removal Date)\tDeviceClasses (53f56307-b6bf-11d0-94f2-00a0c91efb8b)\tDeviceClasses (10497b1b-ba51-44e5-8318-a65c837b6661)\tEnum\\USB VIDPID\t")
 
         temp = ''
         for i in range(numMp2):
@@ -313,6 +1353,10 @@ def output_data_to_file_csv(output):
         writer = csv.writer(f, delimiter='\t', quotechar='"', quoting=csv.QUOTE_ALL)
         for device in usb_devices:
             data = []
+            data.append(device.image)
+            data.append(device.partition_offset)
+            data.append(device.snapshot)
+            data.append(device.source)
             data.append(device.vendor)
             data.append(device.product)
             data.append(device.version)
@@ -376,6 +1420,10 @@ def output_data_to_file_text(output):
 
     with open(output, "wb") as f:
         for device in usb_devices:
+            f.write("Image: " + device.image + '\n')
+            f.write("Partition Offset: " + str(device.partition_offset) + '\n')
+            f.write("Snapshot: " + device.snapshot + '\n')
+            f.write("Source: " + device.source + '\n')
             f.write("Vendor: " + device.vendor + '\n')
             f.write("Product: " + device.product + '\n')
             f.write("Version: " + device.version + '\n')
@@ -882,53 +1930,88 @@ def process_emd_mgmt(registry):
 
 ##### NTUSER Hive Methods ############################################################################################
 
-def process_mountpoints2(registry, reg_file_path, username):
-    """Processes the Software\Microsoft\Windows\CurrentVersion\Explorer\MountPoints2 key"""
+def parse_mountpoints2_task(task):
+    """Worker entry point, takes a (username, path, hive data or MappedFile) tuple and
+    returns (username, [(MountPoints2 sub key name, timestamp)])"""
+    username, filepath, data = task
+    entries = []
     try:
-        key = registry.open('Software\\Microsoft\\Windows\\CurrentVersion\\Explorer\\MountPoints2')
+        if isinstance(data, MappedFile):
+            hive = MappedFile(data.name)
+        else:
+            hive = io.BytesIO(data)
+        try:
+            registry = Registry.Registry(hive)
+            key = registry.open('Software\\Microsoft\\Windows\\CurrentVersion\\Explorer\\MountPoints2')
+            for sub_key in key.subkeys():
+                if sub_key.name().startswith('{'):
+                    entries.append((sub_key.name(), sub_key.timestamp()))
+        finally:
+            hive.close()
+    except Registry.RegistryKeyNotFoundException:
+        pass
+    except Exception as err:
+        print('Unable to parse user hive: ' + filepath)
+        print(err.args)
 
-        global usb_devices
+    return (username, entries)
 
-        for usb_device in usb_devices:
-            # If there is no GUID then we cannot match so just continue
-            if len(usb_device.guid) == 0:
-                continue
 
-            for sub_key in key.subkeys():
-                if '{' + usb_device.guid + '}' != sub_key.name():
-                    continue
+def merge_mountpoints2(results):
+    """Merges the MountPoints2 tuples for each user into the devices, matched on the volume GUID"""
+    global usb_devices
+
+    devices_by_guid = {}
+    for usb_device in usb_devices:
+        # If there is no GUID then we cannot match
+        if len(usb_device.guid) == 0:
+            continue
+        devices_by_guid.setdefault('{' + usb_device.guid + '}', []).append(usb_device)
 
+    for username, entries in results:
+        for name, timestamp in entries:
+            for usb_device in devices_by_guid.get(name, []):
                 mp2 = MountPoint2()
                 mp2.file = username
-                mp2.timestamp = sub_key.timestamp()
+                mp2.timestamp = timestamp
                 usb_device.mountpoint2.append(mp2)
 
                 write_debug(name='Mountpoint2 file', value=mp2.file)
                 write_debug(name='Mountpoint2 date/time', value=mp2.timestamp.strftime('%Y-%m-%dT%H:%M:%S'))
 
-    except Registry.RegistryKeyNotFoundException:
-        return
-
 
 # Log File Methods ############################################################
 
 def process_log_file(filesystemObject):
-    """This function has been modified to extract the right log file based on the OS version"""
+    """This function has been modified to extract the right log file based on the OS version.
+    When an artifact index is available every setupapi log it found is processed"""
+    if artifact_index is not None:
+        for entry in get_artifacts(['setupapi.log', 'setupapi.dev.log'], 'setupapi.dev.'):
+            print('Processing log file: ' + entry.path)
+            f = open_file_from_image(filesystemObject, entry.path, entry.record)
+            process_log_lines(f.readlines())
+            f.close()
+        return
+
+    if os == WindowsVersions.WindowsXP or os == WindowsVersions.WindowsXPx64:
+        f = open_file_from_image(filesystemObject, "/Windows/setupapi.log")
+    else:
+        f = open_file_from_image(filesystemObject, "/Windows/Inf/Setupapi.dev.log")
+
+    lines = f.readlines()
+    f.close()
+
+    process_log_lines(lines)
+
+
+def process_log_lines(lines):
+    """Parses the lines of a setupapi log and updates the install date/time of the devices"""
     regexXp1 = '^\[([0-9]+/[0-9]+/[0-9]+\s[0-9]+:[0-9]+:[0-9]+)\s[0-9]+.[0-9]+\sDriver\sInstall\]'
     regexXp2 = '#-019 .*? ID\(s\): usb\\(.+)'
     regexXp3 = '#I121.*? "(.*)"'
     regexVista1 = '>>> *\[Device Install \(Hardware initiated\) - USBSTOR\\(.+)\]'
     regexVista2 = '>>>\s\sSection\sstart\s([0-9]+/[0-9]+/[0-9]+\s[0-9]+:[0-9]+:[0-9]+\.[0-9]+)'
     regexWin78 = '>>>\s\s\[Device\sInstall\s\(Hardware\sinitiated\) - SWD\\WPDBUSENUM\\_\?\?_USBSTOR#(.*)\]'
-    if os == WindowsVersions.WindowsXP or os == WindowsVersions.WindowsXPx64:
-        extract_file_from_image(filesystemObject, "/Windows/setupapi.log", "setupapi.log")
-    else:
-        extract_file_from_image(filesystemObject, "/Windows/Inf/Setupapi.dev.log", "setupapi.log")
-        
-        
-    with open("setupapi.log") as f:
-        lines = f.readlines()
-    f.close()
 
     install_times = {}
     index = 0
@@ -1023,10 +2106,10 @@ def process_log_file(filesystemObject):
         for device in usb_devices:
             if os == WindowsVersions.WindowsXP or os == WindowsVersions.WindowsXPx64:
                 if (device.vid.lower() + '&' + device.pid.lower() + "\\" + device.serial_number.lower()) in key.lower():
-                    device.install_datetime = datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S.%f")
+                    set_install_datetime(device, timestamp)
                 elif (device.vendor.lower() + "&" + device.product.lower() + "&" + device.version.lower() + "\\" + device.serial_number.lower()) in key.lower():
                     #I121 "USBSTOR\DISK&VEN_USB_2.0&PROD_&REV_1100\6&12202299&0
-                    device.install_datetime = datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S.%f")
+                    set_install_datetime(device, timestamp)
             else:
                 if len(device.mountpoint) == 0:
                     continue
@@ -1037,15 +2120,575 @@ def process_log_file(filesystemObject):
 
                     if temp.lower() in key.lower():
                         write_debug(data='Matched install log timestamp using mountpoint: ' + key.lower())
-                        device.install_datetime = datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S.%f")
+                        set_install_datetime(device, timestamp)
                     else:
                         write_debug(data='Unable to match install log timestamp using mountpoint: ' + key.lower())
                 else:
                     print('The mountpoint does not contain 4 delimited (#) parts: ' + device.mountpoint)
 
 
+def set_install_datetime(device, timestamp):
+    """Sets the install date/time of a device, keeping the earliest when several setupapi logs
+    (e.g. rotated logs found by --discover) record an install of the same device"""
+    install_datetime = datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S.%f")
+    if device.install_datetime == datetime.min or install_datetime < device.install_datetime:
+        device.install_datetime = install_datetime
+
+
+# Manifest Methods ############################################################
+
+def get_hashes(data):
+    """Returns the (md5, sha256) of data that has already been read from the image"""
+    return hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest()
+
+
+def add_to_manifest(file_path, fileobject, hashes):
+    """Records the provenance of a file analysed from the image. The hashes are computed
+    in the same pass that reads the file, so this costs no extra I/O"""
+    meta = fileobject.info.meta
+    manifest.append({'image': current_image,
+                     'partition_offset': current_offset,
+                     'snapshot': current_snapshot,
+                     'path': file_path,
+                     'inode': meta.addr,
+                     'size': meta.size,
+                     'md5': hashes[0],
+                     'sha256': hashes[1],
+                     'modified': meta.mtime,
+                     'accessed': meta.atime,
+                     'changed': meta.ctime,
+                     'created': meta.crtime})
+
+
+def output_manifest_to_file(output):
+    """Outputs the chain of custody manifest to a file in CSV format"""
+    write_debug(data='Method: output_manifest_to_file')
+
+    with open(output, 'wb') as f:
+        f.write('Image\tPartitionOffset\tSnapshot\tPath\tInode\tSize\tMD5\tSHA256\tModified\tAccessed\tChanged\tCreated\n')
+        writer = csv.writer(f, delimiter='\t', quotechar='"', quoting=csv.QUOTE_ALL)
+        for entry in manifest:
+            data = [entry['image'], entry['partition_offset'], entry['snapshot'], entry['path'], entry['inode'], entry['size'],
+                    entry['md5'], entry['sha256']]
+            for name in ['modified', 'accessed', 'changed', 'created']:
+                if entry[name] > 0:
+                    data.append(datetime.utcfromtimestamp(entry[name]).strftime('%Y-%m-%dT%H:%M:%S'))
+                else:
+                    data.append('')
+            writer.writerow(data)
+
+
+# MFT Discovery Methods #######################################################
+
+def build_artifact_index(filesystemObject):
+    """Parses the $MFT in one sequential pass and returns the entries whose names are
+    candidate artifacts (see ARTIFACT_NAMES), including deleted entries, keyed by
+    lower case name. No directories are traversed, so RegBack copies, Windows.old,
+    rotated setupapi logs and profiles in non-standard locations are all found"""
+    mft = ImageFile(filesystemObject.open_meta(inode=0))
+
+    header = mft.read(MFT_RECORD_HEADER_SIZE)
+    record_size = struct.unpack('<I', header[0x1C:0x20])[0]
+    if header[0:4] != 'FILE' or record_size == 0:
+        print('Unable to parse the $MFT record header')
+        return None
+    mft.seek(0)
+
+    names = {}
+    parents = {}
+    candidates = []
+    record = 0
+    while True:
+        data = mft.read(record_size * MFT_RECORDS_PER_READ)
+        if len(data) < record_size:
+            break
+
+        for offset in range(0, len(data) - record_size + 1, record_size):
+            entry = parse_mft_record(data[offset:offset + record_size], record)
+            record += 1
+            if entry is None:
+                continue
+
+            names[entry.record] = entry.name
+            parents[entry.record] = entry.parent
+            if entry.name.lower() in ARTIFACT_NAMES or is_rotated_setupapi_log(entry.name):
+                candidates.append(entry)
+
+    index = {}
+    for entry in candidates:
+        entry.path = get_mft_path(entry.record, names, parents)
+        index.setdefault(entry.name.lower(), []).append(entry)
+        write_debug(name='Artifact', value=entry.path + ' (record: ' + str(entry.record) +
+                    (', deleted' if not entry.in_use else '') + (', resident' if entry.resident else '') + ')')
+
+    return index
+
+
+def parse_mft_record(data, record):
+    """Parses a single MFT FILE record, returning an MftEntry or None if it is not a named base
+    record. Every offset and length is checked against the record before it is used, as
+    deleted and torn records hold partially overwritten attributes"""
+    if len(data) < MFT_RECORD_HEADER_SIZE or data[0:4] != 'FILE':
+        return None
+
+    data = apply_mft_fixups(data)
+    if data is None:
+        return None
+
+    attribute_offset = struct.unpack('<H', data[0x14:0x16])[0]
+    flags = struct.unpack('<H', data[0x16:0x18])[0]
+    used_size = struct.unpack('<I', data[0x18:0x1C])[0]
+    base_record = struct.unpack('<Q', data[0x20:0x28])[0]
+    if base_record != 0:
+        return None
+    if used_size > len(data) or attribute_offset < MFT_RECORD_HEADER_SIZE or attribute_offset >= used_size:
+        return None
+
+    entry = MftEntry()
+    entry.record = record
+    entry.in_use = (flags & 0x01) != 0
+    entry.is_directory = (flags & 0x02) != 0
+
+    name_namespace = -1
+    offset = attribute_offset
+    while offset + 16 <= used_size:
+        attribute_type, attribute_length = struct.unpack('<II', data[offset:offset + 8])
+        if attribute_type == 0xFFFFFFFF or attribute_length < 16 or offset + attribute_length > used_size:
+            break
+
+        non_resident = ord(data[offset + 8]) != 0
+        attribute_name_length = ord(data[offset + 9])
+        attribute_end = offset + attribute_length
+
+        if attribute_type == 0x30 and not non_resident:
+            # $FILE_NAME, prefer the Win32/POSIX name over the DOS 8.3 name
+            if offset + 0x18 > attribute_end:
+                return None
+            content_length = struct.unpack('<I', data[offset + 0x10:offset + 0x14])[0]
+            content_offset = offset + struct.unpack('<H', data[offset + 0x14:offset + 0x16])[0]
+            if content_offset + 0x42 > attribute_end or content_offset + content_length > attribute_end:
+                return None
+            namespace = ord(data[content_offset + 0x41])
+            if name_namespace == -1 or name_namespace == 2:
+                name_length = ord(data[content_offset + 0x40])
+                if content_offset + 0x42 + name_length * 2 > attribute_end:
+                    return None
+                entry.parent = struct.unpack('<Q', data[content_offset:content_offset + 8])[0] & 0xFFFFFFFFFFFF
+                entry.name = data[content_offset + 0x42:content_offset + 0x42 + name_length * 2].decode('utf-16-le', 'replace')
+                name_namespace = namespace
+
+        elif attribute_type == 0x80 and attribute_name_length == 0:
+            # The unnamed $DATA stream
+            if offset + (0x38 if non_resident else 0x14) > attribute_end:
+                return None
+            entry.resident = not non_resident
+            if non_resident:
+                entry.size = struct.unpack('<Q', data[offset + 0x30:offset + 0x38])[0]
+            else:
+                entry.size = struct.unpack('<I', data[offset + 0x10:offset + 0x14])[0]
+
+        offset += attribute_length
+
+    if name_namespace == -1:
+        return None
+
+    return entry
+
+
+def apply_mft_fixups(data):
+    """Replaces the update sequence numbers at the end of each sector with the original bytes"""
+    usa_offset, usa_count = struct.unpack('<HH', data[0x04:0x08])
+    if usa_count == 0 or usa_offset < 0x08 or usa_offset + usa_count * 2 > len(data):
+        return None
+
+    data = bytearray(data)
+    usn = data[usa_offset:usa_offset + 2]
+    for index in range(1, usa_count):
+        sector_end = index * 512
+        if sector_end > len(data):
+            break
+        if data[sector_end - 2:sector_end] != usn:
+            # Torn write, the record cannot be trusted
+            return None
+        data[sector_end - 2:sector_end] = data[usa_offset + index * 2:usa_offset + index * 2 + 2]
+
+    return str(data)
+
+
+def get_mft_path(record, names, parents):
+    """Builds the full path of an MFT entry from the parent references"""
+    parts = []
+    depth = 0
+    while record != MFT_ROOT_RECORD and depth < 256:
+        if record not in names:
+            parts.append('$OrphanFiles')
+            break
+        parts.append(names[record])
+        record = parents[record]
+        depth += 1
+
+    parts.reverse()
+    return '/' + '/'.join(parts)
+
+
+def is_rotated_setupapi_log(name):
+    """Determines if the name is a rotated setupapi log e.g. setupapi.dev.20150101_120000.log"""
+    name = name.lower()
+    return name.startswith('setupapi.dev.') and name.endswith('.log')
+
+
+def get_artifacts(names, prefix=None):
+    """Returns the allocated, non-directory entries from the artifact index with any
+    of the names, or starting with the prefix"""
+    entries = []
+    for name in artifact_index:
+        if name in names or (prefix is not None and name.startswith(prefix)):
+            for entry in artifact_index[name]:
+                if entry.in_use and not entry.is_directory:
+                    entries.append(entry)
+
+    return entries
+
+
+def output_artifact_index():
+    """Outputs the artifact index to StdOut"""
+    for name in sorted(artifact_index.keys()):
+        for entry in artifact_index[name]:
+            status = 'allocated' if entry.in_use else 'deleted'
+            if entry.resident:
+                status += ', resident'
+            print('Artifact: %s (record: %d, size: %d, %s)' % (entry.path, entry.record, entry.size, status))
+
+
+# Carving Methods #############################################################
+
+def carve_unallocated(filesystemObject, image_path):
+    """Carves regf/hbin pages and setupapi device install sections from the unallocated
+    clusters of the partition. The unallocated space is split into blocks which are
+    searched in parallel worker processes, then the hbin pages are reassembled into
+    hives and the recovered records are processed as devices marked as carved"""
+    ranges = get_unallocated_ranges(filesystemObject)
+    alignment = min(filesystemObject.info.block_size, REGF_HEADER_SIZE)
+    fs_offset = filesystemObject.info.offset
+
+    tasks = []
+    for start, length in ranges:
+        for block in range(start, start + length, CARVE_BLOCK_SIZE):
+            tasks.append((image_path, block, min(block + CARVE_BLOCK_SIZE, start + length), alignment, fs_offset))
+
+    print('Carving %d bytes of unallocated space in %d blocks' % (sum(length for start, length in ranges), len(tasks)))
+
+    if carve_workers > 1 and len(tasks) > 1 and not multiprocessing.current_process().daemon:
+        pool = get_worker_pool(min(carve_workers, len(tasks)))
+        try:
+            results = pool.map(carve_block_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [carve_block(image_handle.read_direct, task[1], task[2], task[3], task[4]) for task in tasks]
+
+    headers = []
+    hbins = []
+    sections = []
+    for block_headers, block_hbins, block_sections in results:
+        headers.extend(block_headers)
+        hbins.extend(block_hbins)
+        sections.extend(block_sections)
+
+    hives = assemble_carved_hives(headers, hbins)
+    print('Carved %d regf headers, %d hbin pages, %d hives, %d setupapi sections' % (len(headers), len(hbins), len(hives), len(sections)))
+
+    process_carved_artifacts(hives, sections)
+
+
+def get_unallocated_ranges(filesystemObject):
+    """Returns the (image offset, length) byte ranges of the unallocated clusters, read from the NTFS $Bitmap"""
+    bitmap = read_file_from_image(filesystemObject, filesystemObject.open_meta(inode=NTFS_BITMAP_RECORD))
+    block_size = filesystemObject.info.block_size
+    block_count = filesystemObject.info.block_count
+
+    # Runs of whole free bytes are added in one go, only the partially allocated bytes are walked bit by bit
+    clusters = []
+    for match in re.finditer('\x00+|[^\x00\xff]', bitmap):
+        if bitmap[match.start()] == '\x00':
+            add_cluster_range(clusters, match.start() * 8, (match.end() - match.start()) * 8)
+            continue
+
+        byte = ord(bitmap[match.start()])
+        for bit in range(8):
+            if byte & (1 << bit) == 0:
+                add_cluster_range(clusters, match.start() * 8 + bit, 1)
+
+    ranges = []
+    for cluster, count in clusters:
+        count = min(count, block_count - cluster)
+        if count > 0:
+            ranges.append((filesystemObject.info.offset + cluster * block_size, count * block_size))
+
+    return ranges
+
+
+def add_cluster_range(clusters, cluster, count):
+    """Adds a run of clusters to a list of (first cluster, count), extending the last run when contiguous"""
+    if len(clusters) > 0 and clusters[-1][0] + clusters[-1][1] == cluster:
+        clusters[-1] = (clusters[-1][0], clusters[-1][1] + count)
+    else:
+        clusters.append((cluster, count))
+
+
+def carve_block_task(task):
+    """Worker entry point, takes an (image path, start, end, alignment, partition offset)
+    tuple and returns the signatures carved from that block of the image"""
+    image_path, start, end, alignment, fs_offset = task
+    image = open_image_backend(image_path)
+    try:
+        return carve_block(image.read, start, end, alignment, fs_offset)
+    finally:
+        image.close()
+
+
+def carve_block(read, start, end, alignment, fs_offset):
+    """Searches a block of the image for regf headers, hbin pages and setupapi sections
+    starting within [start, end), the alignment being relative to the partition start (fs_offset), returning ([(offset, header)], [(offset, hbin offset,
+    data)], [(offset, text)])"""
+    buffer = read(start, end - start + CARVE_SECTION_MAX)
+
+    def get_data(offset, size):
+        if offset - start + size <= len(buffer):
+            return buffer[offset - start:offset - start + size]
+        return read(offset, size)
+
+    headers = []
+    for position in find_aligned(buffer, 'regf', start, end, alignment, fs_offset):
+        header = get_data(start + position, REGF_HEADER_SIZE)
+        if is_regf_header(header):
+            headers.append((start + position, header))
+
+    hbins = []
+    for position in find_aligned(buffer, 'hbin', start, end, alignment, fs_offset):
+        if position + HBIN_HEADER_SIZE > len(buffer):
+            continue
+        hbin_offset, size = struct.unpack('<II', buffer[position + 4:position + 12])
+        if hbin_offset % REGF_HEADER_SIZE != 0 or size % REGF_HEADER_SIZE != 0 or size == 0 or size > CARVE_HBIN_MAX:
+            continue
+        hbins.append((start + position, hbin_offset, get_data(start + position, size)))
+
+    sections = []
+    position = buffer.find('>>>  [Device Install')
+    while position != -1 and position < end - start:
+        sections.append((start + position, get_setupapi_section(buffer, position)))
+        position = buffer.find('>>>  [Device Install', position + 1)
+
+    return (headers, hbins, sections)
+
+
+def find_aligned(buffer, signature, start, end, alignment, fs_offset):
+    """Yields the positions in the buffer of a signature that is aligned within the partition,
+    as the clusters are aligned to the partition start (e.g. sector 63) rather than the image"""
+    position = buffer.find(signature)
+    while position != -1 and position < end - start:
+        if (start + position - fs_offset) % alignment == 0:
+            yield position
+        position = buffer.find(signature, position + 1)
+
+
+def is_regf_header(header):
+    """Validates a carved regf base block"""
+    if len(header) < REGF_HEADER_SIZE or header[0:4] != 'regf':
+        return False
+
+    major_version, minor_version = struct.unpack('<II', header[0x14:0x1C])
+    hbins_size = struct.unpack('<I', header[0x28:0x2C])[0]
+    return major_version == 1 and minor_version <= 6 and hbins_size % REGF_HEADER_SIZE == 0
+
+
+def get_setupapi_section(buffer, position):
+    """Returns a setupapi section from its start line to the end of its exit status line,
+    stopping at the first NUL as the rest of the cluster belongs to something else"""
+    end = buffer.find('<<<  [Exit status', position, position + CARVE_SECTION_MAX)
+    if end == -1:
+        end = min(position + CARVE_SECTION_MAX, len(buffer))
+    else:
+        line_end = buffer.find('\n', end, position + CARVE_SECTION_MAX)
+        end = len(buffer) if line_end == -1 else line_end + 1
+
+    nul = buffer.find('\x00', position, end)
+    if nul != -1:
+        end = nul
+
+    return buffer[position:end]
+
+
+def assemble_carved_hives(headers, hbins):
+    """Reassembles the carved hbin pages into hives, returns [(offset, hive data)]. Pages
+    following a regf header are chained while their hbin offsets are contiguous, the
+    remaining chains are kept when they contain the root key, with a base block built
+    for them and the missing leading pages zero filled"""
+    hbins_by_offset = {}
+    for offset, hbin_offset, data in hbins:
+        hbins_by_offset[offset] = (hbin_offset, data)
+
+    used = set()
+    hives = []
+    for offset, header in headers:
+        hbins_size = struct.unpack('<I', header[0x28:0x2C])[0]
+        data = get_hbin_chain(hbins_by_offset, offset + REGF_HEADER_SIZE, 0, hbins_size, used)
+        if len(data) == 0:
+            continue
+        hives.append((offset, set_regf_hbins_size(header, len(data)) + data))
+
+    for offset in sorted(hbins_by_offset.keys()):
+        hbin_offset, first_data = hbins_by_offset[offset]
+        if offset in used:
+            continue
+
+        data = get_hbin_chain(hbins_by_offset, offset, hbin_offset, None, used)
+        root_cell = find_root_cell(data, hbin_offset)
+        if root_cell is None:
+            continue
+
+        header = set_regf_hbins_size(build_regf_header(root_cell), hbin_offset + len(data))
+        hives.append((offset, header + '\x00' * hbin_offset + data))
+
+    return hives
+
+
+def get_hbin_chain(hbins_by_offset, offset, hbin_offset, hbins_size, used):
+    """Returns the data of the pages that follow on from each other in the image from the
+    page at offset, while the hbin offsets are contiguous"""
+    data = []
+    while offset in hbins_by_offset and offset not in used:
+        page_offset, page = hbins_by_offset[offset]
+        if page_offset != hbin_offset:
+            break
+        if hbins_size is not None and hbin_offset >= hbins_size:
+            break
+
+        data.append(page)
+        used.add(offset)
+        offset += len(page)
+        hbin_offset += len(page)
+
+    return ''.join(data)
+
+
+def find_root_cell(data, hbin_offset):
+    """Returns the hive offset of the root key cell (nk with the hive entry flag) within the pages"""
+    for cell_offset, cell in get_hbin_cells(data, hbin_offset):
+        if cell[4:6] == 'nk' and struct.unpack('<H', cell[6:8])[0] & 0x0004:
+            return cell_offset
+
+    return None
+
+
+def get_hbin_cells(data, hbin_offset):
+    """Yields (hive offset, cell data) for each allocated cell within consecutive hbin pages"""
+    page = 0
+    while page + HBIN_HEADER_SIZE <= len(data) and data[page:page + 4] == 'hbin':
+        page_size = struct.unpack('<I', data[page + 8:page + 12])[0]
+        if page_size == 0:
+            break
+
+        position = page + HBIN_HEADER_SIZE
+        while position + 4 <= min(page + page_size, len(data)):
+            size = struct.unpack('<i', data[position:position + 4])[0]
+            if size == 0:
+                break
+            if size < 0:
+                yield (hbin_offset + position, data[position:position - size])
+            position += abs(size)
+
+        page += page_size
+
+
+def build_regf_header(root_cell):
+    """Builds a regf base block for a reassembled hive"""
+    header = struct.pack('<4sIIQIIIIII', 'regf', 1, 1, 0, 1, 5, 0, 1, root_cell, 0)
+    return header + '\x00' * (REGF_HEADER_SIZE - len(header))
+
+
+def set_regf_hbins_size(header, hbins_size):
+    """Sets the hive bins data size of a base block and updates its checksum"""
+    header = header[:0x28] + struct.pack('<I', hbins_size) + header[0x2C:REGF_HEADER_SIZE]
+    checksum = 0
+    for value in struct.unpack('<127I', header[:0x1FC]):
+        checksum ^= value
+    return header[:0x1FC] + struct.pack('<I', checksum) + header[0x200:]
+
+
+def get_carved_hive_type(registry):
+    """Identifies the type of a carved hive from the keys below its root"""
+    names = [key.name().lower() for key in registry.root().subkeys()]
+    if 'select' in names or 'controlset001' in names:
+        return Registry.HiveType.SYSTEM
+    if 'control panel' in names or 'environment' in names:
+        return Registry.HiveType.NTUSER
+    if 'microsoft' in names:
+        return Registry.HiveType.SOFTWARE
+
+    return None
+
+
+def process_carved_artifacts(hives, sections):
+    """Processes the carved hives and setupapi sections through the normal stages. They
+    use their own device store, so the carved records do not alter the live devices, and
+    the devices are appended to the live devices marked as carved"""
+    global usb_devices
+
+    live_devices = usb_devices
+    usb_devices = []
+    try:
+        for offset, data in hives:
+            name = 'carved hive at offset ' + str(offset)
+            try:
+                registry = Registry.Registry(io.BytesIO(data))
+                hive_type = get_carved_hive_type(registry)
+                print('Processing ' + name + ' (' + str(hive_type) + ')')
+
+                if hive_type == Registry.HiveType.SYSTEM:
+                    process_usb_stor(registry)
+                    process_usb_stor_properties(registry)
+                    process_usb(registry)
+                    process_mounted_devices(registry)
+                    process_device_classes(registry)
+                elif hive_type == Registry.HiveType.SOFTWARE:
+                    process_windows_portable_devices(registry)
+                    process_emd_mgmt(registry)
+                elif hive_type == Registry.HiveType.NTUSER:
+                    merge_mountpoints2([parse_mountpoints2_task(('carved', name, data))])
+            except Exception as err:
+                print('Unable to parse ' + name)
+                print(err.args)
+
+        if len(sections) > 0:
+            # The first line is skipped as the header of a log file
+            lines = ['']
+            for offset, text in sections:
+                lines.extend(text.splitlines())
+            process_log_lines(lines)
+    finally:
+        carved_devices = usb_devices
+        usb_devices = live_devices
+
+    for device in carved_devices:
+        device.source = 'carved'
+    usb_devices.extend(carved_devices)
+
+
 # Helper Methods ##############################################################
 
+def get_worker_pool(processes):
+    """Returns a pool of worker processes that have the command line settings of this process"""
+    settings = dict((name, globals()[name]) for name in WORKER_SETTINGS)
+    return multiprocessing.Pool(processes, apply_worker_settings, (settings,))
+
+
+def apply_worker_settings(settings):
+    """Pool initializer, sets the command line variables in a worker process"""
+    globals().update(settings)
+
+
 def load_file(file):
     """Loads a file as a registry hive"""
     try:
@@ -1166,7 +2809,19 @@ def main():
     parser.add_argument('-o', '--output', help='The output file name')
     parser.add_argument('-f', '--format', choices=['csv', 'text'], help='Output format')
     parser.add_argument('-d', '--debug', action='store_true', help='Debug mode, which outputs details VERY verbosely')
-    parser.add_argument('-i', '--image', required=True, help='path to image')
+    parser.add_argument('-i', '--image', required=True, nargs='+', help='path to image(s)')
+    parser.add_argument('-u', '--user-workers', type=int, default=1, help='Number of worker processes used to parse the user hives')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of partitions/images to process in parallel worker processes')
+    parser.add_argument('-c', '--cache-size', type=int, default=64, help='Size in MB of the image block cache')
+    parser.add_argument('-a', '--read-ahead', type=int, default=8, help='Number of 64 KB blocks to read ahead on sequential reads')
+    parser.add_argument('-p', '--prefetch', action='store_true', default=False, help='Read ahead in a background thread whilst the hives are parsed')
+    parser.add_argument('-y', '--image-type', choices=['auto', 'raw', 'split', 'ewf', 'mmap'], default='auto', help='Image backend, by default detected from the extension (.E01 ewf, .001 split raw)')
+    parser.add_argument('-n', '--manifest', help='Write the hashes, size and MAC times of every file analysed to this file')
+    parser.add_argument('-m', '--discover', action='store_true', default=False, help='Locate the user hives and setupapi logs by parsing the $MFT rather than using fixed paths')
+    parser.add_argument('-s', '--shadow-copies', action='store_true', default=False, help='Also process the volume shadow copies of each partition (requires pyvshadow)')
+    parser.add_argument('-r', '--carve', action='store_true', default=False, help='Carve registry hives and setupapi sections from the unallocated space of each partition')
+    parser.add_argument('-k', '--carve-workers', type=int, default=1, help='Number of worker processes used to search the unallocated space')
+    parser.add_argument('-t', '--spill-threshold', type=int, default=256, help='Files larger than this many MB are extracted to a private temporary directory rather than read in memory')
     args = parser.parse_args()
 
     if args.debug is True:
@@ -1178,7 +2833,27 @@ def main():
             print("The output file has not been supplied")
             return
 
-    process(args.image, args.output, args.format)
+    global spill_threshold, cache_size, read_ahead, prefetch_mode, image_type, user_workers, discover_mode, shadow_mode, carve_mode, carve_workers, manifest_mode
+    spill_threshold = args.spill_threshold * 1024 * 1024
+    cache_size = args.cache_size * 1024 * 1024
+    read_ahead = args.read_ahead
+    prefetch_mode = args.prefetch
+    image_type = args.image_type
+    user_workers = args.user_workers
+    discover_mode = args.discover
+    shadow_mode = args.shadow_copies
+    carve_mode = args.carve
+    carve_workers = args.carve_workers
+    manifest_mode = args.manifest is not None
+
+    try:
+        process(args.image, args.output, args.format, args.workers)
+
+        if manifest_mode is True:
+            output_manifest_to_file(args.manifest)
+    finally:
+        remove_temp_directory()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,249 @@
+"""Builders for the small fixtures used by the tests: hive base blocks, hbins, key/value
+records, transaction logs, MFT FILE records and in memory registry keys"""
+import struct
+from datetime import datetime
+
+from Registry import Registry
+
+from usbdeviceforensics import marvin32
+
+# 2014-01-01T00:00:00
+FILETIME = 130330080000000000
+
+PAGE_SIZE = 4096
+
+
+def build_base_block(primary, secondary, hbins_size, file_type=0, size=PAGE_SIZE):
+    """Returns a regf base block with a valid checksum"""
+    header = struct.pack('<4sIIQIIIIII', 'regf', primary, secondary, FILETIME, 1, 5, file_type, 1, 0x20, hbins_size)
+    header += '\x00' * (0x1FC - len(header))
+    checksum = 0
+    for value in struct.unpack('<127I', header):
+        checksum ^= value
+    header += struct.pack('<I', checksum)
+
+    return header + '\x00' * (size - len(header))
+
+
+def build_cell(body, free=False):
+    """Returns a cell holding the body, sized to the 8 byte alignment, negative when allocated"""
+    size = (len(body) + 4 + 7) // 8 * 8
+    return struct.pack('<i', size if free else -size) + body + '\x00' * (size - 4 - len(body))
+
+
+def build_nk(name, parent, values_count=0, values_offset=0xFFFFFFFF, filetime=FILETIME, flags=0x0020):
+    """Returns a key (nk) record with an ASCII name"""
+    return ('nk' + struct.pack('<HQIIIIIIIIIIIIIIIHH', flags, filetime, 0, parent, 0, 0, 0xFFFFFFFF, 0xFFFFFFFF,
+                               values_count, values_offset, 0xFFFFFFFF, 0xFFFFFFFF, 0, 0, 0, 0, 0, len(name), 0) + name)
+
+
+def build_vk(name, data_length, data_offset):
+    """Returns a value (vk) record with an ASCII name and REG_SZ data"""
+    return 'vk' + struct.pack('<HIIIHH', len(name), data_length, data_offset, 1, 0x0001, 0) + name
+
+
+def build_hbin(cells, hbin_offset=0, size=PAGE_SIZE):
+    """Returns an hbin page holding the cells, the rest of the page being one free cell"""
+    data = 'hbin' + struct.pack('<II', hbin_offset, size) + '\x00' * 20 + ''.join(cells)
+    return data + struct.pack('<i', size - len(data)) + '\x00' * (size - len(data) - 4)
+
+
+def get_cell_offsets(cells):
+    """Returns the hive offsets (from the first hbin) of the cells of the first hbin"""
+    offsets = []
+    position = 0x20
+    for cell in cells:
+        offsets.append(position)
+        position += len(cell)
+
+    return offsets
+
+
+def build_log_entry(sequence, hbins_size, pages):
+    """Returns a new format (HvLE) log entry for the [(offset, page data)] with valid hashes"""
+    references = ''.join(struct.pack('<II', offset, len(data)) for offset, data in pages)
+    body = references + ''.join(data for offset, data in pages)
+    size = 40 + len(body)
+
+    hash1 = marvin32(body)
+    header = 'HvLE' + struct.pack('<IIIII', size, 0, sequence, hbins_size, len(pages)) + struct.pack('<Q', hash1)
+    hash2 = marvin32(header)
+
+    return header + struct.pack('<Q', hash2) + body
+
+
+def build_new_format_log(primary, entries):
+    """Returns a new format transaction log, a log base block followed by the entries"""
+    return build_base_block(primary, primary, 0, file_type=6, size=512) + ''.join(entries)
+
+
+def build_old_format_log(sequence, hbins_size, sectors):
+    """Returns an old format (DIRT) transaction log for the {sector index: sector data}"""
+    vector = bytearray(hbins_size // 512 // 8)
+    for index in sectors:
+        vector[index // 8] |= 1 << (index % 8)
+
+    data = build_base_block(sequence, sequence, hbins_size, file_type=2, size=512) + 'DIRT' + str(vector)
+    data += '\x00' * ((512 - len(data) % 512) % 512)
+    for index in sorted(sectors):
+        data += sectors[index]
+
+    return data
+
+
+def build_mft_record(name, parent=5, data_size=100, flags=0x0001, size=1024):
+    """Returns a 1024 byte MFT FILE record with a resident $FILE_NAME and $DATA, with fixups applied"""
+    encoded_name = name.encode('utf-16-le')
+    file_name = struct.pack('<Q', parent) + '\x00' * 0x38 + chr(len(name)) + chr(1) + encoded_name
+    attributes = build_resident_attribute(0x30, file_name) + build_resident_attribute(0x80, '\x00' * data_size)
+    attributes += struct.pack('<I', 0xFFFFFFFF) + '\x00' * 4
+
+    sectors = size // 512
+    used_size = 0x38 + len(attributes)
+    header = 'FILE' + struct.pack('<HH', 0x30, sectors + 1) + '\x00' * 8
+    header += struct.pack('<HHHHII', 1, 1, 0x38, flags, used_size, size) + '\x00' * 16
+    header += struct.pack('<H', 1) + '\x00\x00' * sectors
+
+    record = bytearray((header + '\x00' * (0x38 - len(header)) + attributes).ljust(size, '\x00'))
+    for index in range(1, sectors + 1):
+        end = index * 512
+        record[0x30 + index * 2:0x32 + index * 2] = record[end - 2:end]
+        record[end - 2:end] = struct.pack('<H', 1)
+
+    return str(record)
+
+
+def build_resident_attribute(attribute_type, content):
+    """Returns a resident MFT attribute, padded to 8 bytes"""
+    attribute = struct.pack('<IIBBHHHIHBB', attribute_type, 0, 0, 0, 0, 0, 0, len(content), 0x18, 0, 0) + content
+    attribute += '\x00' * ((8 - len(attribute) % 8) % 8)
+
+    return attribute[:4] + struct.pack('<I', len(attribute)) + attribute[8:]
+
+
+class FakeValue():
+    """Stands in for a python-registry RegistryValue"""
+    def __init__(self, name, value):
+        self._name = name
+        self._value = value
+
+    def name(self):
+        return self._name
+
+    def value(self):
+        return self._value
+
+    def value_type(self):
+        return Registry.RegSZ
+
+    def raw_data(self):
+        return str(self._value)
+
+
+class FakeKey():
+    """Stands in for a python-registry RegistryKey"""
+    def __init__(self, name, subkeys=None, values=None, timestamp=datetime(2014, 1, 1)):
+        self._name = name
+        self._subkeys = subkeys or []
+        self._values = values or []
+        self._timestamp = timestamp
+
+    def name(self):
+        return self._name
+
+    def timestamp(self):
+        return self._timestamp
+
+    def subkeys(self):
+        return self._subkeys
+
+    def values(self):
+        return self._values
+
+    def subkeys_number(self):
+        return len(self._subkeys)
+
+    def values_number(self):
+        return len(self._values)
+
+    def value(self, name):
+        for value in self._values:
+            if value.name().lower() == name.lower():
+                return value
+        raise Registry.RegistryValueNotFoundException(name)
+
+    def subkey(self, name):
+        for key in self._subkeys:
+            if key.name().lower() == name.lower():
+                return key
+        raise Registry.RegistryKeyNotFoundException(name)
+
+    def find_key(self, path):
+        key = self
+        for name in path.split('\\'):
+            try:
+                key = key.subkey(name)
+            except Registry.RegistryKeyNotFoundException:
+                return None
+
+        return key
+
+
+class FakeRegistry():
+    """Stands in for a python-registry Registry, holding the keys below the root"""
+    def __init__(self, subkeys, hive_type=Registry.HiveType.SYSTEM):
+        self._root = FakeKey('ROOT', subkeys)
+        self._hive_type = hive_type
+
+    def root(self):
+        return self._root
+
+    def hive_type(self):
+        return self._hive_type
+
+    def hive_name(self):
+        return self._hive_type.value
+
+    def open(self, path):
+        key = self._root.find_key(path)
+        if key is None:
+            raise Registry.RegistryKeyNotFoundException(path)
+
+        return key
+
+
+def build_system_hive(control_sets=('ControlSet001',), current=1, devices=None):
+    """Returns a SYSTEM FakeRegistry holding the USBSTOR, USB, MountedDevices and DeviceClasses keys of the
+    devices, a list of (vendor, product, version, serial, VID_xxxx&PID_xxxx, ParentIdPrefix, drive letter),
+    in each of the control sets"""
+    if devices is None:
+        devices = [('SanDisk', 'Cruzer', '1.0', 'AA11', 'VID_0781&PID_5530', '7&abc&0', 'E:')]
+
+    subkeys = []
+    mounted_values = []
+    for control_set in control_sets:
+        usb_stor = []
+        usb = []
+        device_classes = []
+        for vendor, product, version, serial, vid_pid, parent_prefix_id, drive_letter in devices:
+            disk = 'Disk&Ven_%s&Prod_%s&Rev_%s' % (vendor, product, version)
+            usb_stor.append(FakeKey(disk, [FakeKey(serial + '&0', [FakeKey('Properties')],
+                                                   [FakeValue('ParentIdPrefix', parent_prefix_id)])]))
+            usb.append(FakeKey(vid_pid, [FakeKey(serial)]))
+            device_classes.append(FakeKey('##?#USBSTOR#%s#%s&0#{53f56307-b6bf-11d0-94f2-00a0c91efb8b}' % (disk, serial)))
+
+        subkeys.append(FakeKey(control_set, [
+            FakeKey('Enum', [FakeKey('USBSTOR', usb_stor), FakeKey('USB', usb)]),
+            FakeKey('Control', [FakeKey('DeviceClasses', [
+                FakeKey('{53f56307-b6bf-11d0-94f2-00a0c91efb8b}', device_classes)])])]))
+
+    for vendor, product, version, serial, vid_pid, parent_prefix_id, drive_letter in devices:
+        data = '_??_USBSTOR#Disk&Ven_%s&Prod_%s&Rev_%s#%s#{53f56307-b6bf-11d0-94f2-00a0c91efb8b}' % (
+            vendor, product, version, parent_prefix_id)
+        mounted_values.append(FakeValue('\\DosDevices\\' + drive_letter, data))
+        mounted_values.append(FakeValue('\\??\\Volume{%s-2222-3333-4444-555555555555}' % serial, data))
+
+    subkeys.append(FakeKey('MountedDevices', values=mounted_values))
+    subkeys.append(FakeKey('Select', values=[FakeValue('Current', current)]))
+
+    return FakeRegistry(subkeys)
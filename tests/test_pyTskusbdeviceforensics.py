@@ -0,0 +1,146 @@
+"""Tests for the MFT record parsing and unallocated space carving of pyTskusbdeviceforensics.py"""
+import struct
+import unittest
+
+import pyTskusbdeviceforensics as tsk
+from tests.fixtures import PAGE_SIZE, build_base_block, build_cell, build_hbin, build_mft_record, build_nk
+
+
+class FakeInfo():
+    def __init__(self, offset, block_size, block_count):
+        self.offset = offset
+        self.block_size = block_size
+        self.block_count = block_count
+
+
+class FakeFilesystem():
+    """Stands in for a pytsk3 FS_Info, only the geometry is used"""
+    def __init__(self, offset, block_size, block_count):
+        self.info = FakeInfo(offset, block_size, block_count)
+
+    def open_meta(self, inode):
+        return None
+
+
+class MftRecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.record = build_mft_record('SYSTEM', parent=0x1234)
+
+    def corrupt(self, offset, data):
+        return self.record[:offset] + data + self.record[offset + len(data):]
+
+    def test_record_is_parsed(self):
+        entry = tsk.parse_mft_record(self.record, 42)
+
+        self.assertEqual(entry.record, 42)
+        self.assertEqual(entry.name, u'SYSTEM')
+        self.assertEqual(entry.parent, 0x1234)
+        self.assertEqual(entry.size, 100)
+        self.assertTrue(entry.in_use)
+        self.assertTrue(entry.resident)
+        self.assertFalse(entry.is_directory)
+
+    def test_truncated_record_is_rejected(self):
+        self.assertIsNone(tsk.parse_mft_record(self.record[:0x20], 42))
+
+    def test_torn_write_is_rejected(self):
+        self.assertIsNone(tsk.parse_mft_record(self.corrupt(1022, '\x09\x09'), 42))
+
+    def test_used_size_beyond_the_record_is_rejected(self):
+        self.assertIsNone(tsk.parse_mft_record(self.corrupt(0x18, struct.pack('<I', 4096)), 42))
+
+    def test_attribute_offset_beyond_the_used_size_is_rejected(self):
+        self.assertIsNone(tsk.parse_mft_record(self.corrupt(0x14, struct.pack('<H', 0x3F0)), 42))
+
+    def test_short_attribute_length_is_rejected(self):
+        self.assertIsNone(tsk.parse_mft_record(self.corrupt(0x3C, struct.pack('<I', 8)), 42))
+
+    def test_file_name_beyond_the_attribute_is_rejected(self):
+        # The $FILE_NAME content starts at 0x50, its name length is at 0x40 within it
+        self.assertIsNone(tsk.parse_mft_record(self.corrupt(0x90, chr(200)), 42))
+
+    def test_file_name_content_beyond_the_attribute_is_rejected(self):
+        self.assertIsNone(tsk.parse_mft_record(self.corrupt(0x48, struct.pack('<I', 0x200)), 42))
+
+
+class CarvingTest(unittest.TestCase):
+    """A partition starting at sector 63, as on MBR disks, with 4 KB clusters"""
+
+    def setUp(self):
+        self.fs_offset = 63 * 512
+        self.read_file_from_image = tsk.read_file_from_image
+
+    def tearDown(self):
+        tsk.read_file_from_image = self.read_file_from_image
+
+    def test_signatures_are_aligned_to_the_partition(self):
+        buffer = bytearray(4 * PAGE_SIZE)
+        # Aligned within the partition, and aligned within the image but not the partition
+        image_aligned = 2 * PAGE_SIZE - self.fs_offset % PAGE_SIZE
+        buffer[PAGE_SIZE:PAGE_SIZE + 4] = 'regf'
+        buffer[image_aligned:image_aligned + 4] = 'regf'
+
+        positions = list(tsk.find_aligned(str(buffer), 'regf', self.fs_offset, self.fs_offset + len(buffer),
+                                          PAGE_SIZE, self.fs_offset))
+        self.assertEqual(positions, [PAGE_SIZE])
+
+    def test_unallocated_ranges_are_read_from_the_bitmap(self):
+        # Clusters 8-23 are free, then clusters 28-31 of which only 28-29 exist
+        tsk.read_file_from_image = lambda filesystemObject, fileobject: '\xff\x00\x00\x0f\xff'
+        filesystem = FakeFilesystem(self.fs_offset, PAGE_SIZE, 30)
+
+        self.assertEqual(tsk.get_unallocated_ranges(filesystem),
+                         [(self.fs_offset + 8 * PAGE_SIZE, 16 * PAGE_SIZE),
+                          (self.fs_offset + 28 * PAGE_SIZE, 2 * PAGE_SIZE)])
+
+    def build_image(self):
+        header = build_base_block(1, 1, PAGE_SIZE)
+        page = build_hbin([build_cell(build_nk('ROOT', 0, flags=0x002C))])
+        section = ('>>>  [Device Install (Hardware initiated) - USBSTOR\\Disk&Ven_A&Prod_B&Rev_1.0\\SER123&0]\r\n'
+                   '>>>  Section start 2014/01/01 00:00:00.000\r\n'
+                   '<<<  [Exit status: SUCCESS]\r\n')
+
+        image = bytearray(self.fs_offset + 4 * PAGE_SIZE)
+        image[self.fs_offset + PAGE_SIZE:self.fs_offset + 2 * PAGE_SIZE] = header
+        image[self.fs_offset + 2 * PAGE_SIZE:self.fs_offset + 3 * PAGE_SIZE] = page
+        image[self.fs_offset + 3 * PAGE_SIZE + 100:self.fs_offset + 3 * PAGE_SIZE + 100 + len(section)] = section
+
+        return str(image), header, page, section
+
+    def test_block_is_carved(self):
+        image, header, page, section = self.build_image()
+        read = lambda offset, size: image[offset:offset + size]
+
+        headers, hbins, sections = tsk.carve_block(read, self.fs_offset, len(image), PAGE_SIZE, self.fs_offset)
+
+        self.assertEqual(headers, [(self.fs_offset + PAGE_SIZE, header)])
+        self.assertEqual(hbins, [(self.fs_offset + 2 * PAGE_SIZE, 0, page)])
+        self.assertEqual(sections, [(self.fs_offset + 3 * PAGE_SIZE + 100, section)])
+
+    def test_hive_is_reassembled_from_its_header_and_pages(self):
+        image, header, page, section = self.build_image()
+        read = lambda offset, size: image[offset:offset + size]
+        headers, hbins, sections = tsk.carve_block(read, self.fs_offset, len(image), PAGE_SIZE, self.fs_offset)
+
+        hives = tsk.assemble_carved_hives(headers, hbins)
+
+        self.assertEqual(len(hives), 1)
+        offset, data = hives[0]
+        self.assertEqual(offset, self.fs_offset + PAGE_SIZE)
+        self.assertEqual(data[tsk.REGF_HEADER_SIZE:], page)
+
+    def test_orphan_pages_are_reassembled_around_the_root_key(self):
+        page = build_hbin([build_cell(build_nk('ROOT', 0, flags=0x002C))])
+
+        hives = tsk.assemble_carved_hives([], [(self.fs_offset, 0, page)])
+
+        self.assertEqual(len(hives), 1)
+        offset, data = hives[0]
+        self.assertEqual(data[0:4], 'regf')
+        self.assertEqual(struct.unpack('<I', data[0x24:0x28])[0], 0x20)
+        self.assertEqual(data[tsk.REGF_HEADER_SIZE:], page)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,789 @@
+"""Tests for the hive processing, transaction log replay, deleted key recovery and multi host modes"""
+import os
+import shutil
+import struct
+import tempfile
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from Registry import Registry
+
+import usbdeviceforensics as usb
+from tests.fixtures import (FILETIME, PAGE_SIZE, FakeKey, FakeRegistry, FakeValue, build_base_block, build_cell,
+                            build_hbin, build_log_entry, build_new_format_log, build_nk, build_old_format_log,
+                            build_system_hive, build_vk, get_cell_offsets)
+
+
+class TransactionLogReplayTest(unittest.TestCase):
+    """A dirty hive (primary sequence 5, secondary 4) replayed from logs alongside it"""
+
+    def setUp(self):
+        usb.quiet_mode = True
+        self.directory = tempfile.mkdtemp()
+        self.hive_path = os.path.join(self.directory, 'SYSTEM')
+        self.hive = build_base_block(5, 4, PAGE_SIZE) + build_hbin([])
+        self.page_a = build_hbin([build_cell(build_nk('PageA', 0))])
+        self.page_b = build_hbin([build_cell(build_nk('PageB', 0))])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_log(self, name, data):
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(data)
+
+    def replay(self):
+        return usb.replay_transaction_logs(self.hive_path, self.hive)
+
+    def get_page(self, data):
+        return data[usb.HIVE_BINS_OFFSET:usb.HIVE_BINS_OFFSET + PAGE_SIZE]
+
+    def test_fixtures_are_identified(self):
+        self.assertTrue(usb.is_hive_dirty(self.hive[:usb.BASE_BLOCK_SIZE]))
+        self.assertFalse(usb.is_transaction_log(self.hive[:usb.BASE_BLOCK_SIZE]))
+        self.assertTrue(usb.is_transaction_log(build_new_format_log(4, [])))
+
+    def test_new_format_entries_are_applied_in_sequence(self):
+        self.write_log('SYSTEM.LOG1', build_new_format_log(4, [build_log_entry(4, PAGE_SIZE, [(0, self.page_a)]),
+                                                               build_log_entry(5, PAGE_SIZE, [(0, self.page_b)])]))
+
+        data = self.replay()
+        self.assertEqual(self.get_page(data), self.page_b)
+        self.assertFalse(usb.is_hive_dirty(data[:usb.BASE_BLOCK_SIZE]))
+
+        checksum = 0
+        for value in struct.unpack('<127I', data[0:0x1FC]):
+            checksum ^= value
+        self.assertEqual(struct.unpack('<I', data[0x1FC:0x200])[0], checksum)
+
+    def test_entries_continue_across_logs(self):
+        self.write_log('SYSTEM.LOG1', build_new_format_log(4, [build_log_entry(4, PAGE_SIZE, [(0, self.page_a)])]))
+        self.write_log('SYSTEM.LOG2', build_new_format_log(5, [build_log_entry(5, PAGE_SIZE, [(0, self.page_b)])]))
+
+        self.assertEqual(self.get_page(self.replay()), self.page_b)
+
+    def test_out_of_sequence_entry_stops_the_replay(self):
+        self.write_log('SYSTEM.LOG1', build_new_format_log(4, [build_log_entry(4, PAGE_SIZE, [(0, self.page_a)]),
+                                                               build_log_entry(6, PAGE_SIZE, [(0, self.page_b)])]))
+
+        self.assertEqual(self.get_page(self.replay()), self.page_a)
+
+    def test_entries_older_than_the_hive_are_skipped(self):
+        self.write_log('SYSTEM.LOG1', build_new_format_log(3, [build_log_entry(3, PAGE_SIZE, [(0, self.page_a)])]))
+
+        self.assertEqual(self.get_page(self.replay()), self.get_page(self.hive))
+
+    def test_entry_with_a_bad_hash_stops_the_replay(self):
+        second = bytearray(build_log_entry(5, PAGE_SIZE, [(0, self.page_b)]))
+        second[-1] ^= 0xFF
+        self.write_log('SYSTEM.LOG1', build_new_format_log(4, [build_log_entry(4, PAGE_SIZE, [(0, self.page_a)]),
+                                                               str(second)]))
+
+        self.assertEqual(self.get_page(self.replay()), self.page_a)
+
+    def test_entry_with_a_bad_header_hash_is_rejected(self):
+        entry = bytearray(build_log_entry(4, PAGE_SIZE, [(0, self.page_a)]))
+        entry[32] ^= 0xFF
+        self.write_log('SYSTEM.LOG1', build_new_format_log(4, [str(entry)]))
+
+        self.assertEqual(self.get_page(self.replay()), self.get_page(self.hive))
+
+    def test_old_format_dirty_sectors_are_applied(self):
+        self.write_log('SYSTEM.LOG', build_old_format_log(5, PAGE_SIZE, {1: 'S' * 512}))
+
+        page = self.get_page(self.replay())
+        self.assertEqual(page[512:1024], 'S' * 512)
+        self.assertEqual(page[0:512], self.get_page(self.hive)[0:512])
+
+    def test_old_format_log_older_than_the_hive_is_ignored(self):
+        self.write_log('SYSTEM.LOG', build_old_format_log(3, PAGE_SIZE, {1: 'S' * 512}))
+
+        self.assertEqual(self.get_page(self.replay()), self.get_page(self.hive))
+
+
+class DeletedKeyRecoveryTest(unittest.TestCase):
+    """A hive holding a Disk&Ven_&Prod_&Rev_ key with a deleted serial number key below it,
+    with a ParentIdPrefix value, and a deleted MountPoints2 volume GUID key"""
+
+    def setUp(self):
+        usb.quiet_mode = True
+        usb.usb_devices = []
+
+    def build_hive(self, deleted_filetime=FILETIME):
+        data = u'7&abc&0\x00'.encode('utf-16le')
+
+        def build_cells(offsets):
+            return [build_cell(build_nk('Disk&Ven_A&Prod_B&Rev_1.0', 0)),
+                    build_cell(struct.pack('<I', offsets[2])),
+                    build_cell(build_vk('ParentIdPrefix', len(data), offsets[3])),
+                    build_cell(data),
+                    build_cell(build_nk('SER123&0', offsets[0], 1, offsets[1], deleted_filetime), free=True),
+                    build_cell(build_nk('MountPoints2', 0)),
+                    build_cell(build_nk('{11111111-2222-3333-4444-555555555555}', offsets[5],
+                                        filetime=deleted_filetime), free=True)]
+
+        offsets = get_cell_offsets(build_cells([0] * 7))
+        return build_base_block(1, 1, PAGE_SIZE) + build_hbin(build_cells(offsets))
+
+    def test_deleted_keys_are_found_in_free_cells(self):
+        keys = usb.find_deleted_keys(self.build_hive())
+
+        self.assertEqual(sorted(key.name for key in keys), ['SER123&0', '{11111111-2222-3333-4444-555555555555}'])
+        self.assertEqual(keys[0].timestamp, datetime(2014, 1, 1))
+
+    def test_implausible_timestamps_are_rejected(self):
+        self.assertEqual(usb.find_deleted_keys(self.build_hive(deleted_filetime=1)), [])
+
+    def test_name_beyond_the_cell_is_rejected(self):
+        data = self.build_hive()
+        position = data.find('SER123&0') - usb.NK_NAME_OFFSET
+        self.assertIsNone(usb.parse_key_record(data, position, position + usb.NK_NAME_OFFSET + 4))
+
+    def test_usb_stor_device_is_recovered(self):
+        data = self.build_hive()
+        recovered = usb.recover_usb_stor_keys(data, usb.find_deleted_keys(data))
+
+        self.assertEqual(len(recovered), 1)
+        device = recovered[0]
+        self.assertEqual((device.vendor, device.product, device.version, device.serial_number),
+                         ('Ven_A', 'Prod_B', 'Rev_1.0', 'SER123'))
+        self.assertEqual(device.parent_prefix_id, '7&abc&0')
+        self.assertEqual(device.source, 'recovered')
+
+    def test_existing_device_key_is_not_recovered(self):
+        device = usb.UsbDevice()
+        device.vendor, device.product, device.version, device.serial_number = 'Ven_A', 'Prod_B', 'Rev_1.0', 'SER123'
+        device.parent_prefix_id = 'SER123&0'
+        usb.usb_devices = [device]
+
+        data = self.build_hive()
+        self.assertEqual(usb.recover_usb_stor_keys(data, usb.find_deleted_keys(data)), [])
+
+    def test_mountpoints2_key_is_matched_on_the_volume_guid(self):
+        device = usb.UsbDevice()
+        device.guid = '11111111-2222-3333-4444-555555555555'
+        usb.usb_devices = [device]
+
+        data = self.build_hive()
+        usb.recover_mountpoints2_keys(data, usb.find_deleted_keys(data), 'NTUSER.DAT')
+
+        self.assertEqual([(mp.file, mp.timestamp) for mp in device.mountpoint2],
+                         [('NTUSER.DAT (recovered)', datetime(2014, 1, 1))])
+
+
+class CsvLoadTest(unittest.TestCase):
+    """The devices are loaded back from the CSV output, including files written before the
+    Source and later columns were added"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, 'host.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_csv(self, header, row):
+        with open(self.csv_path, 'wb') as f:
+            f.write('\t'.join(header) + '\n')
+            f.write('\t'.join('"' + value + '"' for value in row) + '\n')
+
+    def get_fixed_row(self):
+        return ['Ven_A', 'Prod_B', 'Rev_1.0', 'SER123', 'VID_1234', 'PID_5678', '7&abc&0', 'E:', 'DATA',
+                '11111111-2222-3333-4444-555555555555', '', '', '2014-01-01 00:00:00'] + [''] * 7
+
+    def test_file_without_the_later_columns_is_loaded(self):
+        header = ['Vendor', 'Product', 'Version', 'SerialNumber', 'VID', 'PID', 'ParentIDPrefix', 'DriveLetter',
+                  'VolumeName', 'GUID', 'MountPoint', 'Install', 'USBSTOR', 'USBSTOR Properties (Install Date)',
+                  'USBSTOR Properties (First Install Date)', 'USBSTOR Properties (Last Arrival Date)',
+                  'USBSTOR Properties (Last Removal Date)', 'DeviceClasses (53f56307-b6bf-11d0-94f2-00a0c91efb8b)',
+                  'DeviceClasses (10497b1b-ba51-44e5-8318-a65c837b6661)', 'Enum\\USB VIDPID',
+                  'MountPoints2:0', 'MountPoints2 File:0']
+        self.write_csv(header, self.get_fixed_row() + ['2014-01-02 00:00:00', 'NTUSER.DAT'])
+
+        devices = usb.load_devices_from_csv(self.csv_path)
+
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(devices[0].serial_number, 'SER123')
+        self.assertEqual(devices[0].usb_stor_datetime, datetime(2014, 1, 1))
+        self.assertEqual(devices[0].source, '')
+        self.assertEqual([(mp.file, mp.timestamp) for mp in devices[0].mountpoint2],
+                         [('NTUSER.DAT', datetime(2014, 1, 2))])
+
+
+class ResultIndexTest(unittest.TestCase):
+    """Time range queries over the devices of a number of hosts"""
+
+    def build_device(self, first, last):
+        device = usb.UsbDevice()
+        device.usb_stor_datetime = first
+        device.vid_pid_datetime = last
+        return device
+
+    def test_overlap_query_matches_a_scan_of_the_rows(self):
+        generator = random.Random(1)
+        devices = []
+        for i in range(200):
+            first = datetime(2014, 1, 1) + timedelta(hours=generator.randint(0, 2000))
+            devices.append(self.build_device(first, first + timedelta(hours=generator.randint(0, 500))))
+        index = usb.build_result_index([('host', devices)])
+
+        for i in range(50):
+            start = datetime(2014, 1, 1) + timedelta(hours=generator.randint(0, 2500))
+            end = start + timedelta(hours=generator.randint(0, 100))
+            expected = sorted([row for row in range(len(devices))
+                               if index.first_seen[row] <= end and index.last_seen[row] >= start],
+                              key=lambda row: (index.first_seen[row], row))
+            self.assertEqual(index.query_overlap(start, end), expected)
+
+    def test_range_query_includes_both_bounds(self):
+        index = usb.build_result_index([('host', [self.build_device(datetime(2014, 1, 1), datetime(2014, 1, 3))])])
+
+        self.assertEqual(index.query_range('vid_pid_datetime', datetime(2014, 1, 2), datetime(2014, 1, 3)),
+                         [(0, 'vid_pid_datetime', datetime(2014, 1, 3))])
+        self.assertEqual(index.query_range('any', datetime(2014, 1, 2), datetime(2014, 1, 2, 23)), [])
+
+    def test_date_only_end_is_the_end_of_the_day(self):
+        self.assertEqual(usb.parse_query_datetime('2014-01-02'), datetime(2014, 1, 2))
+        self.assertEqual(usb.parse_query_datetime('2014-01-02', end_of_day=True),
+                         datetime(2014, 1, 2, 23, 59, 59, 999999))
+        self.assertEqual(usb.parse_query_datetime('2014-01-02T10:00:00', end_of_day=True),
+                         datetime(2014, 1, 2, 10))
+
+
+class CorrelationTest(unittest.TestCase):
+    """Devices seen on a number of hosts joined on their keys and EMDMgmt volume serial numbers"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hosts_are_named_from_their_path(self):
+        paths = [os.path.join(self.directory, 'host1', 'out.csv'), os.path.join(self.directory, 'host2', 'out.csv')]
+
+        self.assertEqual(usb.get_host_names(paths), [os.path.join('host1', 'out'), os.path.join('host2', 'out')])
+        self.assertEqual(usb.get_host_names([os.path.join(self.directory, 'host1.csv')]), ['host1'])
+
+    def test_keys_missing_a_part_are_compatible(self):
+        self.assertTrue(usb.is_correlation_key_compatible(('aa11', 'VID_0781', 'PID_5530'), ('aa11', '', '')))
+        self.assertTrue(usb.is_correlation_key_compatible(('7&abc&0', 'VID_0781', 'PID_5530'),
+                                                          ('7&def&0', 'VID_0781', 'PID_5530')))
+        self.assertFalse(usb.is_correlation_key_compatible(('aa11', 'VID_0781', 'PID_5530'),
+                                                           ('bb22', 'VID_0781', 'PID_5530')))
+        self.assertFalse(usb.is_correlation_key_compatible(('aa11', 'VID_0781', 'PID_5530'),
+                                                           ('aa11', 'VID_0951', 'PID_1643')))
+
+    def test_groups_are_only_merged_when_compatible(self):
+        full = ('aa11', 'VID_0781', 'PID_5530')
+        partial = ('aa11', '', '')
+        other = ('bb22', 'VID_0781', 'PID_5530')
+        parents = dict((key, key) for key in [full, partial, other])
+        groups = dict(parents)
+
+        usb.union_correlation_keys(parents, groups, partial, full)
+        usb.union_correlation_keys(parents, groups, partial, other)
+
+        self.assertEqual(usb.find_correlation_key(parents, full), partial)
+        self.assertEqual(usb.find_correlation_key(parents, other), other)
+        self.assertEqual(groups[partial], ('aa11', 'VID_0781', 'PID_5530'))
+
+
+class DeviceStoreTest(unittest.TestCase):
+    """A store holding 100 devices with only 10 of them in memory"""
+
+    def setUp(self):
+        self.store = usb.DeviceStore(10)
+        for i in range(100):
+            device = usb.UsbDevice()
+            device.serial_number = 'SER%d' % i
+            device.control_sets = {'vid': 'ControlSet001'}
+            self.store.append(device)
+
+        self.writes = []
+        write_device = self.store.write_device
+
+        def record_write(index, device):
+            written = write_device(index, device)
+            if written:
+                self.writes.append(index)
+            return written
+        self.store.write_device = record_write
+
+        # Writes the new devices that are still in memory
+        for device in self.store:
+            pass
+        del self.writes[:]
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_reading_the_devices_does_not_rewrite_them(self):
+        for i in range(2):
+            for device in self.store:
+                pass
+
+        self.assertEqual(self.writes, [])
+
+    def test_modified_devices_are_written_back(self):
+        self.store[5].vid = 'VID_0781'
+        for device in self.store:
+            pass
+
+        self.assertEqual(self.writes, [5])
+        self.assertEqual(self.store.find(serial_number='SER5')[0].vid, 'VID_0781')
+
+
+class ProfileTest(unittest.TestCase):
+    """The per stage counters of the profile mode"""
+
+    def setUp(self):
+        usb.quiet_mode = True
+        usb.profile_mode = True
+        usb.usb_devices = []
+        usb.profile_records = []
+
+    def tearDown(self):
+        usb.profile_mode = False
+
+    def test_devices_are_counted_once_per_stage(self):
+        # The device is in both control sets, so the second USBSTOR key is a duplicate
+        registry = build_system_hive(control_sets=('ControlSet001', 'ControlSet002'))
+        for stage, method in [('process_usb_stor', usb.process_usb_stor), ('process_usb', usb.process_usb),
+                              ('process_mounted_devices', usb.process_mounted_devices)]:
+            usb.run_stage(stage, 'SYSTEM', method, registry)
+
+        self.assertEqual([(record['stage'], record['devices_matched']) for record in usb.profile_records],
+                         [('process_usb_stor', 1), ('process_usb', 1), ('process_mounted_devices', 1)])
+
+    def test_devices_built_outside_a_stage_are_not_counted(self):
+        matched = usb.profile_counters['devices_matched']
+        device = usb.UsbDevice()
+        device.vendor = 'Ven_A'
+
+        self.assertEqual(usb.profile_counters['devices_matched'], matched)
+        self.assertNotIn('profile_stage', device.__dict__)
+
+
+class TimelineTest(unittest.TestCase):
+    """The timeline of a number of devices, sorted in memory and in runs merged from temporary files"""
+
+    def setUp(self):
+        usb.quiet_mode = True
+        self.directory = tempfile.mkdtemp()
+        self.run_size = usb.TIMELINE_RUN_SIZE
+
+        generator = random.Random(1)
+        usb.usb_devices = []
+        for i in range(20):
+            device = usb.UsbDevice()
+            device.serial_number = 'SER%d' % i
+            device.usb_stor_datetime = datetime(2014, 1, 1) + timedelta(hours=generator.randint(0, 100))
+            device.vid_pid_datetime = datetime(2014, 1, 1) + timedelta(hours=generator.randint(0, 100))
+            mountpoint = usb.MountPoint2()
+            mountpoint.file = 'NTUSER%d.DAT' % (i % 3)
+            mountpoint.timestamp = datetime(2014, 1, 1) + timedelta(hours=generator.randint(0, 100))
+            device.mountpoint2.append(mountpoint)
+            usb.usb_devices.append(device)
+
+    def tearDown(self):
+        usb.TIMELINE_RUN_SIZE = self.run_size
+        shutil.rmtree(self.directory)
+
+    def get_timeline(self, timeline_format):
+        output = os.path.join(self.directory, 'timeline')
+        usb.output_timeline_to_file(output, timeline_format)
+        with open(output, 'rb') as f:
+            return f.read().splitlines()
+
+    def test_events_are_in_chronological_order(self):
+        lines = self.get_timeline('tln')
+        epochs = [int(line.split('|')[0]) for line in lines]
+
+        self.assertEqual(len(lines), 60)
+        self.assertEqual(epochs, sorted(epochs))
+
+    def test_merged_runs_match_the_in_memory_sort(self):
+        for timeline_format in ['csv', 'bodyfile', 'tln']:
+            expected = self.get_timeline(timeline_format)
+            usb.TIMELINE_RUN_SIZE = 7
+            self.assertEqual(self.get_timeline(timeline_format), expected)
+            usb.TIMELINE_RUN_SIZE = self.run_size
+
+    def test_low_confidence_events_are_marked(self):
+        usb.usb_devices[0].low_confidence.append('usb_stor_datetime')
+        lines = [line for line in self.get_timeline('csv') if '"SER0"' in line]
+
+        self.assertEqual(len([line for line in lines if '"USBSTOR (low confidence)"' in line]), 1)
+        self.assertEqual(len([line for line in lines if '"Enum\\USB VIDPID"' in line]), 1)
+
+
+@unittest.skipIf(usb.numpy is None, 'numpy is not installed')
+class DeviceTableTest(unittest.TestCase):
+    """The columnar table of the devices from two hosts"""
+
+    def setUp(self):
+        self.table = usb.build_device_table([
+            ('host1', [self.build_device('SanDisk', 'AA11', datetime(2014, 1, 3)),
+                       self.build_device('Kingston', 'BB22', datetime(2014, 1, 1))]),
+            ('host2', [self.build_device('SanDisk', 'CC33', datetime.min)])])
+
+    def build_device(self, vendor, serial_number, usb_stor_datetime):
+        device = usb.UsbDevice()
+        device.vendor = vendor
+        device.serial_number = serial_number
+        device.usb_stor_datetime = usb_stor_datetime
+        return device
+
+    def test_columns_are_encoded_from_their_own_values(self):
+        self.assertEqual(list(self.table.get_values('vendor')), ['SanDisk', 'Kingston', 'SanDisk'])
+        self.assertEqual(list(self.table.categories['vendor']), ['Kingston', 'SanDisk'])
+        self.assertEqual(list(self.table.categories['serial_number']), ['AA11', 'BB22', 'CC33'])
+
+        usb.intern_string('Lexar')
+        self.assertEqual(list(self.table.categories['vendor']), ['Kingston', 'SanDisk'])
+
+    def test_rows_are_filtered_and_sorted(self):
+        self.assertEqual(list(self.table.filter_value('vendor', 'SanDisk').get_values('serial_number')),
+                         ['AA11', 'CC33'])
+        self.assertEqual(len(self.table.filter_value('vendor', 'Lexar')), 0)
+        self.assertEqual(list(self.table.sort('usb_stor_datetime').get_values('serial_number')),
+                         ['CC33', 'BB22', 'AA11'])
+
+        table = self.table.filter_time_range('usb_stor_datetime', datetime(2014, 1, 2), datetime(2014, 1, 3))
+        self.assertEqual(list(table.get_values('serial_number')), ['AA11'])
+        self.assertEqual([table.hosts[host_id] for host_id in table.host_ids], ['host1'])
+
+
+@unittest.skipIf(usb.numpy is None, 'numpy is not installed')
+class MassUpdateTest(unittest.TestCase):
+    """Clusters of key timestamps rewritten at the same instant"""
+
+    def find_clusters(self, keys):
+        filetimes = usb.numpy.array([usb.datetime_to_filetime(timestamp) for group, device, timestamp in keys],
+                                    dtype=usb.numpy.int64)
+        groups = usb.numpy.array([group for group, device, timestamp in keys], dtype=usb.numpy.int64)
+        devices = usb.numpy.array([device for group, device, timestamp in keys], dtype=usb.numpy.int64)
+        mask, clusters = usb.find_timestamp_clusters(filetimes, groups, devices)
+        return list(mask), clusters
+
+    def test_devices_updated_together_are_flagged(self):
+        update = datetime(2014, 1, 1, 12)
+        mask, clusters = self.find_clusters([(0, 0, update), (0, 1, update + timedelta(milliseconds=300)),
+                                             (0, 2, update + timedelta(milliseconds=600)),
+                                             (0, 3, datetime(2013, 6, 1))])
+
+        self.assertEqual(mask, [True, True, True, False])
+        self.assertEqual(clusters, [(0, usb.datetime_to_filetime(update), 3, 3)])
+
+    def test_keys_of_one_device_are_not_a_cluster(self):
+        plugged_in = datetime(2014, 1, 1, 12)
+        mask, clusters = self.find_clusters([(0, 0, plugged_in), (0, 0, plugged_in), (0, 0, plugged_in),
+                                             (0, 1, datetime(2013, 6, 1)), (0, 2, datetime(2013, 7, 1))])
+
+        self.assertEqual(mask, [False] * 5)
+        self.assertEqual(clusters, [])
+
+    def test_hosts_are_clustered_separately(self):
+        update = datetime(2014, 1, 1, 12)
+        mask, clusters = self.find_clusters([(0, 0, update), (0, 1, update), (1, 0, update), (1, 1, update)])
+
+        self.assertEqual(mask, [False] * 4)
+        self.assertEqual(clusters, [])
+
+
+class SnapshotDiffTest(unittest.TestCase):
+    """Two versions of a SYSTEM hive, the second with a device plugged in or a device key rewritten"""
+
+    def setUp(self):
+        self.old = usb.get_snapshot_subtrees(build_system_hive())
+
+    def diff(self, registry):
+        new = usb.get_snapshot_subtrees(registry, self.old)
+        deltas, skipped = usb.diff_snapshots(self.old, new, 'old', 'new')
+        return new, [(delta['change'], delta['subtree'], delta['device'], delta['detail']) for delta in deltas], skipped
+
+    def test_added_device_is_reported(self):
+        new, deltas, skipped = self.diff(build_system_hive(devices=[
+            ('SanDisk', 'Cruzer', '1.0', 'AA11', 'VID_0781&PID_5530', '7&abc&0', 'E:'),
+            ('Kingston', 'DT', 'PMAP', 'BB22', 'VID_0951&PID_1643', '7&def&0', 'F:')]))
+
+        self.assertEqual(deltas, [
+            ('added', 'ControlSet001\\Enum\\USBSTOR', 'Disk&Ven_Kingston&Prod_DT&Rev_PMAP\\BB22&0', []),
+            ('added', 'ControlSet001\\Enum\\USB', 'VID_0951&PID_1643\\BB22', []),
+            ('added', 'ControlSet001\\Control\\DeviceClasses\\{53f56307-b6bf-11d0-94f2-00a0c91efb8b}',
+             '##?#USBSTOR#Disk&Ven_Kingston&Prod_DT&Rev_PMAP#BB22&0#{53f56307-b6bf-11d0-94f2-00a0c91efb8b}', []),
+            ('added', 'MountedDevices', '\\??\\Volume{BB22-2222-3333-4444-555555555555}', []),
+            ('added', 'MountedDevices', '\\DosDevices\\F:', [])])
+        self.assertEqual(skipped, 0)
+
+        # The subtree of the device that was already there is reused from the previous version
+        name = 'disk&ven_sandisk&prod_cruzer&rev_1.0'
+        self.assertIs(new['ControlSet001\\Enum\\USBSTOR'][1].subkeys[name],
+                      self.old['ControlSet001\\Enum\\USBSTOR'][1].subkeys[name])
+
+    def test_unchanged_hive_is_skipped(self):
+        new, deltas, skipped = self.diff(build_system_hive())
+
+        self.assertEqual(deltas, [])
+        self.assertEqual(skipped, len(self.old))
+
+    def test_rewritten_device_key_is_reported(self):
+        registry = build_system_hive()
+        disk = registry.open('ControlSet001\\Enum\\USBSTOR').subkeys()[0]
+        disk.subkeys()[0]._values = [FakeValue('ParentIdPrefix', '7&fff&0')]
+        disk.subkeys()[0]._timestamp = disk._timestamp = datetime(2014, 2, 1)
+
+        new, deltas, skipped = self.diff(registry)
+
+        self.assertEqual(deltas, [('changed', 'ControlSet001\\Enum\\USBSTOR',
+                                   'Disk&Ven_SanDisk&Prod_Cruzer&Rev_1.0\\AA11&0', ['timestamp', 'values'])])
+        self.assertEqual(skipped, len(self.old) - 1)
+
+
+class ActiveControlSetTest(unittest.TestCase):
+    """A SYSTEM hive whose inactive ControlSet002 holds a device that is missing from the active ControlSet001"""
+
+    def setUp(self):
+        usb.quiet_mode = True
+        usb.active_control_set_mode = True
+        usb.usb_devices = []
+
+        device = ('SanDisk', 'Cruzer', '1.0', 'AA11', 'VID_0781&PID_5530', '7&abc&0', 'E:')
+        missing = ('Kingston', 'DT', 'PMAP', 'BB22', 'VID_0951&PID_1643', '7&def&0', 'F:')
+        active = build_system_hive(devices=[device])
+        inactive = build_system_hive(control_sets=('ControlSet002',), devices=[device, missing])
+        self.registry = FakeRegistry([active.open('ControlSet001'), inactive.open('ControlSet002'),
+                                      inactive.open('MountedDevices'), inactive.open('Select')])
+
+    def tearDown(self):
+        usb.active_control_set_mode = False
+
+    def test_only_the_active_control_set_is_processed(self):
+        self.assertEqual(usb.get_control_sets(self.registry), ['ControlSet001'])
+
+        usb.active_control_set_mode = False
+        self.assertEqual(usb.get_control_sets(self.registry), ['ControlSet001', 'ControlSet002'])
+
+    def test_missing_select_key_processes_every_control_set(self):
+        registry = FakeRegistry([self.registry.open('ControlSet001'), self.registry.open('ControlSet002')])
+
+        self.assertEqual(usb.get_active_control_set(registry), None)
+        self.assertEqual(usb.get_control_sets(registry), ['ControlSet001', 'ControlSet002'])
+
+    def test_usb_stor_key_names_are_compared(self):
+        self.assertEqual(usb.get_usb_stor_key_names(self.registry, 'ControlSet002') -
+                         usb.get_usb_stor_key_names(self.registry, 'ControlSet001'),
+                         set([('disk&ven_kingston&prod_dt&rev_pmap', 'bb22&0')]))
+        self.assertEqual(usb.get_usb_stor_key_names(self.registry, 'ControlSet003'), set())
+
+    def test_device_only_in_an_inactive_control_set_is_added(self):
+        usb.process_registry_hive(None, Registry.HiveType.SYSTEM, [('', 'SYSTEM', self.registry)])
+
+        devices = dict((device.serial_number, device) for device in usb.usb_devices)
+        self.assertEqual(sorted(devices.keys()), ['AA11', 'BB22'])
+        self.assertEqual(set(devices['AA11'].control_sets.values()), set(['ControlSet001']))
+        self.assertEqual(set(devices['BB22'].control_sets.values()), set(['ControlSet002']))
+        self.assertEqual(devices['BB22'].vid, 'VID_0951')
+        self.assertEqual(devices['BB22'].drive_letter, 'F:')
+
+
+class FindTest(unittest.TestCase):
+    """Targeted lookups of the devices of a SYSTEM hive"""
+
+    DEVICES = [('SanDisk', 'Cruzer', '1.0', 'AA11', 'VID_0781&PID_5530', '7&abc&0', 'E:'),
+               ('Kingston', 'DT', 'PMAP', 'BB22', 'VID_0951&PID_1643', '7&def&0', 'F:')]
+
+    def setUp(self):
+        usb.quiet_mode = True
+        usb.usb_devices = []
+        usb.find_identifiers.clear()
+        usb.find_found.clear()
+
+    def tearDown(self):
+        usb.find_mode = False
+        usb.find_terms = []
+        usb.find_identifiers.clear()
+        usb.find_found.clear()
+
+    def find(self, terms, hives):
+        usb.find_mode = True
+        usb.find_terms = usb.parse_find_terms(terms)
+        usb.process_registry_hive(None, Registry.HiveType.SYSTEM, [('', 'SYSTEM', hive) for hive in hives])
+        return sorted((device.vendor, device.serial_number) for device in usb.usb_devices)
+
+    def test_terms_are_normalised(self):
+        terms = ['0781:5530', 'vid_0951&pid_1643', '{0000AA11-2222-3333-4444-555555555555}', '1A2B-3C4D', 'BB22']
+
+        self.assertEqual(usb.parse_find_terms(terms),
+                         [('vid_pid', '0781:5530', 'VID_0781&PID_5530'),
+                          ('vid_pid', 'vid_0951&pid_1643', 'VID_0951&PID_1643'),
+                          ('guid', '{0000AA11-2222-3333-4444-555555555555}', '0000aa11-2222-3333-4444-555555555555'),
+                          ('volume_serial', '1A2B-3C4D', str(0x1A2B3C4D)),
+                          ('serial', 'BB22', 'bb22')])
+        self.assertEqual(usb.find_identifiers, set(['bb22']))
+
+    def test_serial_key_and_parent_id_prefix_are_hits(self):
+        usb.find_identifiers.update(['aa11', '7&def&0'])
+        registry = build_system_hive(devices=self.DEVICES)
+        keys = [disk.subkeys()[0] for disk in registry.open('ControlSet001\\Enum\\USBSTOR').subkeys()]
+
+        self.assertEqual([usb.get_find_hit(key) for key in keys], ['aa11', '7&def&0'])
+
+    def test_only_the_matching_devices_are_extracted(self):
+        self.assertEqual(self.find(['BB22'], [build_system_hive(devices=self.DEVICES)]), [('Ven_Kingston', 'BB22')])
+
+    def test_vid_pid_term_is_resolved(self):
+        self.assertEqual(self.find(['0951:1643'], [build_system_hive(devices=self.DEVICES)]),
+                         [('Ven_Kingston', 'BB22')])
+
+    def test_volume_guid_term_is_resolved(self):
+        registry = build_system_hive(devices=self.DEVICES)
+        mounted_devices = FakeKey('MountedDevices', values=[FakeValue(
+            '\\??\\Volume{0000aa11-2222-3333-4444-555555555555}',
+            '_??_USBSTOR#Disk&Ven_SanDisk&Prod_Cruzer&Rev_1.0#7&abc&0#{53f56307-b6bf-11d0-94f2-00a0c91efb8b}')])
+        registry = FakeRegistry([registry.open('ControlSet001'), mounted_devices, registry.open('Select')])
+
+        self.assertEqual(self.find(['{0000AA11-2222-3333-4444-555555555555}'], [registry]), [('Ven_SanDisk', 'AA11')])
+
+    def test_terms_are_looked_for_in_every_system_hive(self):
+        other = build_system_hive(devices=[('Lexar', 'JumpDrive', '1.0', 'BB22', 'VID_05DC&PID_A781', '7&fed&0', 'G:')])
+
+        self.assertEqual(self.find(['BB22'], [build_system_hive(devices=self.DEVICES), other]),
+                         [('Ven_Kingston', 'BB22'), ('Ven_Lexar', 'BB22')])
+
+
+class DeviceListTest(unittest.TestCase):
+    """An allowlist/watchlist in the text and prebuilt formats"""
+
+    def setUp(self):
+        usb.quiet_mode = True
+        self.directory = tempfile.mkdtemp()
+        self.text_path = os.path.join(self.directory, 'list.txt')
+        self.write_list(['# Approved devices', 'AA11,0781,5530', '', 'bb22', '*\tVID_0951\tPID_1643'])
+        self.lists = []
+
+    def tearDown(self):
+        usb.allowlist = None
+        usb.watchlist = None
+        for device_list in self.lists:
+            device_list.close()
+        shutil.rmtree(self.directory)
+
+    def write_list(self, lines):
+        with open(self.text_path, 'wb') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def load_list(self, path):
+        device_list = usb.DeviceList(path)
+        self.lists.append(device_list)
+        return device_list
+
+    def build_device(self, serial_number, vid, pid):
+        device = usb.UsbDevice()
+        device.serial_number = serial_number
+        device.vid = vid
+        device.pid = pid
+        return device
+
+    def test_entries_are_matched(self):
+        device_list = self.load_list(self.text_path)
+
+        self.assertEqual(len(device_list), 3)
+        self.assertIn(usb.get_device_list_digest('aa11', 'VID_0781', 'PID_5530'), device_list)
+        self.assertIn(usb.get_device_list_digest('BB22', '', ''), device_list)
+        self.assertIn(usb.get_device_list_digest('*', '0951', '1643'), device_list)
+        self.assertNotIn(usb.get_device_list_digest('aa11', '', ''), device_list)
+
+    def test_prebuilt_list_matches_the_text_list(self):
+        prebuilt_path = os.path.join(self.directory, 'list.bin')
+        usb.build_device_list(self.text_path, prebuilt_path)
+        text_list = self.load_list(self.text_path)
+        prebuilt_list = self.load_list(prebuilt_path)
+
+        self.assertNotEqual(prebuilt_list.data, None)
+        self.assertEqual([prebuilt_list[index] for index in range(len(prebuilt_list))],
+                         [text_list[index] for index in range(len(text_list))])
+        self.assertIn(usb.get_device_list_digest('AA11', '0781', '5530'), prebuilt_list)
+        self.assertNotIn(usb.get_device_list_digest('CC33', '', ''), prebuilt_list)
+
+    def test_truncated_prebuilt_list_is_rejected(self):
+        prebuilt_path = os.path.join(self.directory, 'list.bin')
+        usb.build_device_list(self.text_path, prebuilt_path)
+        with open(prebuilt_path, 'rb+') as f:
+            f.truncate(os.path.getsize(prebuilt_path) - 1)
+
+        self.assertRaises(ValueError, usb.DeviceList, prebuilt_path)
+
+    def test_malformed_entry_is_rejected(self):
+        self.write_list(['AA11,0781'])
+
+        self.assertRaises(ValueError, usb.DeviceList, self.text_path)
+
+    def test_watchlist_takes_precedence(self):
+        usb.allowlist = self.load_list(self.text_path)
+        watchlist_path = os.path.join(self.directory, 'watchlist.txt')
+        with open(watchlist_path, 'wb') as f:
+            f.write('BB22\n')
+        usb.watchlist = self.load_list(watchlist_path)
+
+        self.assertEqual(usb.get_device_policy(self.build_device('AA11', 'VID_0781', 'PID_5530')), 'approved')
+        self.assertEqual(usb.get_device_policy(self.build_device('DD44', 'VID_0951', 'PID_1643')), 'approved')
+        self.assertEqual(usb.get_device_policy(self.build_device('AA11', 'VID_0951', 'PID_0001')), 'unknown')
+        self.assertEqual(usb.get_device_policy(self.build_device('BB22', 'VID_0781', 'PID_5530')), 'watchlisted')
+
+
+class DeviceIndexJoinTest(unittest.TestCase):
+    """The usbflags, DeviceContainers and WPDBUSENUM keys joined to the devices of a SYSTEM hive"""
+
+    def setUp(self):
+        usb.quiet_mode = True
+        usb.usb_devices = []
+
+        registry = build_system_hive(devices=[
+            ('SanDisk', 'Cruzer', '1.0', 'AA11', 'VID_0781&PID_5530', '7&abc&0', 'E:'),
+            ('Kingston', 'DT', 'PMAP', 'BB22', 'VID_0951&PID_1643', '7&def&0', 'F:'),
+            ('SanDisk', 'Cruzer', '1.0', 'CC33', 'VID_0781&PID_5530', '7&123&0', 'G:')])
+        enum = registry.open('ControlSet001\\Enum')
+        control = registry.open('ControlSet001\\Control')
+
+        usb_flags = FakeKey('usbflags', [FakeKey('078155300100', timestamp=datetime(2013, 5, 1)),
+                                         FakeKey('IgnoreHWSerNum0781', timestamp=datetime(2013, 6, 1))])
+        containers = FakeKey('DeviceContainers', [FakeKey('{c0000000-0000-0000-0000-000000000001}', [
+            FakeKey('BaseContainers', [FakeKey('{c0000000-0000-0000-0000-000000000001}',
+                                               values=[FakeValue('USB\\VID_0951&PID_1643\\BB22', '')])])],
+            timestamp=datetime(2013, 7, 1))])
+        wpd_bus_enum = FakeKey('SWD', [FakeKey('WPDBUSENUM', [FakeKey(
+            '_??_USBSTOR#Disk&Ven_SanDisk&Prod_Cruzer&Rev_1.0#AA11&0#{53f56307-b6bf-11d0-94f2-00a0c91efb8b}',
+            values=[FakeValue('FriendlyName', 'E:\\'),
+                    FakeValue('ContainerID', '{d0000000-0000-0000-0000-000000000002}')],
+            timestamp=datetime(2013, 8, 1))])])
+
+        control_set = FakeKey('ControlSet001', [FakeKey('Enum', enum.subkeys() + [wpd_bus_enum]),
+                                                FakeKey('Control', control.subkeys() + [usb_flags, containers])])
+        registry = FakeRegistry([control_set, registry.open('MountedDevices'), registry.open('Select')])
+
+        usb.process_registry_hive(None, Registry.HiveType.SYSTEM, [('', 'SYSTEM', registry)])
+        self.devices = dict((device.serial_number, device) for device in usb.usb_devices)
+
+    def test_usbflags_timestamp_is_shared_by_the_model(self):
+        self.assertEqual(self.devices['AA11'].usbflags_datetime, datetime(2013, 5, 1))
+        self.assertEqual(self.devices['CC33'].usbflags_datetime, datetime(2013, 5, 1))
+        self.assertEqual(self.devices['BB22'].usbflags_datetime, datetime.min)
+        self.assertEqual(self.devices['AA11'].control_sets['usbflags_datetime'], 'ControlSet001')
+
+    def test_container_is_joined_on_the_device_instance_id(self):
+        self.assertEqual(self.devices['BB22'].container_id, '{c0000000-0000-0000-0000-000000000001}')
+        self.assertEqual(self.devices['BB22'].device_containers_datetime, datetime(2013, 7, 1))
+        self.assertEqual(self.devices['CC33'].container_id, '')
+
+    def test_wpd_bus_enum_is_joined_on_the_serial_number(self):
+        self.assertEqual(self.devices['AA11'].wpdbusenum_datetime, datetime(2013, 8, 1))
+        self.assertEqual(self.devices['AA11'].wpd_friendly_name, 'E:\\')
+        self.assertEqual(self.devices['AA11'].container_id, '{d0000000-0000-0000-0000-000000000002}')
+        self.assertEqual(self.devices['CC33'].wpdbusenum_datetime, datetime.min)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,24 @@ from enum import Enum
 from datetime import datetime, timedelta
 import re
 import csv
+import heapq
+import hashlib
+import io
+import json
+import time
+import cProfile
+import pickle
+import sqlite3
+import tempfile
+import mmap
+import bisect
+import struct
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Enums #######################################################################
 
@@ -41,6 +59,128 @@ usb_devices = []
 debug_mode = False
 quiet_mode = False
 os_version = WindowsVersions.NotDefined
+string_table = []
+string_ids = {}
+manifest_mode = False
+manifest = OrderedDict()
+profile_mode = False
+profile_directory = None
+profile_records = []
+profile_counters = {'hives_opened': 0, 'keys_visited': 0, 'values_decoded': 0, 'devices_matched': 0}
+profile_matched = set()
+recover_mode = False
+recover_data = {}
+replay_mode = True
+active_control_set_mode = False
+find_mode = False
+find_terms = []
+find_identifiers = set()
+find_found = set()
+allowlist = None
+watchlist = None
+violations_only = False
+
+# The device timestamp fields that make up the timeline, in output order for identical timestamps
+TIMELINE_SOURCES = [('USBSTOR', 'usb_stor_datetime'),
+                    ('USBSTOR Properties (Install Date)', 'usbstor_datetime64'),
+                    ('USBSTOR Properties (First Install Date)', 'usbstor_datetime65'),
+                    ('USBSTOR Properties (Last Arrival Date)', 'usbstor_datetime66'),
+                    ('USBSTOR Properties (Last Removal Date)', 'usbstor_datetime67'),
+                    ('DeviceClasses (53f56307-b6bf-11d0-94f2-00a0c91efb8b)', 'device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b'),
+                    ('DeviceClasses (10497b1b-ba51-44e5-8318-a65c837b6661)', 'device_classes_datetime_10497b1bba5144e58318a65c837b6661'),
+                    ('Enum\\USB VIDPID', 'vid_pid_datetime'),
+                    ('Control\\usbflags (Model First Connected)', 'usbflags_datetime'),
+                    ('Control\\DeviceContainers', 'device_containers_datetime'),
+                    ('Enum\\SWD\\WPDBUSENUM', 'wpdbusenum_datetime'),
+                    ('Install', 'install_datetime')]
+
+# The timestamp fields that can be queried, the device fields plus the MountPoints2/EMDMgmt entries
+QUERY_FIELDS = [attribute for source, attribute in TIMELINE_SOURCES] + ['mountpoint2', 'emdmgmt']
+
+# The number of timeline events sorted in memory at once, a larger timeline is sorted in
+# runs that are written to temporary files and merged
+TIMELINE_RUN_SIZE = 100000
+
+# The key last written timestamps that an update process can rewrite en masse. Timestamps
+# less than MASS_UPDATE_WINDOW (100ns intervals) apart are clustered and a cluster marks its
+# fields as low confidence when it spans at least MASS_UPDATE_MIN_DEVICES devices and either
+# MASS_UPDATE_MIN_FRACTION of the host's devices or MASS_UPDATE_MIN_KEYS keys. The floor
+# alone would flag the handful of hubs and built in devices that are enumerated at boot
+MASS_UPDATE_FIELDS = ['usb_stor_datetime', 'vid_pid_datetime',
+                      'device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b',
+                      'device_classes_datetime_10497b1bba5144e58318a65c837b6661']
+MASS_UPDATE_WINDOW = 10000000
+MASS_UPDATE_MIN_DEVICES = 3
+MASS_UPDATE_MIN_FRACTION = 0.5
+MASS_UPDATE_MIN_KEYS = 20
+
+# The device string fields that are dictionary encoded in a DeviceTable
+TABLE_CATEGORY_FIELDS = ['vendor', 'product', 'version', 'serial_number', 'vid', 'pid']
+
+# The fixed leading columns of the CSV output, used when loading it back in
+CSV_DEVICE_COLUMNS = ['vendor', 'product', 'version', 'serial_number', 'vid', 'pid', 'parent_prefix_id',
+                      'drive_letter', 'volume_name', 'guid', 'mountpoint', 'install_datetime', 'usb_stor_datetime',
+                      'usbstor_datetime64', 'usbstor_datetime65', 'usbstor_datetime66', 'usbstor_datetime67',
+                      'device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b',
+                      'device_classes_datetime_10497b1bba5144e58318a65c837b6661', 'vid_pid_datetime']
+
+# The CSV columns after the fixed leading columns, with the device attribute they are loaded back into.
+# They are found by their header name as files written by earlier versions lack some of them
+CSV_EXTRA_COLUMNS = [('Source', 'source'),
+                     ('ControlSets', None),
+                     ('Policy', 'policy'),
+                     ('LowConfidence', 'low_confidence'),
+                     ('ContainerID', 'container_id'),
+                     ('Control\\usbflags (Model First Connected)', 'usbflags_datetime'),
+                     ('Control\\usbflags', 'usbflags_datetime'),
+                     ('Control\\DeviceContainers', 'device_containers_datetime'),
+                     ('Enum\\SWD\\WPDBUSENUM', 'wpdbusenum_datetime'),
+                     ('WPD Friendly Name', 'wpd_friendly_name')]
+
+# The device fields held as indexed columns by the DeviceStore, used for the lookups
+DEVICE_STORE_COLUMNS = ['serial_number', 'vendor', 'product', 'version', 'parent_prefix_id', 'guid', 'mountpoint']
+
+# Number of 100ns intervals between 1601-01-01 and 1970-01-01
+FILETIME_EPOCH_DELTA = 116444736000000000
+
+# Hive layout used when recovering deleted keys, the cell offsets are relative to the first hbin
+HIVE_BINS_OFFSET = 0x1000
+HBIN_HEADER_SIZE = 0x20
+NK_NAME_OFFSET = 0x4C
+NK_COMP_NAME = 0x0020
+VK_COMP_NAME = 0x0001
+MAX_RECOVERED_VALUES = 64
+REGEX_GUID_KEY = '^\{[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\}$'
+
+# The SYSTEM subtrees compared between hive versions, with the depth of the device
+# level keys below them. MountedDevices is at depth 0 as its devices are values
+DIFF_CONTROL_SET_SUBTREES = [('Enum\\USBSTOR', 2),
+                             ('Enum\\USB', 2),
+                             ('Control\\DeviceClasses\\{53f56307-b6bf-11d0-94f2-00a0c91efb8b}', 1),
+                             ('Control\\DeviceClasses\\{10497b1b-ba51-44e5-8318-a65c837b6661}', 1)]
+DIFF_ROOT_SUBTREES = [('MountedDevices', 0)]
+
+# Find terms, anything else is treated as a device serial number (or ParentIdPrefix)
+REGEX_FIND_VID_PID = '^(?:vid_)?([0-9a-f]{4})(?:&pid_|:)([0-9a-f]{4})$'
+REGEX_FIND_GUID = '^\\{?([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\\}?$'
+REGEX_FIND_VOLUME_SERIAL = '^([0-9a-f]{4})-([0-9a-f]{4})$'
+
+# Prebuilt device list layout, a header (magic, entry count) followed by the sorted MD5 digests of the entries
+DEVICE_LIST_MAGIC = 'USBDLIST'
+DEVICE_LIST_HEADER_SIZE = 16
+DEVICE_LIST_DIGEST_SIZE = 16
+
+# Base block and transaction log layout, the old format logs hold a dirty sector
+# vector (DIRT) and the new format logs (Windows 8.1+) hold log entries (HvLE)
+BASE_BLOCK_SIZE = 512
+LOG_SECTOR_SIZE = 512
+LOG_ENTRY_HEADER_SIZE = 40
+LOG_EXTENSIONS = ['.log', '.log1', '.log2']
+MARVIN32_SEED = 0x82EF4D887A4E55C5
+
+# Recovered key timestamps outside this range (1990 - 2100) are treated as garbage
+MIN_RECOVERED_FILETIME = 94354848000000000
+MAX_RECOVERED_FILETIME = 157766016000000000
 
 # Objects #####################################################################
 
@@ -86,77 +226,300 @@ class UsbDevice():
         self.usbstor_datetime67 = datetime.min
         self.mountpoint2 = []
         self.emdmgmt = []
+        self.source = ''
+        self.control_sets = {}
+        self.policy = ''
+        self.low_confidence = []
+        self.container_id = ''
+        self.usbflags_datetime = datetime.min
+        self.device_containers_datetime = datetime.min
+        self.wpdbusenum_datetime = datetime.min
+        self.wpd_friendly_name = ''
 
 
-# System Hive Methods #########################################################
+class ProfiledRegistry():
+    """Wraps a Registry object so that the keys it returns count the keys visited and values decoded"""
+    def __init__(self, registry):
+        self.registry = registry
 
-def process(registry_path, output, format):
-    """Processing entry point"""
+    def __getattr__(self, name):
+        return getattr(self.registry, name)
 
-    # Process the hives in a specific order so that the
-    # data can be correctly matched between the hives
-    process_registry_hive(registry_path, Registry.HiveType.SYSTEM)
-    process_registry_hive(registry_path, Registry.HiveType.SOFTWARE)
-    process_registry_hive(registry_path, Registry.HiveType.NTUSER)
+    def root(self):
+        return ProfiledKey(self.registry.root())
 
-    # Loop through the files looking for the *.log files
-    for root, dirs, files in os.walk(registry_path):
-        for f in files:
-            try:
-                file_name, ext = os.path.splitext(f)
-                if ext.lower() != ".log":
-                    continue
+    def open(self, path):
+        key = self.registry.open(path)
+        profile_counters['keys_visited'] += 1
+        return ProfiledKey(key)
 
-                process_log_file(os.path.join(root, f))
 
-            except Exception as err:
-                traceback.print_exc(file=sys.stdout)
-                traceback.print_stack()
-                print(err.args)
-                print(err.message)
+class ProfiledKey():
+    """Wraps a RegistryKey object, counting the keys visited and values decoded"""
+    def __init__(self, key):
+        self.key = key
+
+    def __getattr__(self, name):
+        return getattr(self.key, name)
+
+    def subkeys(self):
+        subkeys = self.key.subkeys()
+        profile_counters['keys_visited'] += len(subkeys)
+        return [ProfiledKey(k) for k in subkeys]
+
+    def find_key(self, path):
+        key = self.key.find_key(path)
+        if key is None:
+            return None
+        profile_counters['keys_visited'] += 1
+        return ProfiledKey(key)
+
+    def values(self):
+        values = self.key.values()
+        profile_counters['values_decoded'] += len(values)
+        return values
+
+    def value(self, name):
+        profile_counters['values_decoded'] += 1
+        return self.key.value(name)
+
+
+class DeviceStore():
+    """
+    List like store of USB devices that keeps the most recently used devices in
+    memory and spills the rest to a SQLite database, so the number of devices held
+    in memory is bounded by the cache size rather than the number of devices.
+
+    Devices are written back when they are evicted, so a device returned from the
+    store can be modified in place until cache_size other devices have been used.
+    A new device is always written, and a device read from the database is only
+    written back if it no longer pickles to the same data as when it was read, so
+    reading the devices does not rewrite them
+    """
+    def __init__(self, cache_size, path=None):
+        self.cache_size = max(cache_size, 1)
+        self.cache = OrderedDict()
+        self.dirty = set()
+        self.written = {}
+        self.count = 0
+        self.temporary = path is None
+        if self.temporary:
+            handle, path = tempfile.mkstemp(suffix='.db', prefix='usbdeviceforensics')
+            os.close(handle)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('DROP TABLE IF EXISTS devices')
+        self.connection.execute('CREATE TABLE devices (id INTEGER PRIMARY KEY, ' +
+                                ', '.join([name + ' TEXT' for name in DEVICE_STORE_COLUMNS]) + ', data BLOB)')
+        for name in ['serial_number', 'guid', 'mountpoint']:
+            self.connection.execute('CREATE INDEX devices_' + name + ' ON devices (' + name + ')')
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError('Device index out of range')
+
+        device = self.cache.pop(index, None)
+        if device is None:
+            row = self.connection.execute('SELECT data FROM devices WHERE id = ?', (index,)).fetchone()
+            device = pickle.loads(str(row[0]))
+            for attribute in TABLE_CATEGORY_FIELDS:
+                setattr(device, attribute, intern_string(getattr(device, attribute)))
+            # Pickled again as the shared strings differ once loaded, so an unmodified device compares equal
+            self.written[index] = pickle.dumps(device, pickle.HIGHEST_PROTOCOL)
+
+        self.add_to_cache(index, device)
+        return device
+
+    def append(self, device):
+        """Adds a new device to the store"""
+        index = self.count
+        self.count += 1
+        self.connection.execute('INSERT INTO devices (id) VALUES (?)', (index,))
+        self.add_to_cache(index, device)
+        self.dirty.add(index)
+
+    def find(self, **kwargs):
+        """
+        Returns the devices whose columns (see DEVICE_STORE_COLUMNS) match all of the supplied
+        values. The cached devices are matched on their current values in memory, as they may
+        have changed since they were last written, and the database only answers for the
+        devices that have been evicted
+        """
+        names = sorted(kwargs.keys())
+        indexes = [index for index, device in self.cache.items()
+                   if all(getattr(device, name) == kwargs[name] for name in names)]
+
+        rows = self.connection.execute('SELECT id FROM devices WHERE ' +
+                                       ' AND '.join([name + ' = ?' for name in names]) + ' ORDER BY id',
+                                       [kwargs[name] for name in names]).fetchall()
+        indexes.extend([row[0] for row in rows if row[0] not in self.cache])
+
+        return [self[index] for index in sorted(indexes)]
+
+    def add_to_cache(self, index, device):
+        """Makes the device the most recently used, evicting the least recently used devices"""
+        self.cache[index] = device
+        while len(self.cache) > self.cache_size:
+            evicted_index, evicted_device = self.cache.popitem(last=False)
+            self.write_device(evicted_index, evicted_device)
+            self.written.pop(evicted_index, None)
+
+    def write_device(self, index, device):
+        """Writes a device and its lookup columns to the database if it is new or has been modified
+        since it was last written, returning True if it was written"""
+        data = pickle.dumps(device, pickle.HIGHEST_PROTOCOL)
+        if index not in self.dirty and self.written.get(index) == data:
+            return False
+
+        values = [getattr(device, name) for name in DEVICE_STORE_COLUMNS]
+        values.append(sqlite3.Binary(data))
+        values.append(index)
+        self.connection.execute('UPDATE devices SET ' +
+                                ', '.join([name + ' = ?' for name in DEVICE_STORE_COLUMNS]) +
+                                ', data = ? WHERE id = ?', values)
+        self.dirty.discard(index)
+        self.written[index] = data
+        return True
+
+    def commit(self):
+        """Commits the devices written since the last commit, called once per stage rather than per write"""
+        self.connection.commit()
+
+    def flush(self):
+        """Writes the new and modified cached devices to the database so that the lookup columns are current"""
+        for index, device in self.cache.items():
+            self.write_device(index, device)
+        self.connection.commit()
+
+    def close(self):
+        """Closes the database, deleting it if it was a temporary file"""
+        self.connection.close()
+        if self.temporary:
+            os.remove(self.path)
+
+
+class DeviceList():
+    """
+    Sorted array of the MD5 digests of the entries in an allowlist/watchlist, so a
+    lookup is a binary search. A prebuilt list (see build_device_list) is memory
+    mapped rather than read, a plain text list is hashed and sorted in memory
+    """
+    def __init__(self, path):
+        self.data = None
+        self.digests = None
+
+        with open(path, 'rb') as f:
+            magic = f.read(len(DEVICE_LIST_MAGIC))
+            if magic == DEVICE_LIST_MAGIC:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data is not None:
+            self.count = struct.unpack_from('<Q', self.data, len(DEVICE_LIST_MAGIC))[0]
+            if len(self.data) < DEVICE_LIST_HEADER_SIZE + self.count * DEVICE_LIST_DIGEST_SIZE:
+                self.close()
+                raise ValueError('The device list is truncated: ' + path)
+        else:
+            self.digests = read_device_list_digests(path)
+            self.count = len(self.digests)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if self.data is None:
+            return self.digests[index]
+
+        offset = DEVICE_LIST_HEADER_SIZE + index * DEVICE_LIST_DIGEST_SIZE
+        return self.data[offset:offset + DEVICE_LIST_DIGEST_SIZE]
+
+    def __contains__(self, digest):
+        index = bisect.bisect_left(self, digest)
+        return index < self.count and self[index] == digest
+
+    def close(self):
+        """Unmaps a prebuilt list"""
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+class DeletedKey():
+    """Encapsulates a key (nk) record recovered from a free cell of a hive"""
+    def __init__(self):
+        self.offset = 0
+        self.name = ''
+        self.parent = 0
+        self.timestamp = datetime.min
+        self.values_count = 0
+        self.values_offset = 0
+
+
+class SubtreeHash():
+    """Merkle hash of a registry key, covering its name, timestamp, values and the hashes of its sub keys"""
+    def __init__(self):
+        self.name = ''
+        self.timestamp = datetime.min
+        self.subkey_count = 0
+        self.value_count = 0
+        self.digest = ''
+        self.values = {}
+        self.subkeys = {}
+
+
+# System Hive Methods #########################################################
+
+def process(registry_path, output, format, timeline_format=None):
+    """Processing entry point"""
+
+    if find_mode is True:
+        process_find(registry_path)
+    else:
+        # Process the hives in a specific order so that the
+        # data can be correctly matched between the hives
+        process_registry_hive(registry_path, Registry.HiveType.SYSTEM)
+        process_registry_hive(registry_path, Registry.HiveType.SOFTWARE)
+        process_registry_hive(registry_path, Registry.HiveType.NTUSER)
+        process_log_files(registry_path)
+
+    if allowlist is not None or watchlist is not None:
+        apply_device_lists()
 
     output_data_to_console()
 
     if output is None:
         return
 
-    if format == "csv":
+    if timeline_format is not None:
+        output_timeline_to_file(output, timeline_format)
+    elif format == "csv":
         output_data_to_file_csv(output)
     else:
         output_data_to_file_text(output)
 
-def process_registry_hive(registry_path, hive_type):
-    """Generic method used to process a single registry hive type"""
+
+def process_log_files(registry_path):
+    """Processes the setupapi logs, which are the *.log files"""
     for root, dirs, files in os.walk(registry_path):
         for f in files:
             try:
-                registry = load_file(os.path.join(root, f))
-                if registry is None:
+                file_name, ext = os.path.splitext(f)
+                if ext.lower() != ".log":
+                    continue
+
+                # XP era hive transaction logs (SYSTEM.LOG, NTUSER.DAT.LOG) are not setupapi logs
+                if is_transaction_log(read_base_block(os.path.join(root, f))):
                     continue
 
-                if registry.hive_type() == Registry.HiveType.SYSTEM and hive_type == Registry.HiveType.SYSTEM:
-                    if quiet_mode is False:
-                        print('Hive name: ' + registry.hive_name())
-                        print('Hive type: ' + registry.hive_type().value)
-                    process_usb_stor(registry)
-                    process_usb_stor_properties(registry)
-                    process_usb(registry)
-                    process_mounted_devices(registry)
-                    process_device_classes(registry)
-
-                if registry.hive_type() == Registry.HiveType.SOFTWARE and hive_type == Registry.HiveType.SOFTWARE:
-                    if quiet_mode is False:
-                        print('Hive name: ' + registry.hive_name())
-                        print('Hive type: ' + registry.hive_type().value)
-                    get_os_version(registry)
-                    process_windows_portable_devices(registry)
-                    process_emd_mgmt(registry)
-
-                if registry.hive_type() == Registry.HiveType.NTUSER and hive_type == Registry.HiveType.NTUSER:
-                    if quiet_mode is False:
-                        print('Hive name: ' + registry.hive_name())
-                        print('Hive type: ' + registry.hive_type().value)
-                    process_mountpoints2(registry, f)
+                run_stage('process_log_file', f, process_log_file, os.path.join(root, f))
 
             except Exception as err:
                 traceback.print_exc(file=sys.stdout)
@@ -165,6 +528,74 @@ def process_registry_hive(registry_path, hive_type):
                 print(err.message)
 
 
+def process_registry_hive(registry_path, hive_type, hives=None):
+    """Generic method used to process a single registry hive type. The hives are loaded from
+    the registry path, unless the already loaded (directory, file name, registry) are supplied"""
+    if hives is None:
+        hives = load_hives(registry_path)
+
+    for root, f, registry in hives:
+        try:
+            if registry.hive_type() == Registry.HiveType.SYSTEM and hive_type == Registry.HiveType.SYSTEM:
+                if quiet_mode is False:
+                    print('Hive name: ' + registry.hive_name())
+                    print('Hive type: ' + registry.hive_type().value)
+                if find_mode is True:
+                    # The find terms are looked for afresh in each SYSTEM hive
+                    find_found.clear()
+                    run_stage('resolve_find_terms', f, resolve_find_terms, registry)
+                run_stage('process_usb_stor', f, process_usb_stor, registry)
+                run_stage('process_usb_stor_properties', f, process_usb_stor_properties, registry)
+                run_stage('process_usb', f, process_usb, registry)
+                run_stage('process_mounted_devices', f, process_mounted_devices, registry)
+                run_stage('process_device_classes', f, process_device_classes, registry)
+                if active_control_set_mode is True:
+                    run_stage('process_inactive_control_sets', f, process_inactive_control_sets, registry)
+                if recover_mode is True:
+                    run_stage('recover_deleted_keys', f, recover_deleted_keys, os.path.join(root, f), hive_type,
+                              registry)
+                # Indexed once every device has been added, including the inactive/recovered devices
+                device_index = get_device_index()
+                run_stage('process_usb_flags', f, process_usb_flags, registry, device_index)
+                run_stage('process_device_containers', f, process_device_containers, registry, device_index)
+                run_stage('process_wpd_bus_enum', f, process_wpd_bus_enum, registry, device_index)
+                run_stage('detect_mass_updates', f, detect_mass_updates)
+
+            if registry.hive_type() == Registry.HiveType.SOFTWARE and hive_type == Registry.HiveType.SOFTWARE:
+                if quiet_mode is False:
+                    print('Hive name: ' + registry.hive_name())
+                    print('Hive type: ' + registry.hive_type().value)
+                run_stage('get_os_version', f, get_os_version, registry)
+                run_stage('process_windows_portable_devices', f, process_windows_portable_devices, registry)
+                run_stage('process_emd_mgmt', f, process_emd_mgmt, registry)
+
+            if registry.hive_type() == Registry.HiveType.NTUSER and hive_type == Registry.HiveType.NTUSER:
+                if quiet_mode is False:
+                    print('Hive name: ' + registry.hive_name())
+                    print('Hive type: ' + registry.hive_type().value)
+                run_stage('process_mountpoints2', f, process_mountpoints2, registry, f)
+                if recover_mode is True:
+                    run_stage('recover_deleted_keys', f, recover_deleted_keys, os.path.join(root, f), hive_type,
+                              registry)
+
+        except Exception as err:
+            traceback.print_exc(file=sys.stdout)
+            traceback.print_stack()
+            print(err.args)
+            print(err.message)
+
+
+def load_hives(registry_path):
+    """Yields the (directory, file name, registry) of each hive under the registry path, loading them one at a time"""
+    for root, dirs, files in os.walk(registry_path):
+        for f in files:
+            # Only the replayed copy of the hive being processed is kept for the recovery
+            recover_data.clear()
+            registry = load_file(os.path.join(root, f))
+            if registry is not None:
+                yield root, f, registry
+
+
 def output_data_to_console():
     """Outputs the data to StdOut and an output file if required"""
     for device in usb_devices:
@@ -180,6 +611,16 @@ def output_data_to_console():
         print("GUID : " + device.guid)
         print("Mountpoint: " + device.mountpoint)
         print("Disk Signature: " + device.disk_signature)
+        print("Source: " + device.source)
+        print("Control Sets: " + get_control_sets_text(device))
+        if len(device.policy) > 0:
+            print("Policy: " + device.policy)
+        if len(device.low_confidence) > 0:
+            print("Low Confidence: " + ', '.join(device.low_confidence))
+        if len(device.container_id) > 0:
+            print("Container ID: " + device.container_id)
+        if len(device.wpd_friendly_name) > 0:
+            print("WPD Friendly Name: " + device.wpd_friendly_name)
 
         if device.device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b != datetime.min:
             print("Device Classes Timestamp (53f56): " + device.device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b.strftime('%Y-%m-%dT%H:%M:%S'))
@@ -187,6 +628,12 @@ def output_data_to_console():
             print("Device Classes Timestamp (10497): " + device.device_classes_datetime_10497b1bba5144e58318a65c837b6661.strftime('%Y-%m-%dT%H:%M:%S'))
         if device.vid_pid_datetime != datetime.min:
             print("VID/PID Timestamp: " + device.vid_pid_datetime.strftime('%Y-%m-%dT%H:%M:%S'))
+        if device.usbflags_datetime != datetime.min:
+            print("usbflags Timestamp (Model First Connected): " + device.usbflags_datetime.strftime('%Y-%m-%dT%H:%M:%S'))
+        if device.device_containers_datetime != datetime.min:
+            print("DeviceContainers Timestamp: " + device.device_containers_datetime.strftime('%Y-%m-%dT%H:%M:%S'))
+        if device.wpdbusenum_datetime != datetime.min:
+            print("WPDBUSENUM Timestamp: " + device.wpdbusenum_datetime.strftime('%Y-%m-%dT%H:%M:%S'))
         if device.usb_stor_datetime != datetime.min:
             print("USBSTOR Timestamp: " + device.usb_stor_datetime.strftime('%Y-%m-%dT%H:%M:%S'))
         if device.install_datetime != datetime.min:
@@ -234,7 +681,7 @@ def output_data_to_file_csv(output):
 
     with open(output, "wb") as f:
         # Write the CSV headers
-        f.write("Vendor\tProduct\tVersion\tSerialNumber\tVID\tPID\tParentIDPrefix\tDriveLetter\tVolumeName\tGUID\tMountPoint\tInstall\tUSBSTOR\tUSBSTOR Properties (Install Date)\tUSBSTOR Properties (First Install Date)\tUSBSTOR Properties (Last Arrival Date)\tUSBSTOR Properties (Last Removal Date)\tDeviceClasses (53f56307-b6bf-11d0-94f2-00a0c91efb8b)\tDeviceClasses (10497b1b-ba51-44e5-8318-a65c837b6661)\tEnum\\USB VIDPID\t")
+        f.write("Vendor\tProduct\tVersion\tSerialNumber\tVID\tPID\tParentIDPrefix\tDriveLetter\tVolumeName\tGUID\tMountPoint\tInstall\tUSBSTOR\tUSBSTOR Properties (Install Date)\tUSBSTOR Properties (First Install Date)\tUSBSTOR Properties (Last Arrival Date)\tUSBSTOR Properties (Last Removal Date)\tDeviceClasses (53f56307-b6bf-11d0-94f2-00a0c91efb8b)\tDeviceClasses (10497b1b-ba51-44e5-8318-a65c837b6661)\tEnum\\USB VIDPID\tSource\tControlSets\tPolicy\tLowConfidence\tContainerID\tControl\\usbflags (Model First Connected)\tControl\\DeviceContainers\tEnum\\SWD\\WPDBUSENUM\tWPD Friendly Name\t")
 
         temp = ''
         for i in range(numMp2):
@@ -313,6 +760,24 @@ def output_data_to_file_csv(output):
                 data.append(device.vid_pid_datetime)
             else:
                 data.append('')
+            data.append(device.source)
+            data.append(get_control_sets_text(device))
+            data.append(device.policy)
+            data.append(', '.join(device.low_confidence))
+            data.append(device.container_id.encode('utf-8'))
+            if device.usbflags_datetime != datetime.min:
+                data.append(device.usbflags_datetime)
+            else:
+                data.append('')
+            if device.device_containers_datetime != datetime.min:
+                data.append(device.device_containers_datetime)
+            else:
+                data.append('')
+            if device.wpdbusenum_datetime != datetime.min:
+                data.append(device.wpdbusenum_datetime)
+            else:
+                data.append('')
+            data.append(device.wpd_friendly_name.encode('utf-8'))
 
             for mp in device.mountpoint2:
                 if mp.timestamp != datetime.min:
@@ -361,6 +826,16 @@ def output_data_to_file_text(output):
             f.write("GUID : " + device.guid.encode('utf-8') + '\n')
             f.write("Mountpoint: " + device.mountpoint.encode('utf-8') + '\n')
             f.write("Disk Signature: " + device.disk_signature.encode('utf-8') + '\n')
+            f.write("Source: " + device.source + '\n')
+            f.write("Control Sets: " + get_control_sets_text(device) + '\n')
+            if len(device.policy) > 0:
+                f.write("Policy: " + device.policy + '\n')
+            if len(device.low_confidence) > 0:
+                f.write("Low Confidence: " + ', '.join(device.low_confidence) + '\n')
+            if len(device.container_id) > 0:
+                f.write("Container ID: " + device.container_id.encode('utf-8') + '\n')
+            if len(device.wpd_friendly_name) > 0:
+                f.write("WPD Friendly Name: " + device.wpd_friendly_name.encode('utf-8') + '\n')
 
             if device.device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b != datetime.min:
                 f.write("Device Classes Timestamp (53f56): " + device.device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b.strftime('%Y-%m-%dT%H:%M:%S') + '\n')
@@ -368,6 +843,12 @@ def output_data_to_file_text(output):
                 f.write("Device Classes Timestamp (10497): " + device.device_classes_datetime_10497b1bba5144e58318a65c837b6661.strftime('%Y-%m-%dT%H:%M:%S') + '\n')
             if device.vid_pid_datetime != datetime.min:
                 f.write("VID/PID Timestamp: " + device.vid_pid_datetime.strftime('%Y-%m-%dT%H:%M:%S') + '\n')
+            if device.usbflags_datetime != datetime.min:
+                f.write("usbflags Timestamp (Model First Connected): " + device.usbflags_datetime.strftime('%Y-%m-%dT%H:%M:%S') + '\n')
+            if device.device_containers_datetime != datetime.min:
+                f.write("DeviceContainers Timestamp: " + device.device_containers_datetime.strftime('%Y-%m-%dT%H:%M:%S') + '\n')
+            if device.wpdbusenum_datetime != datetime.min:
+                f.write("WPDBUSENUM Timestamp: " + device.wpdbusenum_datetime.strftime('%Y-%m-%dT%H:%M:%S') + '\n')
             if device.usb_stor_datetime != datetime.min:
                 f.write("USBSTOR Timestamp: " + device.usb_stor_datetime.strftime('%Y-%m-%dT%H:%M:%S') + '\n')
             if device.install_datetime != datetime.min:
@@ -405,22 +886,26 @@ def get_os_version(registry):
         os_version = reg_value.value()
 
 
-def process_usb_stor(registry):
-    """Processes the Enum\\USBStor registry key"""
+def process_usb_stor(registry, control_sets=None, key_names=None):
+    """Processes the Enum\\USBStor registry key, only the (device class key, device key) names
+    in key_names if supplied, see get_usb_stor_key_names"""
 
     write_debug(data='Method: process_usb_stor')
 
-    ccs = []
-    root_key = registry.root()
-    for k in root_key.subkeys():
-        if 'ControlSet' in k.name():
-            ccs.append(k.name())
+    if control_sets is None:
+        control_sets = get_control_sets(registry)
+
+    for c in control_sets:
+        if find_mode is True and is_find_complete():
+            break
 
-    for c in ccs:
         try:
 
             key = registry.open(c + '\\Enum\\USBStor')
             for k in key.subkeys():
+                if find_mode is True and is_find_complete():
+                    break
+
                 parts = k.name().split('&')
 
                 if len(parts) == 0:
@@ -431,17 +916,27 @@ def process_usb_stor(registry):
                     continue
 
                 for device_sk in k.subkeys():
+                    if key_names is not None and (k.name().lower(), device_sk.name().lower()) not in key_names:
+                        continue
+
+                    if find_mode is True:
+                        identifier = get_find_hit(device_sk)
+                        if identifier is None:
+                            continue
+                        find_found.add(identifier)
+
                     usb_device = UsbDevice()
 
                     if len(parts) == 4:
-                        usb_device.vendor = parts[1]
+                        usb_device.vendor = intern_string(parts[1])
                         write_debug(name='Vendor', value=usb_device.vendor)
-                        usb_device.product = parts[2]
+                        usb_device.product = intern_string(parts[2])
                         write_debug(name='Product', value=usb_device.product)
-                        usb_device.version = parts[3]
+                        usb_device.version = intern_string(parts[3])
                         write_debug(name='Version', value=usb_device.version)
 
                     usb_device.usb_stor_datetime = device_sk.timestamp()
+                    usb_device.control_sets['usb_stor_datetime'] = c
                     write_debug(name='USBStor Timestamp', value=usb_device.usb_stor_datetime.strftime('%Y-%m-%dT%H:%M:%S'))
 
                     parts_serial_no = device_sk.name().split('&')
@@ -470,6 +965,7 @@ def process_usb_stor(registry):
                     if not does_usb_device_exist(usb_device):
                         write_debug(data='USB device does not exist so adding new object')
                         usb_devices.append(usb_device)
+                        mark_device_matched(usb_device)
                     else:
                         write_debug(data='USB device already exists')
         except Registry.RegistryKeyNotFoundException:
@@ -478,7 +974,7 @@ def process_usb_stor(registry):
 
 
 
-def process_usb_stor_properties(registry):
+def process_usb_stor_properties(registry, control_sets=None):
     """
     Processes the CCS \Enum\USBStor keys, which contain key timestamps for Win7 & Win8
 
@@ -497,13 +993,10 @@ def process_usb_stor_properties(registry):
 
     write_debug(data='Method: process_usb_stor_properties')
 
-    ccs = []
-    root_key = registry.root()
-    for k in root_key.subkeys():
-        if 'ControlSet' in k.name():
-            ccs.append(k.name())
+    if control_sets is None:
+        control_sets = get_control_sets(registry)
 
-    for c in ccs:
+    for c in control_sets:
         try:
             key = registry.open(c + '\\Enum\\USBStor')
             for k in key.subkeys():
@@ -535,6 +1028,7 @@ def process_usb_stor_properties(registry):
                                                 version=version)
                     if usb_device is None:
                         continue
+                    mark_device_matched(usb_device)
 
                     for sub_key_device in device_sk.subkeys():
                         if sub_key_device.name().lower() != 'properties':
@@ -545,6 +1039,7 @@ def process_usb_stor_properties(registry):
                             value64 = get_reg_value(key64, 'Data')
                             if value64 is not None:
                                 usb_device.usbstor_datetime64 = key64.timestamp()
+                                usb_device.control_sets['usbstor_datetime64'] = c
                                 write_debug(name='USBSTOR date/time (64)', value=usb_device.usbstor_datetime64.strftime('%Y-%m-%dT%H:%M:%S'))
                         else:
                             write_debug(data='{83da6326-97a6-4088-9453-a1923f573b29}\\00000064\\00000000 is None')
@@ -554,6 +1049,7 @@ def process_usb_stor_properties(registry):
                             value65 = get_reg_value(key65, 'Data')
                             if value65 is not None:
                                 usb_device.usbstor_datetime65 = key65.timestamp()
+                                usb_device.control_sets['usbstor_datetime65'] = c
                                 write_debug(name='USBSTOR date/time (65)', value=usb_device.usbstor_datetime65.strftime('%Y-%m-%dT%H:%M:%S'))
                         else:
                             write_debug(data='{83da6326-97a6-4088-9453-a1923f573b29}\\00000065\\00000000 is None')
@@ -563,6 +1059,7 @@ def process_usb_stor_properties(registry):
                             value64win8 = get_reg_value(key64win8, '(default)')
                             if value64win8 is not None:
                                 usb_device.usbstor_datetime64 = key64win8.timestamp()
+                                usb_device.control_sets['usbstor_datetime64'] = c
                                 write_debug(name='USBSTOR date/time (64)', value=usb_device.usbstor_datetime64.strftime('%Y-%m-%dT%H:%M:%S'))
                         else:
                             write_debug(data='{83da6326-97a6-4088-9453-a1923f573b29}\\0064 is None')
@@ -572,6 +1069,7 @@ def process_usb_stor_properties(registry):
                             value65win8 = get_reg_value(key65win8, '(default)')
                             if not value65win8 is None:
                                 usb_device.usbstor_datetime65 = key65win8.timestamp()
+                                usb_device.control_sets['usbstor_datetime65'] = c
                                 write_debug(name='USBSTOR date/time (65)', value=usb_device.usbstor_datetime65.strftime('%Y-%m-%dT%H:%M:%S'))
                         else:
                             write_debug(data='{83da6326-97a6-4088-9453-a1923f573b29}\\0065 is None')
@@ -581,6 +1079,7 @@ def process_usb_stor_properties(registry):
                             value66 = get_reg_value(key66, '(default)')
                             if value66 is not None:
                                 usb_device.usbstor_datetime66 = key66.timestamp()
+                                usb_device.control_sets['usbstor_datetime66'] = c
                                 write_debug(name='USBSTOR date/time (66)', value=usb_device.usbstor_datetime66.strftime('%Y-%m-%dT%H:%M:%S'))
                             else:
                                 write_debug(data='{83da6326-97a6-4088-9453-a1923f573b29}\\0066\\(default) is None')
@@ -592,6 +1091,7 @@ def process_usb_stor_properties(registry):
                             value67 = get_reg_value(key67, '(default)')
                             if value67 is not None:
                                 usb_device.usbstor_datetime67 = key67.timestamp()
+                                usb_device.control_sets['usbstor_datetime67'] = c
                                 write_debug(name='USBSTOR date/time (67)', value=usb_device.usbstor_datetime67.strftime('%Y-%m-%dT%H:%M:%S'))
                         else:
                             write_debug(data='{83da6326-97a6-4088-9453-a1923f573b29}\\0067 is None')
@@ -600,18 +1100,15 @@ def process_usb_stor_properties(registry):
             pass
 
 
-def process_usb(registry):
+def process_usb(registry, control_sets=None):
     """Processes the CCS \Enum\USB keys"""
 
     write_debug(data='Method: process_usb')
 
-    ccs = []
-    root_key = registry.root()
-    for k in root_key.subkeys():
-        if 'ControlSet' in k.name():
-            ccs.append(k.name())
+    if control_sets is None:
+        control_sets = get_control_sets(registry)
 
-    for c in ccs:
+    for c in control_sets:
         try:
             key = registry.open(c + '\\Enum\\USB')
             for sub_key in key.subkeys():
@@ -624,13 +1121,15 @@ def process_usb(registry):
                     usb_device = get_usb_device(serial_number=serial_key.name())
                     if usb_device is None:
                         continue
+                    mark_device_matched(usb_device)
 
                     vid_pid = sub_key.name().split('&')
-                    usb_device.vid = vid_pid[0]
+                    usb_device.vid = intern_string(vid_pid[0])
                     write_debug(name='VID', value=usb_device.vid)
-                    usb_device.pid = vid_pid[1]
+                    usb_device.pid = intern_string(vid_pid[1])
                     write_debug(name='PID', value=usb_device.pid)
                     usb_device.vid_pid_datetime = sub_key.timestamp()
+                    usb_device.control_sets['vid_pid_datetime'] = c
                     write_debug(name='VID/PID datetime', value=usb_device.vid_pid_datetime.strftime('%Y-%m-%dT%H:%M:%S'))
         except Registry.RegistryKeyNotFoundException:
             pass
@@ -665,6 +1164,7 @@ def process_mounted_devices(registry):
                     if usb_device.parent_prefix_id in str(data):
                         usb_device.drive_letter = reg_value.name().replace('\\DosDevices\\', '')
                         write_debug(name='Drive letter', value=usb_device.drive_letter)
+                        mark_device_matched(usb_device)
 
             if '\\Volume{' in reg_value.name():
                 if usb_device.parent_prefix_id in data:
@@ -674,6 +1174,7 @@ def process_mounted_devices(registry):
                     write_debug(name='GUID', value=usb_device.guid)
                     usb_device.mountpoint = data[4:]
                     write_debug(name='Mountpoint', value=usb_device.mountpoint)
+                    mark_device_matched(usb_device)
 
             # If the drive letter is missing from being identified by the
             # ParentPrefixId then try matching the full device string
@@ -687,6 +1188,7 @@ def process_mounted_devices(registry):
 
                         usb_device.drive_letter = reg_value.name().replace('\\DosDevices\\', '')
                         write_debug(name='Drive letter', value=usb_device.drive_letter)
+                        mark_device_matched(usb_device)
 
             # If the GUID is missing from being identified by the
             # ParentPrefixId then try matching the full device string
@@ -703,22 +1205,20 @@ def process_mounted_devices(registry):
                         guid = reg_value.name()[11:]
                         guid = guid[:len(guid)-1]
                         usb_device.guid = guid
+                        mark_device_matched(usb_device)
 
                     write_debug(name='GUID', value=usb_device.guid)
                     usb_device.mountpoint = data[4:]
                     write_debug(name='Mountpoint', value=usb_device.mountpoint)
 
 
-def process_device_classes(registry):
+def process_device_classes(registry, control_sets=None):
     """Processes the CCS \Control\DeviceClasses\{53f56307-b6bf-11d0-94f2-00a0c91efb8b keys"""
 
     write_debug(data='Method: process_device_classes')
 
-    ccs = []
-    root_key = registry.root()
-    for k in root_key.subkeys():
-        if 'ControlSet' in k.name():
-            ccs.append(k.name())
+    if control_sets is None:
+        control_sets = get_control_sets(registry)
 
     global usb_devices
 
@@ -727,18 +1227,22 @@ def process_device_classes(registry):
         if len(usb_device.mountpoint.strip()) == 0:
             continue
 
-        for c in ccs:
+        for c in control_sets:
             try:
                 key = registry.open(c + '\\Control\\DeviceClasses\\{53f56307-b6bf-11d0-94f2-00a0c91efb8b}')
                 for sub_key in key.subkeys():
                     if usb_device.mountpoint in sub_key.name():
                         usb_device.device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b = sub_key.timestamp()
+                        usb_device.control_sets['device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b'] = c
+                        mark_device_matched(usb_device)
                         write_debug(name='Dev Classes date/time (53f56)',
                                     value=usb_device.device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b.strftime('%Y-%m-%dT%H:%M:%S'))
                         continue
 
                     if usb_device.serial_number in sub_key.name():
                         usb_device.device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b = sub_key.timestamp()
+                        usb_device.control_sets['device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b'] = c
+                        mark_device_matched(usb_device)
                         write_debug(name='Dev Classes date/time (53f56)',
                                     value=usb_device.device_classes_datetime_53f56307b6bf11d094f200a0c91efb8b.strftime('%Y-%m-%dT%H:%M:%S'))
                         continue
@@ -750,18 +1254,222 @@ def process_device_classes(registry):
                 for sub_key in key.subkeys():
                     if usb_device.mountpoint in sub_key.name():
                         usb_device.device_classes_datetime_10497b1bba5144e58318a65c837b6661 = sub_key.timestamp()
+                        usb_device.control_sets['device_classes_datetime_10497b1bba5144e58318a65c837b6661'] = c
+                        mark_device_matched(usb_device)
                         write_debug(name='Dev Classes date/time (10497)',
                                     value=usb_device.device_classes_datetime_10497b1bba5144e58318a65c837b6661.strftime('%Y-%m-%dT%H:%M:%S'))
                         continue
 
                     if usb_device.serial_number in sub_key.name():
                         usb_device.device_classes_datetime_10497b1bba5144e58318a65c837b6661 = sub_key.timestamp()
+                        usb_device.control_sets['device_classes_datetime_10497b1bba5144e58318a65c837b6661'] = c
+                        mark_device_matched(usb_device)
                         write_debug(name='Dev Classes date/time (10497)',
                                     value=usb_device.device_classes_datetime_10497b1bba5144e58318a65c837b6661.strftime('%Y-%m-%dT%H:%M:%S'))
                         continue
             except Registry.RegistryKeyNotFoundException:
                 pass
 
+def get_device_index():
+    """
+    Returns hash indexes of the device positions by lower case serial number, ParentIdPrefix
+    and VID/PID, so that the usbflags/DeviceContainers/WPDBUSENUM entries are joined to
+    the devices by lookup rather than a loop over the devices per entry
+    """
+    device_index = {'serial_number': {}, 'parent_prefix_id': {}, 'vid_pid': {}}
+    for index in range(len(usb_devices)):
+        device = usb_devices[index]
+        device_index['serial_number'].setdefault(device.serial_number.lower(), []).append(index)
+        if len(device.parent_prefix_id) > 0:
+            device_index['parent_prefix_id'].setdefault(device.parent_prefix_id.lower(), []).append(index)
+        if len(device.vid) > 0 and len(device.pid) > 0:
+            device_index['vid_pid'].setdefault((device.vid + '&' + device.pid).upper(), []).append(index)
+
+    return device_index
+
+
+def get_indexed_devices(device_index, identifier):
+    """Returns the positions of the devices whose serial number (with or without the &0 suffix) or ParentIdPrefix is the identifier"""
+    identifier = identifier.lower()
+    indexes = list(device_index['parent_prefix_id'].get(identifier, []))
+
+    parts_serial_no = identifier.split('&')
+    if len(parts_serial_no) == 2:
+        indexes.extend(device_index['serial_number'].get(parts_serial_no[0], []))
+    else:
+        indexes.extend(device_index['serial_number'].get(identifier, []))
+
+    return sorted(set(indexes))
+
+
+def process_usb_flags(registry, device_index, control_sets=None):
+    """
+    Processes the Control\\usbflags key, the VVVVPPPPRRRR subkeys are created when a model
+    is first connected, so the timestamp is shared by every device with the same VID/PID
+    """
+
+    write_debug(data='Method: process_usb_flags')
+
+    if control_sets is None:
+        control_sets = get_control_sets(registry)
+
+    for c in control_sets:
+        try:
+            key = registry.open(c + '\\Control\\usbflags')
+        except Registry.RegistryKeyNotFoundException:
+            continue
+
+        for sub_key in key.subkeys():
+            if not re.match('^[0-9a-f]{12}$', sub_key.name(), re.I):
+                continue
+
+            vid_pid = ('VID_' + sub_key.name()[0:4] + '&PID_' + sub_key.name()[4:8]).upper()
+            for index in device_index['vid_pid'].get(vid_pid, []):
+                usb_device = usb_devices[index]
+                usb_device.usbflags_datetime = sub_key.timestamp()
+                usb_device.control_sets['usbflags_datetime'] = c
+                mark_device_matched(usb_device)
+                write_debug(name='usbflags Timestamp', value=usb_device.usbflags_datetime.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def process_device_containers(registry, device_index, control_sets=None):
+    """
+    Processes the Control\\DeviceContainers key, the BaseContainers values of each
+    container are the device instance ids (USB\\VID_xxxx&PID_xxxx\\serial or
+    USBSTOR\\Disk&Ven_...\\serial&0) of the devices in the container
+    """
+
+    write_debug(data='Method: process_device_containers')
+
+    if control_sets is None:
+        control_sets = get_control_sets(registry)
+
+    for c in control_sets:
+        try:
+            key = registry.open(c + '\\Control\\DeviceContainers')
+        except Registry.RegistryKeyNotFoundException:
+            continue
+
+        for container_key in key.subkeys():
+            base_containers = container_key.find_key('BaseContainers')
+            if base_containers is None:
+                continue
+
+            for base_key in base_containers.subkeys():
+                for reg_value in base_key.values():
+                    parts = reg_value.name().split('\\')
+                    if len(parts) < 3 or parts[0].upper() not in ['USB', 'USBSTOR']:
+                        continue
+
+                    for index in get_indexed_devices(device_index, parts[2]):
+                        usb_device = usb_devices[index]
+                        usb_device.container_id = container_key.name()
+                        write_debug(name='Container ID', value=usb_device.container_id)
+                        usb_device.device_containers_datetime = container_key.timestamp()
+                        usb_device.control_sets['device_containers_datetime'] = c
+                        mark_device_matched(usb_device)
+
+
+def process_wpd_bus_enum(registry, device_index, control_sets=None):
+    """Processes the Enum\\SWD\\WPDBUSENUM key, which holds the volumes that were presented as portable devices"""
+
+    write_debug(data='Method: process_wpd_bus_enum')
+
+    if control_sets is None:
+        control_sets = get_control_sets(registry)
+
+    for c in control_sets:
+        try:
+            key = registry.open(c + '\\Enum\\SWD\\WPDBUSENUM')
+        except Registry.RegistryKeyNotFoundException:
+            continue
+
+        for sub_key in key.subkeys():
+            identifier = get_mountpoint_serial(sub_key.name())
+            if identifier is None:
+                continue
+
+            indexes = get_indexed_devices(device_index, identifier)
+            if len(indexes) == 0:
+                continue
+
+            friendly_name = get_reg_value(sub_key, 'FriendlyName')
+            container_id = get_reg_value(sub_key, 'ContainerID')
+            for index in indexes:
+                usb_device = usb_devices[index]
+                usb_device.wpdbusenum_datetime = sub_key.timestamp()
+                usb_device.control_sets['wpdbusenum_datetime'] = c
+                mark_device_matched(usb_device)
+                write_debug(name='WPDBUSENUM Timestamp', value=usb_device.wpdbusenum_datetime.strftime('%Y-%m-%dT%H:%M:%S'))
+                if friendly_name is not None:
+                    usb_device.wpd_friendly_name = friendly_name.value()
+                    write_debug(name='WPD Friendly Name', value=usb_device.wpd_friendly_name)
+                if container_id is not None and len(usb_device.container_id) == 0:
+                    usb_device.container_id = container_id.value()
+                    write_debug(name='Container ID', value=usb_device.container_id)
+
+def process_inactive_control_sets(registry):
+    """Active control set mode: the inactive control sets are only consulted for the
+    devices that are missing from the active control set. The USBSTOR key names are
+    compared first, so only the missing device keys are read, and the devices are
+    extracted into their own store so that the devices from the active control set
+    keep its values"""
+    global usb_devices
+
+    active = get_active_control_set(registry)
+    control_sets = get_all_control_sets(registry)
+    if active not in control_sets:
+        # Every control set has been processed already
+        return
+
+    inactive = [c for c in control_sets if c != active]
+    if len(inactive) == 0:
+        return
+
+    active_names = get_usb_stor_key_names(registry, active)
+    missing_names = set()
+    for c in inactive:
+        missing_names.update(get_usb_stor_key_names(registry, c) - active_names)
+    write_debug(name='Device keys missing from the active control set', value=str(len(missing_names)))
+    if len(missing_names) == 0:
+        return
+
+    active_devices = usb_devices
+    try:
+        usb_devices = []
+        process_usb_stor(registry, inactive, missing_names)
+        missing = usb_devices
+        process_usb_stor_properties(registry, inactive)
+        process_usb(registry, inactive)
+        process_mounted_devices(registry)
+        process_device_classes(registry, inactive)
+        device_index = get_device_index()
+        process_usb_flags(registry, device_index, inactive)
+        process_device_containers(registry, device_index, inactive)
+        process_wpd_bus_enum(registry, device_index, inactive)
+    finally:
+        usb_devices = active_devices
+
+    for usb_device in missing:
+        usb_devices.append(usb_device)
+        mark_device_matched(usb_device)
+
+
+def get_usb_stor_key_names(registry, control_set):
+    """Returns the lower case (device class key, device key) names under the Enum\\USBStor key of a control set"""
+    names = set()
+    try:
+        key = registry.open(control_set + '\\Enum\\USBStor')
+    except Registry.RegistryKeyNotFoundException:
+        return names
+
+    for k in key.subkeys():
+        for device_sk in k.subkeys():
+            names.add((k.name().lower(), device_sk.name().lower()))
+
+    return names
+
+
 # Software Hive Methods #######################################################
 
 def process_windows_portable_devices(registry):
@@ -789,6 +1497,7 @@ def process_windows_portable_devices(registry):
                     continue
 
                 temp = friendly_name.value()
+                mark_device_matched(usb_device)
 
                 if '(' in temp:
                     usb_device.drive_letter = temp[temp.index('('):]
@@ -854,7 +1563,7 @@ def process_emd_mgmt(registry):
                 emdMgmt = EmdMgmt()
                 emdMgmt.volume_serial_num = volume_serial_no
                 write_debug(name='EMDMgmt serial no.', value=emdMgmt.volume_serial_num)
-                emdMgmt.volume_name = volume_name
+                emdMgmt.volume_name = intern_string(volume_name)
                 write_debug(name='EMDMgmt volume name', value=emdMgmt.volume_name)
                 emdMgmt.timestamp = sub_key.timestamp()
                 write_debug(name='EMDMgmt date/time', value=emdMgmt.timestamp.strftime('%Y-%m-%dT%H:%M:%S'))
@@ -865,6 +1574,7 @@ def process_emd_mgmt(registry):
                     write_debug(name='EMDMgmt serial no. (hex)', value=emdMgmt.volume_serial_num_hex)
 
                 usb_device.emdmgmt.append(emdMgmt)
+                mark_device_matched(usb_device)
 
     except Registry.RegistryKeyNotFoundException:
         return
@@ -888,9 +1598,10 @@ def process_mountpoints2(registry, reg_file_path):
                     continue
 
                 mp2 = MountPoint2()
-                mp2.file = reg_file_path
+                mp2.file = intern_string(reg_file_path)
                 mp2.timestamp = sub_key.timestamp()
                 usb_device.mountpoint2.append(mp2)
+                mark_device_matched(usb_device)
 
                 write_debug(name='Mountpoint2 file', value=mp2.file)
                 write_debug(name='Mountpoint2 date/time', value=mp2.timestamp.strftime('%Y-%m-%dT%H:%M:%S'))
@@ -910,10 +1621,16 @@ def process_log_file(file):
     regexVista2 = '>>>\s\sSection\sstart\s([0-9]+/[0-9]+/[0-9]+\s[0-9]+:[0-9]+:[0-9]+\.[0-9]+)'
     regexWin78 = '>>>\s\s\[Device\sInstall\s\(Hardware\sinitiated\) - SWD\\WPDBUSENUM\\_\?\?_USBSTOR#(.*)\]'
 
-    with open(file) as f:
-        lines = f.readlines()
+    with open(file, 'rb') as f:
+        data = f.read()
     f.close()
 
+    # Hash the same data that is parsed, so the provenance costs no extra read
+    if manifest_mode is True:
+        add_to_manifest(file, data)
+
+    lines = data.splitlines(True)
+
     install_times = {}
     index = 0
 
@@ -1008,9 +1725,11 @@ def process_log_file(file):
             if os == WindowsVersions.WindowsXP or os == WindowsVersions.WindowsXPx64:
                 if (device.vid.lower() + '&' + device.pid.lower() + "\\" + device.serial_number.lower()) in key.lower():
                     device.install_datetime = datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S.%f")
+                    mark_device_matched(device)
                 elif (device.vendor.lower() + "&" + device.product.lower() + "&" + device.version.lower() + "\\" + device.serial_number.lower()) in key.lower():
                     #I121 "USBSTOR\DISK&VEN_USB_2.0&PROD_&REV_1100\6&12202299&0
                     device.install_datetime = datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S.%f")
+                    mark_device_matched(device)
             else:
                 if len(device.mountpoint) == 0:
                     continue
@@ -1022,154 +1741,2405 @@ def process_log_file(file):
                     if temp.lower() in key.lower():
                         write_debug(data='Matched install log timestamp using mountpoint: ' + key.lower())
                         device.install_datetime = datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S.%f")
+                        mark_device_matched(device)
                     else:
                         write_debug(data='Unable to match install log timestamp using mountpoint: ' + key.lower())
                 else:
                     print('The mountpoint does not contain 4 delimited (#) parts: ' + device.mountpoint)
 
 
-# Helper Methods ##############################################################
+# Recovery Methods ############################################################
 
-def load_file(file):
-    """Loads a file as a registry hive"""
-    try:
-        if quiet_mode is False:
-            print('Loading file: ' + file)
-        registry = Registry.Registry(file)
+def recover_deleted_keys(file, hive_type, registry):
+    """Recovers deleted USBSTOR (SYSTEM) and MountPoints2 (NTUSER) keys from the free
+    cells of a hive. A dirty hive is searched in the copy that load_file replayed its
+    transaction logs into, otherwise the hive is memory mapped. The data is searched for
+    the nk signature, and only the hbins containing candidates have their cells walked,
+    so large hives are scanned without being read into memory or parsed cell by cell"""
+    data = recover_data.pop(file, None)
+    if data is None:
+        with open(file, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-        return registry
-    except Exception:
-        return None
+    try:
+        deleted_keys = find_deleted_keys(data)
+        write_debug(name='Deleted key records', value=str(len(deleted_keys)))
+
+        if hive_type == Registry.HiveType.SYSTEM:
+            recovered = recover_usb_stor_keys(data, deleted_keys)
+            process_recovered_devices(registry, recovered)
+            for usb_device in recovered:
+                usb_devices.append(usb_device)
+                mark_device_matched(usb_device)
+        elif hive_type == Registry.HiveType.NTUSER:
+            recover_mountpoints2_keys(data, deleted_keys, os.path.basename(file))
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def process_recovered_devices(registry, recovered):
+    """Joins the VID/PID, drive letter, volume GUID and DeviceClasses data to the recovered
+    devices. The devices are processed in their own store, and from every control set as
+    the device may only be left in an inactive control set"""
+    global usb_devices
 
+    control_sets = get_all_control_sets(registry)
+    existing_devices = usb_devices
+    try:
+        usb_devices = recovered
+        process_usb(registry, control_sets)
+        process_mounted_devices(registry)
+        process_device_classes(registry, control_sets)
+    finally:
+        usb_devices = existing_devices
+
+
+def find_deleted_keys(data):
+    """Returns the DeletedKey records found in the free cells of the hive"""
+    # Cells are 8 byte aligned and start with a 4 byte size, so only
+    # signatures at an offset of 4 from the alignment can be records
+    candidates = []
+    position = data.find('nk', HIVE_BINS_OFFSET)
+    while position != -1:
+        if (position - HIVE_BINS_OFFSET) % 8 == 4:
+            candidates.append(position)
+        position = data.find('nk', position + 1)
+
+    hbins = get_hbins(data)
+    hbin_starts = [start for start, size in hbins]
+
+    deleted_keys = []
+    index = 0
+    while index < len(candidates):
+        hbin = bisect.bisect_right(hbin_starts, candidates[index]) - 1
+        if hbin < 0:
+            index += 1
+            continue
 
-def parse_windows_timestamp(qword):
-    """see http://integriography.wordpress.com/2010/01/16/using-phython-to-parse-and-present-windows-64-bit-timestamps"""
-    return datetime.utcfromtimestamp(float(qword) * 1e-7 - 11644473600)
+        # Walk the cells of the hbin once for all of the candidates within it
+        start, size = hbins[hbin]
+        free_cells = get_free_cells(data, start, size)
+        while index < len(candidates) and candidates[index] < start + size:
+            position = candidates[index]
+            index += 1
+            for cell_start, cell_end in free_cells:
+                if cell_start < position < cell_end:
+                    key = parse_key_record(data, position, cell_end)
+                    if key is not None:
+                        deleted_keys.append(key)
+                    break
+
+    return deleted_keys
+
+
+def get_hbins(data):
+    """Returns the (file offset, size) of each hbin in the hive"""
+    hbins = []
+    position = HIVE_BINS_OFFSET
+    while position + HBIN_HEADER_SIZE <= len(data) and data[position:position + 4] == 'hbin':
+        size = struct.unpack('<I', data[position + 8:position + 12])[0]
+        if size == 0:
+            break
+        hbins.append((position, size))
+        position += size
+
+    return hbins
+
+
+def get_free_cells(data, start, size):
+    """Returns the (file offset, end) of the free cells within an hbin"""
+    free_cells = []
+    end = min(start + size, len(data))
+    position = start + HBIN_HEADER_SIZE
+    while position + 4 <= end:
+        cell_size = struct.unpack('<i', data[position:position + 4])[0]
+        if cell_size == 0:
+            break
+        if cell_size > 0:
+            free_cells.append((position, min(position + cell_size, end)))
+        position += abs(cell_size)
+
+    return free_cells
+
+
+def parse_key_record(data, position, end):
+    """Parses a key (nk) record at the file offset of its signature, returning a
+    DeletedKey or None if the record is not plausible"""
+    if position + NK_NAME_OFFSET > end:
+        return None
 
+    flags = struct.unpack('<H', data[position + 2:position + 4])[0]
+    filetime = struct.unpack('<Q', data[position + 4:position + 12])[0]
+    parent = struct.unpack('<I', data[position + 0x10:position + 0x14])[0]
+    values_count, values_offset = struct.unpack('<II', data[position + 0x24:position + 0x2C])
+    name_length = struct.unpack('<H', data[position + 0x48:position + 0x4A])[0]
 
-def does_usb_device_exist(usb_device):
-    """Iterates through the module level list of USB device objects and determines if the object already exists"""
-    global usb_devices
+    if name_length == 0 or position + NK_NAME_OFFSET + name_length > end:
+        return None
+    if filetime < MIN_RECOVERED_FILETIME or filetime > MAX_RECOVERED_FILETIME:
+        return None
 
-    for device in usb_devices:
-        if (device.serial_number == usb_device.serial_number and
-                device.vendor == usb_device.vendor and
-                device.product == usb_device.product and
-                device.version == usb_device.version and
-                device.parent_prefix_id == usb_device.parent_prefix_id):
-            return True
+    name = data[position + NK_NAME_OFFSET:position + NK_NAME_OFFSET + name_length]
+    try:
+        if flags & NK_COMP_NAME:
+            name = name.decode('latin-1')
+        else:
+            name = name.decode('utf-16le')
+    except UnicodeDecodeError:
+        return None
 
-    return False
+    key = DeletedKey()
+    key.offset = position - 4 - HIVE_BINS_OFFSET
+    key.name = name
+    key.parent = parent
+    key.timestamp = parse_windows_timestamp(filetime)
+    key.values_count = values_count
+    key.values_offset = values_offset
+    return key
 
 
-def get_usb_device(serial_no):
-    """Iterates through the module level list of USB device objects and returns the object if it exists"""
-    global usb_devices
+def get_key_record(data, cell_offset):
+    """Returns the key record at a cell offset, allocated or not, or None"""
+    position = HIVE_BINS_OFFSET + cell_offset + 4
+    if position + NK_NAME_OFFSET > len(data) or data[position:position + 2] != 'nk':
+        return None
 
-    for device in usb_devices:
-        if device.serial_number == serial_no:
-            return device
+    return parse_key_record(data, position, len(data))
 
-    return None
 
+def get_key_string_value(data, key, value_name):
+    """Returns a string value of a recovered key by walking its values list, or None"""
+    if key.values_count == 0 or key.values_count > MAX_RECOVERED_VALUES:
+        return None
 
-def get_usb_device(**kwargs):
-    """Iterates through the module level list of USB device objects and returns the object if it exists"""
-    global usb_devices
+    position = HIVE_BINS_OFFSET + key.values_offset + 4
+    if position + key.values_count * 4 > len(data):
+        return None
 
-    for device in usb_devices:
-        if len(kwargs) == 1:
-            if device.serial_number == kwargs['serial_number']:
-                write_debug(data='Located USB device by serial number')
-                return device
-        elif len(kwargs) == 4:
-            write_debug(data=kwargs['serial_number'] + '#' + kwargs['vendor'] + '#' + kwargs['product'] + '#' + kwargs['version'])
-            write_debug(data=device.serial_number + '#' + device.vendor + '#' + device.product + '#' + device.version)
-            if (device.serial_number == kwargs['serial_number'] and
-                device.vendor == kwargs['vendor'] and
-                device.product == kwargs['product'] and
-                device.version == kwargs['version']):
+    for value_offset in struct.unpack('<%dI' % key.values_count, data[position:position + key.values_count * 4]):
+        vk = HIVE_BINS_OFFSET + value_offset + 4
+        if vk + 0x14 > len(data) or data[vk:vk + 2] != 'vk':
+            continue
 
-                write_debug(data='Located USB device by multi key')
+        name_length, data_length, data_offset = struct.unpack('<HII', data[vk + 2:vk + 12])
+        flags = struct.unpack('<H', data[vk + 0x10:vk + 0x12])[0]
+        name = data[vk + 0x14:vk + 0x14 + name_length]
+        if not flags & VK_COMP_NAME:
+            name = name.decode('utf-16le', 'ignore')
+        if name.lower() != value_name.lower():
+            continue
 
-                return device
+        # Data of 4 bytes or less is held in the data offset field
+        if data_length & 0x80000000:
+            value = data[vk + 8:vk + 8 + (data_length & 0x7FFFFFFF)]
+        else:
+            start = HIVE_BINS_OFFSET + data_offset + 4
+            value = data[start:start + data_length]
 
-    if len(kwargs) == 1:
-        write_debug(data='Unable to locate USB device by serial number: ' + kwargs['serial_number'])
-    else:
-        write_debug(data='Unable to locate USB device by serial number, vendor, product, version: ' + kwargs['serial_number'] + '#' + kwargs['vendor'] + '#' + kwargs['product'] + '#' + kwargs['version'])
+        return value.decode('utf-16le', 'ignore').split('\x00')[0]
 
     return None
 
 
-def control_set_check(sys_reg):
-    """Determine which Current Control Set the system was using"""
-    registry = Registry.Registry(sys_reg)
-    key = registry.open("Select")
-    for v in key.values():
-        if v.name() == "Current":
-            return v.value()
+def recover_usb_stor_keys(data, deleted_keys):
+    """Returns the devices of deleted USBSTOR serial number keys, which are the children
+    of the Disk&Ven_&Prod_&Rev_ keys, flagged as recovered. A device is only recovered
+    once, and not at all if its key still exists"""
+    recovered = []
+    for key in deleted_keys:
+        parent = get_key_record(data, key.parent)
+        if parent is None:
+            continue
 
+        parts = parent.name.split('&')
+        if parts[0].lower() != 'disk':
+            continue
 
-def get_reg_value(reg_key, value):
-    """Helper method to retrieve a specific value"""
-    try:
-        return reg_key.value(value)
-    except:
-        return None
+        usb_device = UsbDevice()
+        if len(parts) == 4:
+            usb_device.vendor = intern_string(parts[1])
+            usb_device.product = intern_string(parts[2])
+            usb_device.version = intern_string(parts[3])
 
+        usb_device.usb_stor_datetime = key.timestamp
 
-def get_key(reg_key, key_name):
-    """Helper method to retrieve a specific key"""
-    try:
-        for sk in reg_key.subkeys():
-            if quiet_mode is False:
-                print(sk.name())
-        return reg_key.find_key(key_name)
-    except:
-        return None
+        parts_serial_no = key.name.split('&')
+        if len(parts_serial_no) == 2:
+            usb_device.serial_number = parts_serial_no[0]
+        else:
+            usb_device.serial_number = key.name
 
+        parent_prefix_id = get_key_string_value(data, key, 'ParentIdPrefix')
+        if parent_prefix_id is not None:
+            usb_device.parent_prefix_id = parent_prefix_id
+        elif '&' in key.name:
+            usb_device.parent_prefix_id = key.name
 
-def write_debug(**kwargs):
-    """Simple debug logging"""
-    if debug_mode is False:
-        return
+        usb_device.source = 'recovered'
+        write_debug(name='Recovered USBStor key', value=parent.name + '\\' + key.name)
 
-    if len(kwargs) == 1:
-        print(kwargs['data'])
-    else:
-        print(kwargs['name'] + ': ' + kwargs['value'])
+        if does_usb_device_key_exist(usb_device, usb_devices) or does_usb_device_key_exist(usb_device, recovered):
+            continue
+        recovered.append(usb_device)
 
+    return recovered
 
-def remove_non_ascii_characters(data):
-    """Removes all non ascii characters from a string"""
-    return ''.join([i if (ord(i) < 128 and ord(i) > 0) else '' for i in data])
 
+def recover_mountpoints2_keys(data, deleted_keys, reg_file_path):
+    """Adds the MountPoints2 entries of deleted {GUID} keys to the devices with the volume GUID, flagged as recovered"""
+    for key in deleted_keys:
+        if re.match(REGEX_GUID_KEY, key.name, re.I) is None:
+            continue
 
-def main():
-    """Parse the command line parameters and load the configuration."""
-    parser = argparse.ArgumentParser(description='Example: usbdeviceforensics --registry "/case/registryhives" ')
-    parser.add_argument('-o', '--output', help='The output file name')
-    parser.add_argument('-f', '--format', choices=['csv', 'text'], help='Output format')
-    parser.add_argument('-d', '--debug', action='store_true', help='Debug mode, which outputs details VERY verbosely')
-    parser.add_argument('-r', '--registry', required=True, help='Path to registry hives')
-    parser.add_argument('-q', '--quiet', action='store_true', default=False, help='Supress output to the terminal')
-    args = parser.parse_args()
+        parent = get_key_record(data, key.parent)
+        if parent is None or parent.name.lower() != 'mountpoints2':
+            continue
 
-    if args.debug is True:
-        global debug_mode
-        debug_mode = True
+        write_debug(name='Recovered MountPoints2 key', value=key.name)
 
-    if args.quiet is True:
+        for usb_device in usb_devices:
+            if len(usb_device.guid) == 0 or '{' + usb_device.guid.lower() + '}' != key.name.lower():
+                continue
+
+            mp2 = MountPoint2()
+            mp2.file = intern_string(reg_file_path + ' (recovered)')
+            mp2.timestamp = key.timestamp
+            if any(mp.file == mp2.file and mp.timestamp == mp2.timestamp for mp in usb_device.mountpoint2):
+                continue
+            usb_device.mountpoint2.append(mp2)
+            mark_device_matched(usb_device)
+
+
+# Snapshot Diff Methods #######################################################
+
+def process_snapshot_diff(hive_paths, output):
+    """Compares versions of a SYSTEM hive, oldest first, reporting the device level changes
+    between each consecutive pair. Each relevant subtree is reduced to a Merkle hash, so
+    the subtrees that are unchanged between two versions are skipped without being compared.
+    Only the values of the keys whose Last Written time changed are read again, see hash_subtree"""
+    deltas = []
+    previous = None
+    previous_path = None
+    for hive_path in hive_paths:
+        registry = load_file(hive_path)
+        if registry is None:
+            print('Unable to load hive: ' + hive_path)
+            continue
+
+        if registry.hive_type() != Registry.HiveType.SYSTEM:
+            print('Hive is not a SYSTEM hive, skipping: ' + hive_path)
+            continue
+
+        subtrees = get_snapshot_subtrees(registry, previous)
+        if previous is not None:
+            pair_deltas, skipped = diff_snapshots(previous, subtrees, previous_path, hive_path)
+            deltas.extend(pair_deltas)
+            output_diff_summary(previous_path, hive_path, pair_deltas, skipped)
+
+        previous = subtrees
+        previous_path = hive_path
+
+    if quiet_mode is False:
+        for delta in deltas:
+            print('%s -> %s: %s %s\\%s %s' % (delta['from'], delta['to'], delta['change'], delta['subtree'],
+                                              delta['device'], ','.join(delta['detail'])))
+
+    if output is not None:
+        output_diff_to_file(output, deltas)
+
+
+def get_snapshot_subtrees(registry, previous=None):
+    """Returns an OrderedDict of subtree path to (device depth, SubtreeHash) for the
+    subtrees of every control set and the root subtrees that exist in the hive. The
+    subtrees of the previous version, if supplied, are reused where unchanged"""
+    paths = []
+    for key in registry.root().subkeys():
+        if 'ControlSet' in key.name():
+            for path, depth in DIFF_CONTROL_SET_SUBTREES:
+                paths.append((key.name() + '\\' + path, depth))
+    paths.extend(DIFF_ROOT_SUBTREES)
+
+    subtrees = OrderedDict()
+    for path, depth in paths:
+        try:
+            previous_node = None
+            if previous is not None and path in previous:
+                previous_node = previous[path][1]
+            subtrees[path] = (depth, hash_subtree(registry.open(path), previous_node))
+        except Registry.RegistryKeyNotFoundException:
+            continue
+
+    return subtrees
+
+
+def hash_subtree(key, previous=None):
+    """
+    Returns the SubtreeHash of a key, computed from its value hashes and the hashes of its sub keys.
+
+    Windows updates the Last Written time of a key when its values or list of sub keys
+    change, but not the times of its parents, so every sub key is visited. The value
+    hashes of the previous version of a key are reused, without reading the value data,
+    when its timestamp and value count are the same, and the previous SubtreeHash is
+    returned when nothing below it changed
+    """
+    node = SubtreeHash()
+    node.name = key.name()
+    node.timestamp = key.timestamp()
+    node.subkey_count = key.subkeys_number()
+    node.value_count = key.values_number()
+
+    if previous is not None and previous.timestamp == node.timestamp and previous.value_count == node.value_count:
+        node.values = previous.values
+    else:
+        for value in key.values():
+            node.values[value.name()] = hashlib.sha1(str(value.value_type()) + '\x00' + value.raw_data()).hexdigest()
+
+    for sub_key in key.subkeys():
+        previous_child = None
+        if previous is not None:
+            previous_child = previous.subkeys.get(sub_key.name().lower())
+        child = hash_subtree(sub_key, previous_child)
+        node.subkeys[sub_key.name().lower()] = child
+
+    digest = hashlib.sha1()
+    digest.update(node.name.lower().encode('utf-8') + '\x00' + str(node.timestamp))
+    for name in sorted(node.values.keys()):
+        digest.update('\x00v' + name.encode('utf-8') + '\x00' + node.values[name])
+    for name in sorted(node.subkeys.keys()):
+        digest.update('\x00k' + name.encode('utf-8') + '\x00' + node.subkeys[name].digest)
+    node.digest = digest.hexdigest()
+
+    if previous is not None and previous.digest == node.digest:
+        return previous
+
+    return node
+
+
+def diff_snapshots(old_subtrees, new_subtrees, old_path, new_path):
+    """Returns the (deltas, number of subtrees skipped) between two hive versions"""
+    deltas = []
+    skipped = 0
+
+    paths = list(old_subtrees.keys())
+    paths.extend(path for path in new_subtrees.keys() if path not in old_subtrees)
+    for path in paths:
+        depth, old = old_subtrees.get(path, (None, None))
+        depth, new = new_subtrees.get(path, (depth, None))
+        if old is not None and new is not None and old.digest == new.digest:
+            skipped += 1
+            continue
+
+        diff_subtree(old, new, path, '', depth, deltas)
+
+    for delta in deltas:
+        delta['from'] = old_path
+        delta['to'] = new_path
+
+    return (deltas, skipped)
+
+
+def diff_subtree(old, new, subtree, device, depth, deltas):
+    """Descends through the sub keys whose hashes differ down to the device level keys
+    (or values at depth 0), adding a delta for each device added, removed or changed"""
+    if old is not None and new is not None and old.digest == new.digest:
+        return
+
+    if depth == 0:
+        old_values = old.values if old is not None else {}
+        new_values = new.values if new is not None else {}
+        old_timestamp = old.timestamp if old is not None else datetime.min
+        new_timestamp = new.timestamp if new is not None else datetime.min
+        for name in sorted(set(old_values.keys()) | set(new_values.keys())):
+            if name not in old_values:
+                deltas.append(get_delta('added', subtree, name, old_timestamp, new_timestamp, []))
+            elif name not in new_values:
+                deltas.append(get_delta('removed', subtree, name, old_timestamp, new_timestamp, []))
+            elif old_values[name] != new_values[name]:
+                deltas.append(get_delta('changed', subtree, name, old_timestamp, new_timestamp, ['values']))
+        return
+
+    old_subkeys = old.subkeys if old is not None else {}
+    new_subkeys = new.subkeys if new is not None else {}
+    for name in sorted(set(old_subkeys.keys()) | set(new_subkeys.keys())):
+        old_key = old_subkeys.get(name)
+        new_key = new_subkeys.get(name)
+        key_name = (new_key or old_key).name
+        key_device = device + '\\' + key_name if len(device) > 0 else key_name
+
+        if depth > 1:
+            diff_subtree(old_key, new_key, subtree, key_device, depth - 1, deltas)
+        elif old_key is None:
+            deltas.append(get_delta('added', subtree, key_device, datetime.min, new_key.timestamp, []))
+        elif new_key is None:
+            deltas.append(get_delta('removed', subtree, key_device, old_key.timestamp, datetime.min, []))
+        elif old_key.digest != new_key.digest:
+            detail = []
+            if old_key.timestamp != new_key.timestamp:
+                detail.append('timestamp')
+            if old_key.values != new_key.values:
+                detail.append('values')
+            if [(n, k.digest) for n, k in sorted(old_key.subkeys.items())] != [(n, k.digest) for n, k in sorted(new_key.subkeys.items())]:
+                detail.append('subkeys')
+            deltas.append(get_delta('changed', subtree, key_device, old_key.timestamp, new_key.timestamp, detail))
+
+
+def get_delta(change, subtree, device, old_timestamp, new_timestamp, detail):
+    """Returns a device level change between two hive versions"""
+    return {'from': '',
+            'to': '',
+            'change': change,
+            'subtree': subtree,
+            'device': device,
+            'old_timestamp': old_timestamp,
+            'new_timestamp': new_timestamp,
+            'detail': detail}
+
+
+def output_diff_summary(old_path, new_path, deltas, skipped):
+    """Outputs the number of changes between two hive versions to StdOut"""
+    counts = {'added': 0, 'removed': 0, 'changed': 0}
+    for delta in deltas:
+        counts[delta['change']] += 1
+
+    print('%s -> %s: %d added, %d removed, %d changed, %d subtrees unchanged' % (
+        old_path, new_path, counts['added'], counts['removed'], counts['changed'], skipped))
+
+
+def output_diff_to_file(output, deltas):
+    """Outputs the snapshot deltas to a file in CSV format"""
+    write_debug(data='Method: output_diff_to_file')
+
+    with open(output, 'wb') as f:
+        f.write('From\tTo\tChange\tSubtree\tDevice\tOld Timestamp\tNew Timestamp\tDetail\n')
+        writer = csv.writer(f, delimiter='\t', quotechar='"', quoting=csv.QUOTE_ALL)
+        for delta in deltas:
+            data = [delta['from'], delta['to'], delta['change'], delta['subtree'].encode('utf-8'),
+                    delta['device'].encode('utf-8')]
+            for name in ['old_timestamp', 'new_timestamp']:
+                if delta[name] != datetime.min:
+                    data.append(delta[name].strftime('%Y-%m-%dT%H:%M:%S'))
+                else:
+                    data.append('')
+            data.append(','.join(delta['detail']))
+            writer.writerow(data)
+
+
+# Find Methods ################################################################
+
+def process_find(registry_path):
+    """Targeted lookup of the find terms. The terms are resolved to the USBSTOR serial
+    key names (or ParentIdPrefix) that they refer to, so only the matching USBSTOR
+    keys are descended into and the later stages only join to those devices. When
+    nothing matches, the SOFTWARE and NTUSER hives and the logs are skipped"""
+    software_hives = None
+    if any(kind == 'volume_serial' for kind, term, value in find_terms):
+        # The volume serial numbers are only in the SOFTWARE hive, which is kept
+        # loaded so that it is processed later without being loaded again
+        software_hives = []
+        for root, f, registry in load_hives(registry_path):
+            if registry.hive_type() == Registry.HiveType.SOFTWARE:
+                run_stage('resolve_volume_serial_terms', f, resolve_volume_serial_terms, registry)
+                software_hives.append((root, f, registry))
+
+    process_registry_hive(registry_path, Registry.HiveType.SYSTEM)
+
+    if len(usb_devices) > 0:
+        process_registry_hive(registry_path, Registry.HiveType.SOFTWARE, software_hives)
+        process_registry_hive(registry_path, Registry.HiveType.NTUSER)
+        process_log_files(registry_path)
+    elif quiet_mode is False:
+        print('No devices match the find terms, skipping the SOFTWARE and NTUSER hives and the logs')
+
+    output_find_results()
+
+
+def parse_find_terms(terms):
+    """Returns a list of (kind, term, normalised value) for the find terms"""
+    parsed = []
+    for term in terms:
+        match = re.match(REGEX_FIND_VID_PID, term, re.I)
+        if match:
+            parsed.append(('vid_pid', term, ('VID_' + match.group(1) + '&PID_' + match.group(2)).upper()))
+            continue
+
+        match = re.match(REGEX_FIND_GUID, term, re.I)
+        if match:
+            parsed.append(('guid', term, match.group(1).lower()))
+            continue
+
+        match = re.match(REGEX_FIND_VOLUME_SERIAL, term, re.I)
+        if match:
+            parsed.append(('volume_serial', term, str(int(match.group(1) + match.group(2), 16))))
+            continue
+
+        parsed.append(('serial', term, term.lower()))
+        find_identifiers.add(term.lower())
+
+    return parsed
+
+
+def resolve_find_terms(registry):
+    """Resolves the VID/PID terms (from the Enum\\USB key names) and the volume GUID
+    terms (from MountedDevices) to the USBSTOR serial key names they refer to"""
+    vid_pids = set(value for kind, term, value in find_terms if kind == 'vid_pid')
+    if len(vid_pids) > 0:
+        for c in get_control_sets(registry):
+            try:
+                key = registry.open(c + '\\Enum\\USB')
+            except Registry.RegistryKeyNotFoundException:
+                continue
+
+            for sub_key in key.subkeys():
+                if sub_key.name().upper() not in vid_pids:
+                    continue
+                for serial_key in sub_key.subkeys():
+                    write_debug(name='Find VID/PID serial', value=serial_key.name())
+                    find_identifiers.add(serial_key.name().lower())
+
+    guids = set(value for kind, term, value in find_terms if kind == 'guid')
+    if len(guids) > 0:
+        reg_key = registry.root().find_key('MountedDevices')
+        if reg_key is None:
+            return
+
+        for reg_value in reg_key.values():
+            if not '\\Volume{' in reg_value.name():
+                continue
+            if reg_value.name()[11:-1].lower() not in guids:
+                continue
+
+            identifier = get_mountpoint_serial(remove_non_ascii_characters(reg_value.value()))
+            if identifier is not None:
+                write_debug(name='Find volume GUID serial', value=identifier)
+                find_identifiers.add(identifier)
+
+
+def resolve_volume_serial_terms(registry):
+    """Resolves the volume serial number terms to the USBSTOR serial key names using the EMDMgmt key names"""
+    volume_serials = set(value for kind, term, value in find_terms if kind == 'volume_serial')
+    try:
+        key = registry.open('Microsoft\\Windows NT\\CurrentVersion\\EMDMgmt')
+    except Registry.RegistryKeyNotFoundException:
+        return
+
+    for sub_key in key.subkeys():
+        name = sub_key.name()
+        if '_' not in name or name[name.rfind('_') + 1:] not in volume_serials:
+            continue
+
+        identifier = get_mountpoint_serial(name)
+        if identifier is not None:
+            write_debug(name='Find volume serial serial', value=identifier)
+            find_identifiers.add(identifier)
+
+
+def get_mountpoint_serial(data):
+    """Returns the serial number (or ParentIdPrefix) part of a USBSTOR device path
+    e.g. _??_USBSTOR#Disk&Ven_SanDisk&Prod_Cruzer&Rev_7.01#2444120C4E80D827&0#{53f56307-...}
+    or _??_STORAGE#RemovableMedia#7&326659cd&0&RM#{53f56307-...}"""
+    index = data.upper().find('USBSTOR#')
+    if index != -1:
+        parts = data[index:].split('#')
+        if len(parts) < 3 or len(parts[2]) == 0:
+            return None
+        return parts[2].lower()
+
+    index = data.upper().find('REMOVABLEMEDIA#')
+    if index != -1:
+        parts = data[index:].split('#')
+        if len(parts) < 2 or len(parts[1]) == 0:
+            return None
+        return re.sub('&rm$', '', parts[1].lower())
+
+    return None
+
+
+def get_find_hit(device_sk):
+    """Returns the find identifier that a USBSTOR serial key matches, or None"""
+    name = device_sk.name().lower()
+    if name in find_identifiers:
+        return name
+
+    parts_serial_no = name.split('&')
+    if len(parts_serial_no) == 2 and parts_serial_no[0] in find_identifiers:
+        return parts_serial_no[0]
+
+    reg_value = get_reg_value(device_sk, 'ParentIdPrefix')
+    if reg_value is not None and reg_value.value().lower() in find_identifiers:
+        return reg_value.value().lower()
+
+    return None
+
+
+def is_find_complete():
+    """Returns True once every find identifier has been found, so the lookup can stop early"""
+    return find_identifiers.issubset(find_found)
+
+
+def output_find_results():
+    """Outputs whether each of the find terms was found to StdOut"""
+    for kind, term, value in find_terms:
+        count = 0
+        for device in usb_devices:
+            if kind == 'serial':
+                matched = value in [device.serial_number.lower(), device.parent_prefix_id.lower()]
+            elif kind == 'vid_pid':
+                matched = (device.vid + '&' + device.pid).upper() == value
+            elif kind == 'guid':
+                matched = device.guid.lower() == value
+            else:
+                matched = any(emd.volume_serial_num == value for emd in device.emdmgmt)
+            if matched:
+                count += 1
+
+        if count > 0:
+            print('Find: %s (%s) found in %d device(s)' % (term, kind, count))
+        else:
+            print('Find: %s (%s) not found' % (term, kind))
+
+
+# Device List Methods #########################################################
+
+def apply_device_lists():
+    """
+    Tags every device as approved, unknown or watchlisted. In violations only mode the
+    approved devices (and the unknown devices when there is no allowlist) are dropped
+    """
+    global usb_devices
+
+    if violations_only is False:
+        for device in usb_devices:
+            device.policy = get_device_policy(device)
+        return
+
+    if isinstance(usb_devices, DeviceStore):
+        violations = DeviceStore(usb_devices.cache_size)
+    else:
+        violations = []
+
+    for device in usb_devices:
+        device.policy = get_device_policy(device)
+        if device.policy == 'watchlisted' or (device.policy == 'unknown' and allowlist is not None):
+            violations.append(device)
+
+    write_debug(name='Policy violations', value=str(len(violations)))
+
+    if isinstance(usb_devices, DeviceStore):
+        usb_devices.close()
+    usb_devices = violations
+
+
+def get_device_policy(device):
+    """Returns the policy tag for a device, the watchlist taking precedence over the allowlist"""
+    digests = get_device_digests(device.serial_number, device.vid, device.pid)
+    if watchlist is not None and any(digest in watchlist for digest in digests):
+        return 'watchlisted'
+    if allowlist is not None and any(digest in allowlist for digest in digests):
+        return 'approved'
+
+    return 'unknown'
+
+
+def get_device_digests(serial_number, vid, pid):
+    """
+    Returns the digests that a device matches on, the exact serial/VID/PID entry, a
+    serial only entry and a VID/PID entry for any serial (serial of *)
+    """
+    return [get_device_list_digest(serial_number, vid, pid),
+            get_device_list_digest(serial_number, '', ''),
+            get_device_list_digest('*', vid, pid)]
+
+
+def get_device_list_digest(serial_number, vid, pid):
+    """Returns the MD5 digest of a normalised list entry"""
+    vid = vid.upper()
+    if len(vid) > 0 and not vid.startswith('VID_'):
+        vid = 'VID_' + vid
+    pid = pid.upper()
+    if len(pid) > 0 and not pid.startswith('PID_'):
+        pid = 'PID_' + pid
+
+    return hashlib.md5((serial_number.lower() + '|' + vid + '|' + pid).encode('utf-8')).digest()
+
+
+def read_device_list_digests(path):
+    """
+    Reads a text device list, one serial[,VID,PID] entry per line (comma or tab
+    separated, # for comments), returning the sorted unique digests. An entry with any
+    other number of fields is an error, rather than being skipped, as a skipped
+    watchlist entry would silently miss the device
+    """
+    digests = set()
+    with open(path, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.decode('utf-8').strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+
+            parts = [part.strip() for part in re.split('[,\t]', line)]
+            if len(parts) == 1:
+                digests.add(get_device_list_digest(parts[0], '', ''))
+            elif len(parts) == 3:
+                digests.add(get_device_list_digest(parts[0], parts[1], parts[2]))
+            else:
+                raise ValueError('Invalid device list entry on line ' + str(line_number) + ' of ' + path +
+                                 ', expected serial or serial,VID,PID: ' + line.encode('utf-8'))
+
+    return sorted(digests)
+
+
+def build_device_list(input, output):
+    """Converts a text device list into the prebuilt format that is memory mapped when loaded"""
+    digests = read_device_list_digests(input)
+    with open(output, 'wb') as f:
+        f.write(DEVICE_LIST_MAGIC)
+        f.write(struct.pack('<Q', len(digests)))
+        for digest in digests:
+            f.write(digest)
+
+    if quiet_mode is False:
+        print('Device list written: ' + output + ' (' + str(len(digests)) + ' entries)')
+
+
+# Transaction Log Methods #####################################################
+
+def read_base_block(file):
+    """Returns the first sector of a file, which holds the base block of a hive or transaction log"""
+    with open(file, 'rb') as f:
+        return f.read(BASE_BLOCK_SIZE)
+
+
+def is_transaction_log(base_block):
+    """Returns True if the base block is from a transaction log, identified by the file type"""
+    if len(base_block) < BASE_BLOCK_SIZE or base_block[0:4] != 'regf':
+        return False
+
+    return struct.unpack('<I', base_block[0x1C:0x20])[0] != 0
+
+
+def is_hive_dirty(base_block):
+    """A hive is dirty when the primary and secondary sequence numbers differ, as the
+    last write was not completed and the changes are only in the transaction logs"""
+    if len(base_block) < BASE_BLOCK_SIZE or base_block[0:4] != 'regf':
+        return False
+
+    primary, secondary = struct.unpack('<II', base_block[4:12])
+    return primary != secondary
+
+
+def get_transaction_logs(file):
+    """Returns the paths of the transaction logs (.LOG, .LOG1, .LOG2) alongside a hive"""
+    directory, name = os.path.split(file)
+    logs = []
+    for f in os.listdir(directory or '.'):
+        file_name, ext = os.path.splitext(f)
+        if file_name.lower() == name.lower() and ext.lower() in LOG_EXTENSIONS:
+            logs.append(os.path.join(directory, f))
+
+    return sorted(logs)
+
+
+def replay_transaction_logs(file, data):
+    """Replays the transaction logs of a dirty hive into an in-memory copy of it, the
+    hive and logs on disk are never modified. The new format log entries are applied
+    in sequence number order across both logs, stopping at the first entry that is
+    out of sequence or fails its hash, otherwise the latest old format log is applied"""
+    hive = bytearray(data)
+    secondary = struct.unpack('<I', data[8:12])[0]
+
+    old_logs = []
+    new_logs = []
+    for log_path in get_transaction_logs(file):
+        with open(log_path, 'rb') as f:
+            log_data = f.read()
+        if manifest_mode is True:
+            add_to_manifest(log_path, log_data)
+
+        if len(log_data) < BASE_BLOCK_SIZE + 4 or log_data[0:4] != 'regf':
+            continue
+
+        primary, log_secondary = struct.unpack('<II', log_data[4:12])
+        signature = log_data[BASE_BLOCK_SIZE:BASE_BLOCK_SIZE + 4]
+        if signature == 'HvLE':
+            new_logs.append((primary, log_path, log_data))
+        elif signature == 'DIRT' and primary == log_secondary:
+            old_logs.append((primary, log_path, log_data))
+
+    applied = 0
+    if len(new_logs) > 0:
+        last_sequence = None
+        for primary, log_path, log_data in sorted(new_logs):
+            for sequence, bins_size, pages in get_log_entries(log_data, primary):
+                if sequence < secondary or (last_sequence is not None and sequence <= last_sequence):
+                    continue
+                apply_dirty_pages(hive, bins_size, pages)
+                last_sequence = sequence
+                applied += 1
+    elif len(old_logs) > 0:
+        primary, log_path, log_data = max(old_logs)
+        if primary >= secondary:
+            bins_size = struct.unpack('<I', log_data[0x28:0x2C])[0]
+            apply_dirty_pages(hive, bins_size, get_dirty_sectors(log_data, bins_size))
+            applied += 1
+
+    if quiet_mode is False:
+        print('Replayed %d transaction log entries into an in-memory copy of: %s' % (applied, file))
+
+    # Mark the copy as clean
+    hive[8:12] = hive[4:8]
+    checksum = 0
+    for value in struct.unpack('<127I', bytes(hive[0:0x1FC])):
+        checksum ^= value
+    hive[0x1FC:0x200] = struct.pack('<I', checksum)
+
+    return bytes(hive)
+
+
+def get_log_entries(log_data, sequence):
+    """Yields (sequence number, hive bins data size, [(offset, data)]) for each valid new
+    format log entry, starting with the expected sequence number of the log"""
+    position = BASE_BLOCK_SIZE
+    while position + LOG_ENTRY_HEADER_SIZE <= len(log_data) and log_data[position:position + 4] == 'HvLE':
+        size, flags, entry_sequence, bins_size, page_count, hash1, hash2 = struct.unpack(
+            '<IIIIIQQ', log_data[position + 4:position + LOG_ENTRY_HEADER_SIZE])
+        if size < LOG_ENTRY_HEADER_SIZE or position + size > len(log_data) or entry_sequence != sequence:
+            return
+
+        entry = log_data[position:position + size]
+        if marvin32(entry[0:32]) != hash2 or marvin32(entry[LOG_ENTRY_HEADER_SIZE:]) != hash1:
+            write_debug(data='Transaction log entry failed its hash: ' + str(entry_sequence))
+            return
+
+        # The dirty page references are followed by the pages in the same order
+        pages = []
+        page_data = LOG_ENTRY_HEADER_SIZE + page_count * 8
+        for index in range(page_count):
+            reference = LOG_ENTRY_HEADER_SIZE + index * 8
+            offset, page_size = struct.unpack('<II', entry[reference:reference + 8])
+            pages.append((offset, entry[page_data:page_data + page_size]))
+            page_data += page_size
+
+        yield (entry_sequence, bins_size, pages)
+
+        sequence += 1
+        position += size
+
+
+def get_dirty_sectors(log_data, bins_size):
+    """Returns [(offset, data)] for the sectors marked in the dirty vector of an old format log"""
+    vector_size = bins_size // LOG_SECTOR_SIZE // 8
+    vector = log_data[BASE_BLOCK_SIZE + 4:BASE_BLOCK_SIZE + 4 + vector_size]
+
+    # The dirty sectors follow the vector, aligned to a sector
+    position = BASE_BLOCK_SIZE + 4 + vector_size
+    position += (LOG_SECTOR_SIZE - position % LOG_SECTOR_SIZE) % LOG_SECTOR_SIZE
+
+    sectors = []
+    for index in range(len(vector)):
+        byte = ord(vector[index])
+        if byte == 0:
+            continue
+        for bit in range(8):
+            if byte & (1 << bit):
+                sectors.append(((index * 8 + bit) * LOG_SECTOR_SIZE, log_data[position:position + LOG_SECTOR_SIZE]))
+                position += LOG_SECTOR_SIZE
+
+    return sectors
+
+
+def apply_dirty_pages(hive, bins_size, pages):
+    """Writes dirty pages into the hive copy at their offsets from the first hbin, resizing it to the hive bins data size"""
+    size = HIVE_BINS_OFFSET + bins_size
+    if len(hive) < size:
+        hive.extend('\x00' * (size - len(hive)))
+    elif len(hive) > size:
+        del hive[size:]
+
+    for offset, data in pages:
+        start = HIVE_BINS_OFFSET + offset
+        if start + len(data) <= len(hive):
+            hive[start:start + len(data)] = data
+
+    hive[0x28:0x2C] = struct.pack('<I', bins_size)
+
+
+def marvin32(data, seed=MARVIN32_SEED):
+    """Returns the Marvin32 hash of the data, used to validate the new format log entries"""
+    low = seed & 0xFFFFFFFF
+    high = seed >> 32
+
+    count = len(data) // 4
+    values = list(struct.unpack('<%dI' % count, data[:count * 4]))
+
+    # The final partial block is padded with 0x80
+    tail = data[count * 4:]
+    final = 0x80 << (8 * len(tail))
+    for index in range(len(tail)):
+        final |= ord(tail[index]) << (8 * index)
+    values.append(final & 0xFFFFFFFF)
+    values.append(0)
+
+    for value in values:
+        low = (low + value) & 0xFFFFFFFF
+        high ^= low
+        low = ((low << 20) | (low >> 12)) & 0xFFFFFFFF
+        low = (low + high) & 0xFFFFFFFF
+        high = ((high << 9) | (high >> 23)) & 0xFFFFFFFF
+        high ^= low
+        low = ((low << 27) | (low >> 5)) & 0xFFFFFFFF
+        low = (low + high) & 0xFFFFFFFF
+        high = ((high << 19) | (high >> 13)) & 0xFFFFFFFF
+
+    return (high << 32) | low
+
+
+# Timeline Methods ############################################################
+
+def output_timeline_to_file(output, timeline_format):
+    """
+    Outputs one event per device, source and timestamp in global chronological order.
+
+    The devices are read once, in order, and their events are sorted in runs of at most
+    TIMELINE_RUN_SIZE events. A timeline that fits in one run is written straight from
+    memory, otherwise each run is written to a temporary file and the runs are k-way
+    merged, so no more than one run of events is held in memory
+    """
+    write_debug(data='Method: output_timeline_to_file')
+
+    with open(output, "wb") as f:
+        if timeline_format == 'csv':
+            f.write('Timestamp\tSource\tUser\tVendor\tProduct\tVersion\tSerialNumber\tVID\tPID\tDriveLetter\tGUID\n')
+
+        runs = []
+        try:
+            events = []
+            for event in get_timeline_events(timeline_format):
+                events.append(event)
+                if len(events) >= TIMELINE_RUN_SIZE:
+                    runs.append(write_timeline_run(events))
+                    events = []
+
+            if len(runs) == 0:
+                events.sort()
+                for key, line in events:
+                    f.write(line)
+                return
+
+            runs.append(write_timeline_run(events))
+            write_debug(name='Timeline runs', value=str(len(runs)))
+            for key, line in heapq.merge(*[read_timeline_run(run) for run in runs]):
+                f.write(line)
+        finally:
+            for run in runs:
+                run.close()
+
+
+def get_timeline_events(timeline_format):
+    """
+    Yields a (sort key, formatted line) per event of each device. The key orders identical
+    timestamps by TIMELINE_SOURCES then MountPoints2 and EMDMgmt, then by device and user
+    """
+    for device_index, device in enumerate(usb_devices):
+        for stream_index in range(len(TIMELINE_SOURCES)):
+            source, attribute = TIMELINE_SOURCES[stream_index]
+            timestamp = getattr(device, attribute)
+            if timestamp == datetime.min:
+                continue
+            if attribute in device.low_confidence:
+                source += ' (low confidence)'
+            yield ((timestamp, stream_index, device_index, ''),
+                   format_timeline_event(timeline_format, timestamp, source, device, ''))
+
+        for mp in device.mountpoint2:
+            if mp.timestamp == datetime.min:
+                continue
+            yield ((mp.timestamp, len(TIMELINE_SOURCES), device_index, mp.file),
+                   format_timeline_event(timeline_format, mp.timestamp, 'MountPoints2', device, mp.file))
+
+        for emd in device.emdmgmt:
+            if emd.timestamp == datetime.min:
+                continue
+            yield ((emd.timestamp, len(TIMELINE_SOURCES) + 1, device_index, ''),
+                   format_timeline_event(timeline_format, emd.timestamp, 'EMDMgmt', device, ''))
+
+
+def write_timeline_run(events):
+    """Sorts the events and writes them to a temporary file, which is deleted when it is closed"""
+    events.sort()
+    run = tempfile.TemporaryFile(prefix='usbdeviceforensics')
+    for event in events:
+        pickle.dump(event, run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+
+    return run
+
+
+def read_timeline_run(run):
+    """Yields the events of a run written by write_timeline_run"""
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+
+def format_timeline_event(timeline_format, timestamp, source, device, user):
+    """Returns the output line of a timeline event"""
+    if timeline_format == 'bodyfile':
+        # MD5|name|inode|mode_as_string|UID|GID|size|atime|mtime|ctime|crtime
+        return ('0|' + get_timeline_description(device, source, user).encode('utf-8') +
+                '|0|0|0|0|0|0|' + str(get_epoch_seconds(timestamp)) + '|0|0\n')
+    elif timeline_format == 'tln':
+        # Time|Source|Host|User|Description
+        return (str(get_epoch_seconds(timestamp)) + '|USB||' + user.encode('utf-8') + '|' +
+                get_timeline_description(device, source, '').encode('utf-8') + '\n')
+
+    line = io.BytesIO()
+    writer = csv.writer(line, delimiter='\t', quotechar='"', quoting=csv.QUOTE_ALL)
+    writer.writerow([timestamp.strftime('%Y-%m-%dT%H:%M:%S'),
+                     source,
+                     user.encode('utf-8'),
+                     device.vendor.encode('utf-8'),
+                     device.product.encode('utf-8'),
+                     device.version.encode('utf-8'),
+                     device.serial_number.encode('utf-8'),
+                     device.vid.encode('utf-8'),
+                     device.pid.encode('utf-8'),
+                     device.drive_letter.encode('utf-8'),
+                     device.guid.encode('utf-8')])
+
+    return line.getvalue()
+
+
+def get_timeline_description(device, source, user):
+    """Returns a single line description of a timeline event, without any pipe characters"""
+    description = (source + ': ' + device.vendor + ' ' + device.product + ' ' + device.version +
+                   ' (Serial: ' + device.serial_number + ')')
+    if len(device.drive_letter) > 0:
+        description += ' [' + device.drive_letter + ']'
+    if len(user) > 0:
+        description += ' User: ' + user
+
+    return description.replace('|', '_')
+
+
+def get_epoch_seconds(timestamp):
+    """Converts a naive UTC datetime to seconds since the Unix epoch"""
+    delta = timestamp - datetime(1970, 1, 1)
+    return delta.days * 86400 + delta.seconds
+
+
+# Fleet Table Methods #########################################################
+
+class DeviceTable():
+    """Columnar (NumPy) view of the devices from one or more hosts, one row per device"""
+    def __init__(self):
+        self.hosts = []
+        self.host_ids = None
+        self.categories = {}
+        self.codes = {}
+        self.filetimes = {}
+
+    def __len__(self):
+        return len(self.host_ids)
+
+    def get_values(self, attribute):
+        """Decodes a categorical column back into an array of strings"""
+        return self.categories[attribute][self.codes[attribute]]
+
+    def get_datetimes(self, attribute):
+        """Returns a FILETIME column as datetime64[us], with NaT for missing values"""
+        return filetimes_to_datetime64(self.filetimes[attribute])
+
+    def take(self, indexes):
+        """Returns a new table holding the rows at the supplied indexes (or boolean mask)"""
+        table = DeviceTable()
+        table.hosts = self.hosts
+        table.host_ids = self.host_ids[indexes]
+        table.categories = self.categories
+        for attribute in self.codes:
+            table.codes[attribute] = self.codes[attribute][indexes]
+        for attribute in self.filetimes:
+            table.filetimes[attribute] = self.filetimes[attribute][indexes]
+
+        return table
+
+    def sort(self, attribute):
+        """Returns a new table sorted by a FILETIME column, stable so ties keep their host order"""
+        return self.take(numpy.argsort(self.filetimes[attribute], kind='mergesort'))
+
+    def filter_time_range(self, attribute, start, end):
+        """Returns a new table holding the rows where the FILETIME column is within [start, end]"""
+        values = self.filetimes[attribute]
+        return self.take((values >= datetime_to_filetime(start)) & (values <= datetime_to_filetime(end)))
+
+    def filter_value(self, attribute, value):
+        """Returns a new table holding the rows where a categorical column equals value"""
+        matches = numpy.nonzero(self.categories[attribute] == value)[0]
+        if len(matches) == 0:
+            return self.take(numpy.zeros(len(self), dtype=bool))
+
+        return self.take(self.codes[attribute] == matches[0])
+
+
+def build_device_table(host_devices):
+    """
+    Materialises a list of (host name, list of UsbDevice) into a DeviceTable.
+
+    The timestamps are stored as int64 FILETIMEs (0 when missing) and each string
+    column as codes into the sorted array of its own unique values
+    """
+    if numpy is None:
+        raise ImportError('The numpy module is required to build a device table')
+
+    table = DeviceTable()
+    host_ids = []
+    strings = {}
+    for attribute in TABLE_CATEGORY_FIELDS:
+        strings[attribute] = []
+    filetimes = {}
+    for source, attribute in TIMELINE_SOURCES:
+        filetimes[attribute] = []
+
+    for host, devices in host_devices:
+        table.hosts.append(host)
+        for device in devices:
+            host_ids.append(len(table.hosts) - 1)
+            for attribute in TABLE_CATEGORY_FIELDS:
+                strings[attribute].append(getattr(device, attribute))
+            for source, attribute in TIMELINE_SOURCES:
+                filetimes[attribute].append(datetime_to_filetime(getattr(device, attribute)))
+
+    table.host_ids = numpy.array(host_ids, dtype=numpy.int32)
+    for attribute in TABLE_CATEGORY_FIELDS:
+        categories, codes = numpy.unique(numpy.array(strings[attribute], dtype=object), return_inverse=True)
+        table.categories[attribute] = categories
+        table.codes[attribute] = codes.astype(numpy.int32)
+    for source, attribute in TIMELINE_SOURCES:
+        table.filetimes[attribute] = numpy.array(filetimes[attribute], dtype=numpy.int64)
+
+    return table
+
+
+def load_device_table(csv_paths):
+    """
+    Loads the CSV output files (-f csv) from a number of hosts into a DeviceTable.
+
+    The host name is taken from the file path, see get_host_names
+    """
+    host_devices = []
+    for host, csv_path in zip(get_host_names(csv_paths), csv_paths):
+        host_devices.append((host, load_devices_from_csv(csv_path)))
+
+    return build_device_table(host_devices)
+
+
+def load_devices_from_csv(csv_path):
+    """Reads the devices back from a CSV output file, including the MountPoints2/EMDMgmt columns"""
+    devices = []
+    with open(csv_path, 'rb') as f:
+        # The header row is not quoted so parse it before handing over to the CSV reader. The
+        # MountPoints2/EMDMgmt column counts come from the header as they vary between files
+        header = f.readline().rstrip('\r\n').split('\t')
+        num_mp2 = len([name for name in header if name.startswith('MountPoints2:')])
+        num_emd_mgmt = len([name for name in header if name.startswith('EMDMgmt:')])
+        extra_columns = [(header.index(name), attribute) for name, attribute in CSV_EXTRA_COLUMNS
+                         if name in header and attribute is not None]
+        start = len(CSV_DEVICE_COLUMNS) + len([name for name, attribute in CSV_EXTRA_COLUMNS if name in header])
+
+        for row in csv.reader(f, delimiter='\t', quotechar='"'):
+            if len(row) < len(CSV_DEVICE_COLUMNS):
+                continue
+
+            device = UsbDevice()
+            for index in range(len(CSV_DEVICE_COLUMNS)):
+                attribute = CSV_DEVICE_COLUMNS[index]
+                if 'datetime' in attribute:
+                    setattr(device, attribute, parse_csv_datetime(row[index]))
+                elif attribute in TABLE_CATEGORY_FIELDS:
+                    setattr(device, attribute, intern_string(row[index].decode('utf-8')))
+                else:
+                    setattr(device, attribute, row[index].decode('utf-8'))
+
+            for index, attribute in extra_columns:
+                if index >= len(row):
+                    continue
+                if 'datetime' in attribute:
+                    setattr(device, attribute, parse_csv_datetime(row[index]))
+                elif attribute == 'low_confidence':
+                    if len(row[index]) > 0:
+                        device.low_confidence = row[index].split(', ')
+                else:
+                    setattr(device, attribute, row[index].decode('utf-8'))
+
+            position = start
+            for i in range(num_mp2):
+                values = row[position:position + 2]
+                position += 2
+                if len(values) < 2 or len(values[1]) == 0:
+                    continue
+
+                mp = MountPoint2()
+                mp.timestamp = parse_csv_datetime(values[0])
+                mp.file = values[1].decode('utf-8')
+                device.mountpoint2.append(mp)
+
+            for i in range(num_emd_mgmt):
+                values = row[position:position + 4]
+                position += 4
+                if len(values) < 4 or len(values[1]) == 0:
+                    continue
+
+                emd = EmdMgmt()
+                emd.timestamp = parse_csv_datetime(values[0])
+                emd.volume_serial_num = values[1].decode('utf-8')
+                emd.volume_serial_num_hex = values[2].decode('utf-8')
+                emd.volume_name = values[3].decode('utf-8')
+                device.emdmgmt.append(emd)
+
+            devices.append(device)
+
+    return devices
+
+
+def parse_csv_datetime(value):
+    """Parses a date/time as written by the CSV output, returning datetime.min when empty"""
+    if len(value) == 0:
+        return datetime.min
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def datetime_to_filetime(timestamp):
+    """Converts a naive UTC datetime to a FILETIME, datetime.min becoming 0"""
+    if timestamp == datetime.min:
+        return 0
+
+    delta = timestamp - datetime(1601, 1, 1)
+    return (delta.days * 86400 + delta.seconds) * 10000000 + delta.microseconds * 10
+
+
+def filetimes_to_datetime64(filetimes):
+    """Vectorised FILETIME to datetime64[us] conversion, 0 becoming NaT"""
+    result = ((filetimes - FILETIME_EPOCH_DELTA) // 10).astype('datetime64[us]')
+    result[filetimes == 0] = numpy.datetime64('NaT')
+    return result
+
+
+# Mass Update Methods #########################################################
+
+def detect_mass_updates():
+    """
+    Marks the key timestamps that collapse to the same instant across a number of devices
+    as low confidence, as an update process can rewrite the Last Written times of all
+    of the USBSTOR/Enum\\USB/DeviceClasses keys
+    """
+    write_debug(data='Method: detect_mass_updates')
+
+    if numpy is None:
+        write_debug(data='The numpy module is not installed, mass updated timestamps are not detected')
+        return
+
+    filetimes = []
+    devices = []
+    fields = []
+    for device_index in range(len(usb_devices)):
+        device = usb_devices[device_index]
+        for field_index in range(len(MASS_UPDATE_FIELDS)):
+            timestamp = getattr(device, MASS_UPDATE_FIELDS[field_index])
+            if timestamp == datetime.min:
+                continue
+            filetimes.append(datetime_to_filetime(timestamp))
+            devices.append(device_index)
+            fields.append(field_index)
+
+    if len(filetimes) == 0:
+        return
+
+    devices = numpy.array(devices, dtype=numpy.int64)
+    mask, clusters = find_timestamp_clusters(numpy.array(filetimes, dtype=numpy.int64),
+                                             numpy.zeros(len(filetimes), dtype=numpy.int64),
+                                             devices)
+
+    for group, filetime, device_count, key_count in clusters:
+        write_debug(name='Mass updated timestamp', value=filetimes_to_datetime64(numpy.array([filetime]))[0].astype(str) +
+                    ' (' + str(device_count) + ' devices, ' + str(key_count) + ' keys)')
+        if quiet_mode is False:
+            print('Mass updated timestamps: ' + str(key_count) + ' keys of ' + str(device_count) + ' devices at ' +
+                  filetimes_to_datetime64(numpy.array([filetime]))[0].astype(str))
+
+    fields = numpy.array(fields, dtype=numpy.int64)
+    for device_index in numpy.unique(devices[mask]):
+        device = usb_devices[int(device_index)]
+        flagged = set(fields[mask & (devices == device_index)])
+        device.low_confidence = [MASS_UPDATE_FIELDS[field_index] for field_index in range(len(MASS_UPDATE_FIELDS))
+                                 if field_index in flagged]
+
+
+def detect_fleet_mass_updates(table):
+    """
+    Detects the mass updated timestamps of every host in a DeviceTable in one pass. Returns
+    the list of (host, timestamp, device count, key count) clusters
+    """
+    filetimes = []
+    hosts = []
+    rows = []
+    for field in MASS_UPDATE_FIELDS:
+        present = numpy.nonzero(table.filetimes[field] != 0)[0]
+        filetimes.append(table.filetimes[field][present])
+        hosts.append(table.host_ids[present])
+        rows.append(present)
+
+    mask, clusters = find_timestamp_clusters(numpy.concatenate(filetimes).astype(numpy.int64),
+                                             numpy.concatenate(hosts).astype(numpy.int64),
+                                             numpy.concatenate(rows).astype(numpy.int64))
+
+    return [(table.hosts[group], filetimes_to_datetime64(numpy.array([filetime]))[0], device_count, key_count)
+                   for group, filetime, device_count, key_count in clusters]
+
+
+def find_timestamp_clusters(filetimes, groups, devices):
+    """
+    Clusters the timestamps of each group (host) where consecutive timestamps are less than
+    MASS_UPDATE_WINDOW apart. Returns a boolean mask of the timestamps in the flagged clusters,
+    see MASS_UPDATE_MIN_DEVICES, and the (group, first FILETIME, device count, key count) of
+    those clusters
+    """
+    if len(filetimes) == 0:
+        return numpy.zeros(0, dtype=bool), []
+
+    order = numpy.lexsort((filetimes, groups))
+    sorted_filetimes = filetimes[order]
+    sorted_groups = groups[order]
+
+    starts = numpy.ones(len(order), dtype=bool)
+    starts[1:] = ((sorted_groups[1:] != sorted_groups[:-1]) |
+                  (sorted_filetimes[1:] - sorted_filetimes[:-1] >= MASS_UPDATE_WINDOW))
+    cluster_ids = numpy.cumsum(starts) - 1
+    num_clusters = cluster_ids[-1] + 1
+
+    # Distinct devices per cluster, a device has several keys in the same cluster when it is plugged in
+    stride = devices.max() + 1
+    pairs = numpy.unique(cluster_ids * stride + devices[order])
+    device_counts = numpy.bincount(pairs // stride, minlength=num_clusters)
+    key_counts = numpy.bincount(cluster_ids, minlength=num_clusters)
+
+    # Distinct devices per group, for the fraction of the host's devices each cluster spans
+    group_pairs = numpy.unique(groups * stride + devices)
+    group_device_counts = numpy.bincount(group_pairs // stride)
+    first_indexes = numpy.nonzero(starts)[0]
+    host_device_counts = group_device_counts[sorted_groups[first_indexes]]
+
+    flagged = ((device_counts >= MASS_UPDATE_MIN_DEVICES) &
+               ((device_counts >= host_device_counts * MASS_UPDATE_MIN_FRACTION) |
+                (key_counts >= MASS_UPDATE_MIN_KEYS)))
+
+    mask = numpy.zeros(len(order), dtype=bool)
+    mask[order] = flagged[cluster_ids]
+
+    clusters = []
+    for cluster_id in numpy.nonzero(flagged)[0]:
+        clusters.append((int(sorted_groups[first_indexes[cluster_id]]), int(sorted_filetimes[first_indexes[cluster_id]]),
+                         int(device_counts[cluster_id]), int(key_counts[cluster_id])))
+
+    return mask, clusters
+
+
+def process_fleet_mass_updates(csv_paths, output):
+    """Reports the hosts with mass updated timestamps from the CSV output files (-f csv) of a number of hosts"""
+    write_debug(data='Method: process_fleet_mass_updates')
+
+    clusters = detect_fleet_mass_updates(load_device_table(csv_paths))
+
+    if quiet_mode is False:
+        for host, timestamp, device_count, key_count in clusters:
+            print(host + ': ' + str(key_count) + ' keys of ' + str(device_count) + ' devices at ' + timestamp.astype(str))
+
+    if output is None:
+        return
+
+    with open(output, "wb") as f:
+        f.write('Host\tTimestamp\tDevices\tKeys\n')
+
+        writer = csv.writer(f, delimiter='\t', quotechar='"', quoting=csv.QUOTE_ALL)
+        for host, timestamp, device_count, key_count in clusters:
+            writer.writerow([host, timestamp.astype(str), device_count, key_count])
+
+
+# Correlation Methods #########################################################
+
+def process_correlation(csv_paths, output):
+    """
+    Correlates the CSV output files (-f csv) of a number of hosts, reporting the hosts
+    that each physical device has been seen on. The host name is taken from the file
+    path, see get_host_names.
+
+    The sightings are hash joined on (serial, VID, PID) and the devices that share an
+    EMDMgmt volume serial number are then merged when their keys are compatible, so a
+    device that is missing its VID/PID on one host still joins to its sightings on the
+    others, while two devices holding a copy of the same volume are kept apart
+    """
+    write_debug(data='Method: process_correlation')
+
+    sightings = {}
+    volume_serials = {}
+    parents = {}
+    groups = {}
+    for host, csv_path in zip(get_host_names(csv_paths), csv_paths):
+        for device in load_devices_from_csv(csv_path):
+            key = get_correlation_key(device)
+            if key not in sightings:
+                sightings[key] = {'device': device, 'hosts': {}}
+                parents[key] = key
+                groups[key] = key
+            add_sighting(sightings[key]['hosts'], host, device)
+
+            for emd in device.emdmgmt:
+                if len(emd.volume_serial_num) == 0:
+                    continue
+                keys = volume_serials.setdefault(emd.volume_serial_num, [])
+                for other_key in keys:
+                    union_correlation_keys(parents, groups, other_key, key)
+                if key not in keys:
+                    keys.append(key)
+
+    correlated = {}
+    for key in sightings:
+        root = find_correlation_key(parents, key)
+        if root not in correlated:
+            correlated[root] = {'device': sightings[root]['device'], 'hosts': {}}
+        for host, sighting in sightings[key]['hosts'].items():
+            merge_sighting(correlated[root]['hosts'], sighting)
+
+    # Most widely seen devices first, then the hosts of each device in the order it was first seen on them
+    report = []
+    for entry in correlated.values():
+        hosts = sorted(entry['hosts'].values(), key=lambda sighting: (sighting['first'], sighting['host']))
+        report.append((entry['device'], hosts))
+    report.sort(key=lambda item: (-len(item[1]), item[1][0]['first'], item[0].serial_number))
+
+    write_debug(name='Correlated devices', value=str(len(report)))
+
+    if quiet_mode is False:
+        output_correlation_to_console(report)
+
+    if output is not None:
+        output_correlation_to_file(output, report)
+
+
+def get_correlation_key(device):
+    """Returns the normalised (serial, VID, PID) that the sightings are joined on"""
+    return (device.serial_number.lower(), device.vid.upper(), device.pid.upper())
+
+
+def is_correlation_key_compatible(key, other_key):
+    """Determines if two (serial, VID, PID) keys can be the same device, each part being equal or
+    missing from one of them. A serial number generated by Windows (& as the second character) is
+    not unique to the device so it counts as missing"""
+    serial, other_serial = key[0], other_key[0]
+    if len(serial) > 0 and len(other_serial) > 0 and serial != other_serial:
+        if serial[1:2] != '&' and other_serial[1:2] != '&':
+            return False
+
+    return all(len(part) == 0 or len(other_part) == 0 or part == other_part
+               for part, other_part in zip(key[1:], other_key[1:]))
+
+
+def merge_correlation_keys(key, other_key):
+    """Returns the key of a merged group, the parts of the first key filled in from the other"""
+    return tuple(part if len(part) > 0 else other_part for part, other_part in zip(key, other_key))
+
+
+def add_sighting(hosts, host, device):
+    """Adds a device to the sightings of a host, the first/last seen being the earliest and latest device timestamps"""
+    timestamps = [timestamp for field, timestamp in get_device_timestamps(device)]
+
+    sighting = {'host': host,
+                'first': datetime.min,
+                'last': datetime.min,
+                'users': set([mp.file for mp in device.mountpoint2]),
+                'volume_serials': set([emd.volume_serial_num for emd in device.emdmgmt if len(emd.volume_serial_num) > 0]),
+                'low_confidence': set(device.low_confidence)}
+    if len(timestamps) > 0:
+        sighting['first'] = min(timestamps)
+        sighting['last'] = max(timestamps)
+
+    merge_sighting(hosts, sighting)
+
+
+def merge_sighting(hosts, sighting):
+    """Merges a sighting into the sightings of its host"""
+    existing = hosts.get(sighting['host'])
+    if existing is None:
+        hosts[sighting['host']] = {'host': sighting['host'],
+                                   'first': sighting['first'],
+                                   'last': sighting['last'],
+                                   'users': set(sighting['users']),
+                                   'volume_serials': set(sighting['volume_serials']),
+                                   'low_confidence': set(sighting['low_confidence'])}
+        return
+
+    if existing['first'] == datetime.min or (sighting['first'] != datetime.min and sighting['first'] < existing['first']):
+        existing['first'] = sighting['first']
+    if sighting['last'] > existing['last']:
+        existing['last'] = sighting['last']
+    existing['users'].update(sighting['users'])
+    existing['volume_serials'].update(sighting['volume_serials'])
+    existing['low_confidence'].update(sighting['low_confidence'])
+
+
+def find_correlation_key(parents, key):
+    """Returns the key that a group of correlated keys is merged into, compressing the path as it goes"""
+    root = key
+    while parents[root] != root:
+        root = parents[root]
+    while parents[key] != root:
+        parents[key], key = root, parents[key]
+
+    return root
+
+
+def union_correlation_keys(parents, groups, key, other_key):
+    """Merges the groups of two keys, the group that was seen first being kept. The groups are only
+    merged when the keys they hold so far (see groups, the merged key of each root) are compatible"""
+    root = find_correlation_key(parents, key)
+    other_root = find_correlation_key(parents, other_key)
+    if root == other_root or not is_correlation_key_compatible(groups[root], groups[other_root]):
+        return
+
+    parents[other_root] = root
+    groups[root] = merge_correlation_keys(groups[root], groups.pop(other_root))
+
+
+def output_correlation_to_console(report):
+    """Outputs the device sightings to StdOut"""
+    for device, hosts in report:
+        print('Device: ' + device.vendor + ' ' + device.product + ' ' + device.serial_number +
+              ' (' + device.vid + '&' + device.pid + ')')
+        print('Hosts: ' + str(len(hosts)))
+        for sighting in hosts:
+            print('\tHost: ' + sighting['host'] + ' First: ' + format_correlation_datetime(sighting['first']) +
+                  ' Last: ' + format_correlation_datetime(sighting['last']))
+            if len(sighting['low_confidence']) > 0:
+                print('\t\tLow Confidence: ' + ', '.join(sorted(sighting['low_confidence'])))
+            for user in sorted(sighting['users']):
+                print('\t\tUser: ' + user)
+
+        print('------------------------------------------------------------------------------')
+
+
+def output_correlation_to_file(output, report):
+    """Outputs the device sightings to a file in CSV format, one row per device and host"""
+    write_debug(data='Method: output_correlation_to_file')
+
+    with open(output, "wb") as f:
+        f.write('Vendor\tProduct\tSerialNumber\tVID\tPID\tHostCount\tHost\tFirstSeen\tLastSeen\tUsers\tVolumeSerialNumbers\tLowConfidence\n')
+
+        writer = csv.writer(f, delimiter='\t', quotechar='"', quoting=csv.QUOTE_ALL)
+        for device, hosts in report:
+            for sighting in hosts:
+                data = []
+                data.append(device.vendor.encode('utf-8'))
+                data.append(device.product.encode('utf-8'))
+                data.append(device.serial_number.encode('utf-8'))
+                data.append(device.vid.encode('utf-8'))
+                data.append(device.pid.encode('utf-8'))
+                data.append(len(hosts))
+                data.append(sighting['host'])
+                data.append(format_correlation_datetime(sighting['first']))
+                data.append(format_correlation_datetime(sighting['last']))
+                data.append(', '.join(sorted(sighting['users'])).encode('utf-8'))
+                data.append(', '.join(sorted(sighting['volume_serials'])).encode('utf-8'))
+                data.append(', '.join(sorted(sighting['low_confidence'])))
+                writer.writerow(data)
+
+
+def format_correlation_datetime(timestamp):
+    """Returns a date/time as text, empty when it is missing"""
+    if timestamp == datetime.min:
+        return ''
+
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+# Query Methods ###############################################################
+
+class ResultIndex():
+    """
+    Sorted per field timestamp indexes over the devices from the CSV outputs of one or
+    more hosts, so range queries are two binary searches rather than a scan of every row.
+    The activity (first to last timestamp) of the rows is held in first seen order, with
+    a tree of the latest last seen timestamp below each node for the overlap queries
+    """
+    def __init__(self):
+        self.sources = []
+        self.rows = []
+        self.fields = {}
+        self.first_seen = []
+        self.last_seen = []
+        self.first_index = ([], [])
+        self.last_seen_tree = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def query_range(self, field, start, end):
+        """Returns the (row, field, timestamp) entries where the field is within [start, end], in time order"""
+        if field == 'any':
+            fields = QUERY_FIELDS
+        else:
+            fields = [field]
+
+        results = []
+        for name in fields:
+            timestamps, rows = self.fields[name]
+            low = bisect.bisect_left(timestamps, start)
+            high = bisect.bisect_right(timestamps, end)
+            results.extend([(rows[index], name, timestamps[index]) for index in range(low, high)])
+
+        if len(fields) > 1:
+            results.sort(key=lambda result: (result[2], result[0]))
+
+        return results
+
+    def query_overlap(self, start, end):
+        """
+        Returns the rows whose activity (first to last timestamp) overlaps [start, end], in
+        first seen order. A binary search finds the rows first seen before the end, and the
+        tree is descended over them skipping every subtree last seen before the start, so a
+        query takes O(log n) per row returned rather than a scan of the rows
+        """
+        first_timestamps, first_rows = self.first_index
+        started = bisect.bisect_right(first_timestamps, end)
+        leaves = len(self.last_seen_tree) // 2
+
+        rows = []
+        nodes = [(1, 0, leaves)]
+        while len(nodes) > 0:
+            node, low, high = nodes.pop()
+            if low >= started or self.last_seen_tree[node] < start:
+                continue
+            if high - low == 1:
+                rows.append(first_rows[low])
+                continue
+
+            middle = (low + high) // 2
+            nodes.append((node * 2 + 1, middle, high))
+            nodes.append((node * 2, low, middle))
+
+        return rows
+
+
+def build_result_index(host_devices):
+    """Builds a ResultIndex from a list of (host name, list of UsbDevice)"""
+    index = ResultIndex()
+    entries = {}
+    for field in QUERY_FIELDS:
+        entries[field] = []
+    activity = []
+
+    for host, devices in host_devices:
+        for device in devices:
+            row = len(index.rows)
+            index.rows.append((host, device))
+
+            timestamps = get_device_timestamps(device)
+            for field, timestamp in timestamps:
+                entries[field].append((timestamp, row))
+
+            if len(timestamps) > 0:
+                index.first_seen.append(min([timestamp for field, timestamp in timestamps]))
+                index.last_seen.append(max([timestamp for field, timestamp in timestamps]))
+                activity.append(row)
+            else:
+                index.first_seen.append(datetime.min)
+                index.last_seen.append(datetime.min)
+
+    for field in QUERY_FIELDS:
+        entries[field].sort()
+        index.fields[field] = ([timestamp for timestamp, row in entries[field]],
+                               [row for timestamp, row in entries[field]])
+
+    activity_by_first = sorted(activity, key=lambda row: (index.first_seen[row], row))
+    index.first_index = ([index.first_seen[row] for row in activity_by_first], activity_by_first)
+
+    # The leaves are the last seen timestamps in first seen order, each node holds the latest of its children
+    leaves = 1
+    while leaves < len(activity_by_first):
+        leaves *= 2
+    index.last_seen_tree = [datetime.min] * (leaves * 2)
+    for position, row in enumerate(activity_by_first):
+        index.last_seen_tree[leaves + position] = index.last_seen[row]
+    for node in range(leaves - 1, 0, -1):
+        index.last_seen_tree[node] = max(index.last_seen_tree[node * 2], index.last_seen_tree[node * 2 + 1])
+
+    return index
+
+
+def load_result_index(csv_paths, index_path=None):
+    """
+    Loads the CSV output files (-f csv) from a number of hosts into a ResultIndex.
+
+    The host name is taken from the file path, see get_host_names. When an index path is
+    supplied the index is kept there, and is reused by the later queries until a CSV file
+    is added, removed or modified. The index file is a pickle, so only an index written by
+    an earlier query should be supplied
+    """
+    sources = get_query_sources(csv_paths)
+    if index_path is not None and os.path.isfile(index_path):
+        try:
+            with open(index_path, 'rb') as f:
+                index = pickle.load(f)
+            if index.sources == sources:
+                write_debug(name='Reusing result index', value=index_path)
+                return index
+        except Exception:
+            write_debug(name='Unable to read result index', value=index_path)
+
+    host_devices = []
+    for host, csv_path in zip(get_host_names(csv_paths), csv_paths):
+        host_devices.append((host, load_devices_from_csv(csv_path)))
+
+    index = build_result_index(host_devices)
+    index.sources = sources
+    if index_path is None:
+        return index
+
+    try:
+        with open(index_path, 'wb') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError):
+        print('Unable to write the result index: ' + index_path)
+
+    return index
+
+
+def get_query_sources(csv_paths):
+    """Returns the (absolute path, size, modified time) of the CSV files, identifying the data an index was built from"""
+    sources = []
+    for csv_path in csv_paths:
+        stat = os.stat(csv_path)
+        sources.append((os.path.abspath(csv_path), stat.st_size, stat.st_mtime))
+
+    return sources
+
+
+def get_device_timestamps(device):
+    """Returns the (field, timestamp) pairs of a device that are set, see QUERY_FIELDS"""
+    timestamps = []
+    for source, attribute in TIMELINE_SOURCES:
+        timestamps.append((attribute, getattr(device, attribute)))
+    for mp in device.mountpoint2:
+        timestamps.append(('mountpoint2', mp.timestamp))
+    for emd in device.emdmgmt:
+        timestamps.append(('emdmgmt', emd.timestamp))
+
+    return [(field, timestamp) for field, timestamp in timestamps if timestamp != datetime.min]
+
+
+def process_query(csv_paths, field, start, end, overlap, output, index_path=None):
+    """Runs a time range query over the CSV output files (-f csv) of a number of hosts"""
+    write_debug(data='Method: process_query')
+
+    index = load_result_index(csv_paths, index_path)
+    start = parse_query_datetime(start)
+    end = parse_query_datetime(end, end_of_day=True)
+
+    results = []
+    if overlap is True:
+        for row in index.query_overlap(start, end):
+            results.append((row, 'activity', index.first_seen[row], index.last_seen[row]))
+    else:
+        for row, name, timestamp in index.query_range(field, start, end):
+            results.append((row, name, timestamp, timestamp))
+
+    write_debug(name='Query results', value=str(len(results)))
+
+    if quiet_mode is False:
+        for row, name, first, last in results:
+            host, device = index.rows[row]
+            text = (host + ': ' + device.vendor + ' ' + device.product + ' ' + device.serial_number +
+                    ' (' + device.vid + '&' + device.pid + ') ' + name + ' ' + first.strftime('%Y-%m-%dT%H:%M:%S'))
+            if overlap is True:
+                text += ' - ' + last.strftime('%Y-%m-%dT%H:%M:%S')
+            if len(get_query_low_confidence(device, name)) > 0:
+                text += ' (low confidence)'
+            print(text)
+
+    if output is None:
+        return
+
+    with open(output, "wb") as f:
+        f.write('Host\tVendor\tProduct\tSerialNumber\tVID\tPID\tField\tFirst\tLast\tLowConfidence\n')
+
+        writer = csv.writer(f, delimiter='\t', quotechar='"', quoting=csv.QUOTE_ALL)
+        for row, name, first, last in results:
+            host, device = index.rows[row]
+            data = []
+            data.append(host)
+            data.append(device.vendor.encode('utf-8'))
+            data.append(device.product.encode('utf-8'))
+            data.append(device.serial_number.encode('utf-8'))
+            data.append(device.vid.encode('utf-8'))
+            data.append(device.pid.encode('utf-8'))
+            data.append(name)
+            data.append(first.strftime('%Y-%m-%dT%H:%M:%S'))
+            data.append(last.strftime('%Y-%m-%dT%H:%M:%S'))
+            data.append(', '.join(get_query_low_confidence(device, name)))
+            writer.writerow(data)
+
+
+def get_query_low_confidence(device, name):
+    """Returns the low confidence fields behind a query result, all of them for an activity (overlap) result"""
+    if name == 'activity':
+        return device.low_confidence
+
+    return [field for field in device.low_confidence if field == name]
+
+
+def parse_query_datetime(value, end_of_day=False):
+    """Parses a query date (YYYY-MM-DD) or date/time (YYYY-MM-DDTHH:MM:SS). A date is
+    the start of the day, or the end of it when it is the end of the range"""
+    for format in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S']:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+
+    try:
+        date = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('Invalid date/time: ' + value)
+
+    if end_of_day is True:
+        return date + timedelta(days=1, microseconds=-1)
+
+    return date
+
+
+# Manifest Methods ############################################################
+
+def add_to_manifest(file, data):
+    """Records the hashes, size and MAC times of an analysed file. The hashes are computed
+    from the data that has already been read for parsing"""
+    if file in manifest:
+        return
+
+    stat = os.stat(file)
+    created = datetime.min
+    if hasattr(stat, 'st_birthtime'):
+        created = datetime.utcfromtimestamp(stat.st_birthtime)
+
+    manifest[file] = {'path': file,
+                      'inode': stat.st_ino,
+                      'size': len(data),
+                      'md5': hashlib.md5(data).hexdigest(),
+                      'sha256': hashlib.sha256(data).hexdigest(),
+                      'modified': datetime.utcfromtimestamp(stat.st_mtime),
+                      'accessed': datetime.utcfromtimestamp(stat.st_atime),
+                      'changed': datetime.utcfromtimestamp(stat.st_ctime),
+                      'created': created}
+
+
+def output_manifest_to_file(output):
+    """Outputs the chain of custody manifest to a file in CSV format"""
+    write_debug(data='Method: output_manifest_to_file')
+
+    with open(output, 'wb') as f:
+        f.write('Path\tInode\tSize\tMD5\tSHA256\tModified\tAccessed\tChanged\tCreated\n')
+        writer = csv.writer(f, delimiter='\t', quotechar='"', quoting=csv.QUOTE_ALL)
+        for entry in manifest.values():
+            data = [entry['path'], entry['inode'], entry['size'], entry['md5'], entry['sha256']]
+            for name in ['modified', 'accessed', 'changed', 'created']:
+                if entry[name] != datetime.min:
+                    data.append(entry[name].strftime('%Y-%m-%dT%H:%M:%S'))
+                else:
+                    data.append('')
+            writer.writerow(data)
+
+
+# Profile Methods #############################################################
+
+def run_stage(stage, hive, method, *args):
+    """Runs a single processing stage, recording its timings and counters when in profile mode"""
+    if profile_mode is False:
+        try:
+            return method(*args)
+        finally:
+            commit_device_store()
+
+    keys_visited = profile_counters['keys_visited']
+    values_decoded = profile_counters['values_decoded']
+    devices_matched = profile_counters['devices_matched']
+    profile_matched.clear()
+
+    profiler = None
+    if profile_directory is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    wall_start = time.time()
+    cpu_start = get_cpu_time()
+    try:
+        return method(*args)
+    finally:
+        commit_device_store()
+        cpu_seconds = get_cpu_time() - cpu_start
+        wall_seconds = time.time() - wall_start
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_directory,
+                                             str(len(profile_records)).zfill(3) + '_' + stage + '.pstats'))
+
+        profile_records.append({'stage': stage,
+                                'hive': hive,
+                                'wall_seconds': wall_seconds,
+                                'cpu_seconds': cpu_seconds,
+                                'keys_visited': profile_counters['keys_visited'] - keys_visited,
+                                'values_decoded': profile_counters['values_decoded'] - values_decoded,
+                                'devices_matched': profile_counters['devices_matched'] - devices_matched})
+
+
+def commit_device_store():
+    """Commits the devices spilled by a stage when in bounded memory mode"""
+    if isinstance(usb_devices, DeviceStore):
+        usb_devices.commit()
+
+
+def mark_device_matched(device):
+    """Counts a device as matched by the running stage when the stage joins a registry key or
+    value to it (or adds it), once per stage however many keys are joined to the device"""
+    if profile_mode is False:
+        return
+
+    key = (device.serial_number, device.vendor, device.product, device.version)
+    if key not in profile_matched:
+        profile_matched.add(key)
+        profile_counters['devices_matched'] += 1
+
+
+def get_cpu_time():
+    """Returns the user and system CPU time used by the process"""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def get_profile_totals():
+    """Aggregates the profile records by stage, in the order the stages were first run"""
+    totals = OrderedDict()
+    for record in profile_records:
+        if record['stage'] not in totals:
+            totals[record['stage']] = {'runs': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                       'keys_visited': 0, 'values_decoded': 0, 'devices_matched': 0}
+        total = totals[record['stage']]
+        total['runs'] += 1
+        for name in ['wall_seconds', 'cpu_seconds', 'keys_visited', 'values_decoded', 'devices_matched']:
+            total[name] += record[name]
+
+    return totals
+
+
+def output_profile_summary():
+    """Outputs a human readable summary of the profile to StdOut"""
+    print('Stage                              Runs    Wall (s)     CPU (s)        Keys      Values   Devices')
+    totals = get_profile_totals()
+    for stage in totals:
+        total = totals[stage]
+        print('%-32s %6d %11.3f %11.3f %11d %11d %9d' % (stage, total['runs'], total['wall_seconds'],
+                                                         total['cpu_seconds'], total['keys_visited'],
+                                                         total['values_decoded'], total['devices_matched']))
+    print('Hives opened: ' + str(profile_counters['hives_opened']))
+
+
+def output_profile_to_file(output):
+    """Outputs the profile records and per stage totals to a file in JSON format"""
+    write_debug(data='Method: output_profile_to_file')
+
+    with open(output, 'wb') as f:
+        json.dump({'hives_opened': profile_counters['hives_opened'],
+                   'stages': get_profile_totals(),
+                   'records': profile_records}, f, indent=4)
+
+
+# Helper Methods ##############################################################
+
+def load_file(file):
+    """Loads a file as a registry hive. Transaction logs are not loaded, and a dirty hive
+    is loaded from an in-memory copy that has had its transaction logs replayed"""
+    try:
+        base_block = read_base_block(file)
+        if is_transaction_log(base_block):
+            write_debug(data='Skipping transaction log: ' + file)
+            return None
+
+        if quiet_mode is False:
+            print('Loading file: ' + file)
+
+        dirty = replay_mode is True and is_hive_dirty(base_block)
+        if manifest_mode is True or dirty is True:
+            # Parse from the same buffer that is hashed
+            with open(file, 'rb') as f:
+                data = f.read()
+            if manifest_mode is True:
+                add_to_manifest(file, data)
+            if dirty is True:
+                data = replay_transaction_logs(file, data)
+                if recover_mode is True:
+                    # Deleted keys are recovered from the replayed copy
+                    recover_data[file] = data
+            registry = Registry.Registry(io.BytesIO(data))
+        else:
+            registry = Registry.Registry(file)
+
+        if profile_mode is True:
+            profile_counters['hives_opened'] += 1
+            return ProfiledRegistry(registry)
+
+        return registry
+    except Exception:
+        return None
+
+
+def get_common_directory(paths):
+    """Returns the deepest directory that contains all of the files"""
+    directories = [os.path.dirname(os.path.abspath(path)) for path in paths]
+    common = os.path.commonprefix([directory + os.sep for directory in directories])
+
+    return common[:common.rfind(os.sep) + 1]
+
+
+def get_host_names(csv_paths):
+    """Returns the host name of each CSV output file, its path from the directory the files share minus
+    the extension, e.g. host1/out.csv and host2/out.csv are the hosts host1/out and host2/out"""
+    common = get_common_directory(csv_paths)
+
+    return [os.path.splitext(os.path.abspath(csv_path)[len(common):])[0] for csv_path in csv_paths]
+
+
+def get_control_sets_text(device):
+    """Returns the control set each field was read from e.g. usb_stor_datetime=ControlSet001;vid_pid_datetime=ControlSet002"""
+    return ';'.join(field + '=' + device.control_sets[field] for field in sorted(device.control_sets.keys()))
+
+
+def parse_windows_timestamp(qword):
+    """see http://integriography.wordpress.com/2010/01/16/using-phython-to-parse-and-present-windows-64-bit-timestamps"""
+    return datetime.utcfromtimestamp(float(qword) * 1e-7 - 11644473600)
+
+
+def does_usb_device_exist(usb_device):
+    """Iterates through the module level list of USB device objects and determines if the object already exists"""
+    global usb_devices
+
+    if isinstance(usb_devices, DeviceStore):
+        return len(usb_devices.find(serial_number=usb_device.serial_number,
+                                    vendor=usb_device.vendor,
+                                    product=usb_device.product,
+                                    version=usb_device.version,
+                                    parent_prefix_id=usb_device.parent_prefix_id)) > 0
+
+    for device in usb_devices:
+        if (device.serial_number == usb_device.serial_number and
+                device.vendor == usb_device.vendor and
+                device.product == usb_device.product and
+                device.version == usb_device.version and
+                device.parent_prefix_id == usb_device.parent_prefix_id):
+            return True
+
+    return False
+
+
+def does_usb_device_key_exist(usb_device, devices):
+    """Determines if the devices hold a device with the same USBSTOR key, i.e. serial number,
+    vendor, product and version. The parent prefix ID is not compared as a recovered key
+    may not have kept its ParentIdPrefix value"""
+    if isinstance(devices, DeviceStore):
+        return len(devices.find(serial_number=usb_device.serial_number,
+                                vendor=usb_device.vendor,
+                                product=usb_device.product,
+                                version=usb_device.version)) > 0
+
+    for device in devices:
+        if (device.serial_number == usb_device.serial_number and
+                device.vendor == usb_device.vendor and
+                device.product == usb_device.product and
+                device.version == usb_device.version):
+            return True
+
+    return False
+
+
+def intern_string(value):
+    """Returns the pooled copy of a repetitive string, so identical values are only stored once"""
+    string_id = string_ids.get(value)
+    if string_id is None:
+        string_id = len(string_table)
+        string_ids[value] = string_id
+        string_table.append(value)
+
+    return string_table[string_id]
+
+
+def get_usb_device(serial_no):
+    """Iterates through the module level list of USB device objects and returns the object if it exists"""
+    global usb_devices
+
+    for device in usb_devices:
+        if device.serial_number == serial_no:
+            return device
+
+    return None
+
+
+def get_usb_device(**kwargs):
+    """Iterates through the module level list of USB device objects and returns the object if it exists"""
+    global usb_devices
+
+    if isinstance(usb_devices, DeviceStore):
+        devices = usb_devices.find(**kwargs)
+        if len(devices) > 0:
+            write_debug(data='Located USB device in the device store')
+            return devices[0]
+
+        write_debug(data='Unable to locate USB device in the device store: ' + kwargs['serial_number'])
+        return None
+
+    for device in usb_devices:
+        if len(kwargs) == 1:
+            if device.serial_number == kwargs['serial_number']:
+                write_debug(data='Located USB device by serial number')
+                return device
+        elif len(kwargs) == 4:
+            write_debug(data=kwargs['serial_number'] + '#' + kwargs['vendor'] + '#' + kwargs['product'] + '#' + kwargs['version'])
+            write_debug(data=device.serial_number + '#' + device.vendor + '#' + device.product + '#' + device.version)
+            if (device.serial_number == kwargs['serial_number'] and
+                device.vendor == kwargs['vendor'] and
+                device.product == kwargs['product'] and
+                device.version == kwargs['version']):
+
+                write_debug(data='Located USB device by multi key')
+
+                return device
+
+    if len(kwargs) == 1:
+        write_debug(data='Unable to locate USB device by serial number: ' + kwargs['serial_number'])
+    else:
+        write_debug(data='Unable to locate USB device by serial number, vendor, product, version: ' + kwargs['serial_number'] + '#' + kwargs['vendor'] + '#' + kwargs['product'] + '#' + kwargs['version'])
+
+    return None
+
+
+def control_set_check(registry):
+    """Determine which Current Control Set the system was using"""
+    key = registry.open("Select")
+    for v in key.values():
+        if v.name() == "Current":
+            return v.value()
+
+
+def get_active_control_set(registry):
+    """Returns the name of the active control set e.g. ControlSet001, or None if Select\\Current is missing"""
+    try:
+        current = control_set_check(registry)
+    except Registry.RegistryKeyNotFoundException:
+        return None
+
+    if current is None:
+        return None
+
+    return 'ControlSet%03d' % current
+
+
+def get_all_control_sets(registry):
+    """Returns the names of all of the control sets"""
+    control_sets = []
+    for k in registry.root().subkeys():
+        if 'ControlSet' in k.name():
+            control_sets.append(k.name())
+
+    return control_sets
+
+
+def get_control_sets(registry):
+    """Returns the control sets to process, only the active control set in active
+    control set mode (if Select\\Current identifies one that exists), otherwise all"""
+    control_sets = get_all_control_sets(registry)
+    if active_control_set_mode is True:
+        active = get_active_control_set(registry)
+        if active in control_sets:
+            return [active]
+
+    return control_sets
+
+
+def get_reg_value(reg_key, value):
+    """Helper method to retrieve a specific value"""
+    try:
+        return reg_key.value(value)
+    except:
+        return None
+
+
+def get_key(reg_key, key_name):
+    """Helper method to retrieve a specific key"""
+    try:
+        for sk in reg_key.subkeys():
+            if quiet_mode is False:
+                print(sk.name())
+        return reg_key.find_key(key_name)
+    except:
+        return None
+
+
+def write_debug(**kwargs):
+    """Simple debug logging"""
+    if debug_mode is False:
+        return
+
+    if len(kwargs) == 1:
+        print(kwargs['data'])
+    else:
+        print(kwargs['name'] + ': ' + kwargs['value'])
+
+
+def remove_non_ascii_characters(data):
+    """Removes all non ascii characters from a string"""
+    return ''.join([i if (ord(i) < 128 and ord(i) > 0) else '' for i in data])
+
+
+def main():
+    """Parse the command line parameters and load the configuration."""
+    parser = argparse.ArgumentParser(description='Example: usbdeviceforensics --registry "/case/registryhives" ')
+    parser.add_argument('-o', '--output', help='The output file name')
+    parser.add_argument('-f', '--format', choices=['csv', 'text'], help='Output format')
+    parser.add_argument('-d', '--debug', action='store_true', help='Debug mode, which outputs details VERY verbosely')
+    parser.add_argument('-r', '--registry', help='Path to registry hives')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False, help='Supress output to the terminal')
+    parser.add_argument('-m', '--manifest', help='Write the hashes, size and MAC times of every file analysed to this file')
+    parser.add_argument('-p', '--profile', help='Write a JSON report of the per stage timings and counters to this file')
+    parser.add_argument('--profile-dir', help='Write a cProfile dump for each stage to this directory (requires --profile)')
+    parser.add_argument('-s', '--spill', type=int, help='Bounded memory mode, keeping at most this many devices in memory and the rest in a temporary SQLite database. This is a device count, not a memory size')
+    parser.add_argument('--no-replay', action='store_true', default=False, help='Do not replay the transaction logs of dirty hives')
+    parser.add_argument('--recover', action='store_true', default=False, help='Recover deleted USBSTOR and MountPoints2 keys from the free cells of the hives')
+    parser.add_argument('--active-control-set', action='store_true', default=False, help='Only process the active control set (Select\\Current), consulting the others just for devices missing from it')
+    parser.add_argument('--find', nargs='+', metavar='TERM', help='Only look for these serial numbers, VID/PIDs (VID_0781&PID_5530 or 0781:5530), volume GUIDs or volume serial numbers (1A2B-3C4D)')
+    parser.add_argument('--diff', nargs='+', metavar='HIVE', help='Report the device changes between versions of a SYSTEM hive (oldest first) instead of processing a directory')
+    parser.add_argument('--allowlist', help='Approved device list (prebuilt or text), devices on it are tagged as approved')
+    parser.add_argument('--watchlist', help='Known bad device list (prebuilt or text), devices on it are tagged as watchlisted')
+    parser.add_argument('--violations-only', action='store_true', default=False, help='Only output the devices that are watchlisted or not on the allowlist')
+    parser.add_argument('--build-list', nargs=2, metavar=('INPUT', 'OUTPUT'), help='Convert a text device list (serial[,VID,PID] per line) into the prebuilt format and exit')
+    parser.add_argument('--correlate', nargs='+', metavar='CSV', help='Report the hosts that each device has been seen on from the CSV output files (-f csv) of a number of hosts, instead of processing a directory')
+    parser.add_argument('--query', nargs='+', metavar='CSV', help='Query the CSV output files (-f csv) of a number of hosts for the devices active in a time range (requires --range), instead of processing a directory')
+    parser.add_argument('--range', nargs=2, metavar=('START', 'END'), help='The query time range, as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS (UTC), inclusive. A date only END includes the whole day')
+    parser.add_argument('--field', choices=QUERY_FIELDS + ['any'], default='any', help='The timestamp field to query')
+    parser.add_argument('--overlap', action='store_true', default=False, help='Query for the devices whose first to last activity overlaps the range, rather than those with a timestamp in it')
+    parser.add_argument('--index', metavar='PATH', help='Keep the query index in this file and reuse it for later queries of the same CSV files. Only use an index written by an earlier query, it is a pickle')
+    parser.add_argument('--mass-updates', nargs='+', metavar='CSV', help='Report the hosts whose key timestamps have been mass updated from the CSV output files (-f csv) of a number of hosts (requires numpy), instead of processing a directory')
+    parser.add_argument('-t', '--timeline', choices=['bodyfile', 'tln', 'csv'], help='Output a merged timeline of all timestamps instead of per device data')
+    args = parser.parse_args()
+
+    if args.debug is True:
+        global debug_mode
+        debug_mode = True
+
+    if args.quiet is True:
         global quiet_mode
         quiet_mode = True
 
-    if args.format is not None:
+    if args.build_list is not None:
+        build_device_list(args.build_list[0], args.build_list[1])
+        return
+
+    if (args.registry is None and args.diff is None and args.correlate is None and args.query is None and
+            args.mass_updates is None):
+        parser.error('one of the arguments -r/--registry --diff --correlate --query --mass-updates is required')
+
+    if args.query is not None and args.range is None:
+        parser.error('--query requires --range')
+
+    if args.index is not None and args.query is None:
+        parser.error('--index requires --query')
+
+    if args.profile_dir is not None and args.profile is None:
+        parser.error('--profile-dir requires --profile')
+
+    if args.format is not None or args.timeline is not None:
         if args.output is None:
             print("The output file has not been supplied")
             return
 
-    process(args.registry, args.output, args.format)
+    if args.manifest is not None:
+        global manifest_mode
+        manifest_mode = True
+
+    if args.profile is not None:
+        global profile_mode, profile_directory
+        profile_mode = True
+        profile_directory = args.profile_dir
+        if profile_directory is not None and not os.path.isdir(profile_directory):
+            os.makedirs(profile_directory)
+
+    if args.find is not None:
+        global find_mode, find_terms
+        find_mode = True
+        find_terms = parse_find_terms(args.find)
+
+    if args.active_control_set is True:
+        global active_control_set_mode
+        active_control_set_mode = True
+
+    if args.no_replay is True:
+        global replay_mode
+        replay_mode = False
+
+    if args.recover is True:
+        global recover_mode
+        recover_mode = True
+
+    if args.allowlist is not None:
+        global allowlist
+        allowlist = DeviceList(args.allowlist)
+
+    if args.watchlist is not None:
+        global watchlist
+        watchlist = DeviceList(args.watchlist)
+
+    if args.violations_only is True:
+        global violations_only
+        violations_only = True
+
+    if args.spill is not None:
+        global usb_devices
+        usb_devices = DeviceStore(args.spill)
+
+    try:
+        if args.diff is not None:
+            process_snapshot_diff(args.diff, args.output)
+        elif args.correlate is not None:
+            process_correlation(args.correlate, args.output)
+        elif args.query is not None:
+            process_query(args.query, args.field, args.range[0], args.range[1], args.overlap, args.output, args.index)
+        elif args.mass_updates is not None:
+            process_fleet_mass_updates(args.mass_updates, args.output)
+        else:
+            process(args.registry, args.output, args.format, args.timeline)
+
+        if manifest_mode is True:
+            output_manifest_to_file(args.manifest)
+
+        if profile_mode is True:
+            output_profile_summary()
+            output_profile_to_file(args.profile)
+    finally:
+        if isinstance(usb_devices, DeviceStore):
+            usb_devices.close()
+        if allowlist is not None:
+            allowlist.close()
+        if watchlist is not None:
+            watchlist.close()
 
 if __name__ == "__main__":
     main()